@@ -1,44 +1,42 @@
 import argparse
-import sys
-import time
 
 from core_data_modules.cleaners import Codes
 from core_data_modules.traced_data import Metadata
-from core_data_modules.traced_data.io import TracedDataJsonIO, TracedDataCSVIO
+from core_data_modules.traced_data.io import TracedDataCSVIO
 from core_data_modules.util.consent_utils import ConsentUtils
-from core_data_modules.traced_data.util import FoldTracedData
 
 from lib.analysis_keys import AnalysisKeys
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generates files for analysis from the cleaned and coded show "
-                                                 "and survey responses")
-    parser.add_argument("user", help="User launching this program")
-    parser.add_argument("messages_input_dir", metavar="messages-input-dir",
-                        help="Path to a directory containing JSON files of responses to each of the shows in this "
-                             "project. Each JSON file should contain a list of serialized TracedData objects")
-    parser.add_argument("survey_input_path", metavar="survey-input-path",
-                        help="Path to a coded survey JSON file, containing a list of serialized TracedData objects")
-    parser.add_argument("json_output_path", metavar="json-output-path",
-                        help="Path to a JSON file to write serialized TracedData items to after modification by this"
-                             "pipeline stage")
-    parser.add_argument("csv_by_message_output_path", metavar="csv-by-message-output-path",
-                        help="Analysis dataset where messages are the unit for analysis (i.e. one message per row)")
-    parser.add_argument("csv_by_individual_output_path", metavar="csv-by-individual-output-path",
-                        help="Analysis dataset where respondents are the unit for analysis (i.e. one respondent "
-                             "per row, with all their messages joined into a single cell).")
-
-    args = parser.parse_args()
-    user = args.user
-    data_input_path = args.survey_input_path
-    json_output_path = args.json_output_path
-    csv_by_message_output_path = args.csv_by_message_output_path
-    csv_by_individual_output_path = args.csv_by_individual_output_path
-
-    # Serializer is currently overflowing
-    # TODO: Investigate/address the cause of this.
-    sys.setrecursionlimit(10000)
-
+from lib.columnar import ColumnarDataset, ColumnBuffers
+from lib.fold import TracedDataFolder
+from pipeline_lib.code_keys import CodeKeyCatalogue
+from pipeline_lib.derivation_plan import DerivationPlan
+from pipeline_lib.history import HistoryCheckpointWriter, TracedDataHistory
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+
+
+def generate_analysis_files(user, data, code_key_catalogue, history_checkpoint_path, csv_by_message_output_path,
+                            csv_by_individual_output_path):
+    """
+    Translates cleaned and coded messages to analysis keys, folds them to one row per respondent, and exports both to
+    CSV and to columnar datasets (see ColumnarDataset), which are written to directories next to the CSVs.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param data: Cleaned and coded messages.
+    :type data: list of TracedData
+    :param code_key_catalogue: Catalogue of the matrix code keys in data, or None to search every message for them.
+    :type code_key_catalogue: CodeKeyCatalogue | None
+    :param history_checkpoint_path: Path to a JSON Lines file to write the full histories of the compacted TracedData
+                                    to.
+    :type history_checkpoint_path: str
+    :param csv_by_message_output_path: Path to write the analysis dataset with one message per row to.
+    :type csv_by_message_output_path: str
+    :param csv_by_individual_output_path: Path to write the analysis dataset with one respondent per row to.
+    :type csv_by_individual_output_path: str
+    :return: Folded data, with one TracedData object per respondent.
+    :rtype: list of TracedData
+    """
     demog_keys = [
         "district",
         "region",
@@ -68,20 +66,26 @@ if __name__ == "__main__":
     rapid_pro_consent_withdrawn_key = "esc4jmcna_consent_s07e01_complete"
     avf_consent_withdrawn_key = "withdrawn_consent"
 
-    # Load cleaned and coded message/survey data
-    with open(data_input_path, "r") as f:
-        data = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+    # Compact the histories built by the earlier stages, so that their lineages don't have to be carried through (and
+    # recursively serialized by) this stage. The full histories are kept in the history checkpoint file.
+    history_checkpoint_writer = HistoryCheckpointWriter(history_checkpoint_path)
+    with Instrumentation.span("compact_histories") as span:
+        data = TracedDataHistory.compact_iterable(user, data, history_checkpoint_writer)
+        span.count("records_in", len(data))
 
     # Translate keys to final values for analysis
-    show_keys = set()
-    for td in data:
-        AnalysisKeys.set_analysis_keys(user, td)
-        AnalysisKeys.set_matrix_keys(
-            user, td, show_keys, "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation_coded",
-            "humanitarian_priorities"
-        )
-    show_keys = list(show_keys)
-    show_keys.sort()
+    coded_shows_prefix = "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation_coded"
+    if code_key_catalogue is None:
+        print("Warning: No code key catalogue; searching every message for matrix keys instead")
+        code_key_catalogue = CodeKeyCatalogue.from_data(data, [coded_shows_prefix])
+
+    with Instrumentation.span("set_analysis_keys") as span:
+        AnalysisKeys.set_analysis_keys_iterable(user, data)
+        span.count("records_in", len(data))
+    with Instrumentation.span("set_matrix_keys") as span:
+        show_keys = AnalysisKeys.set_matrix_keys_iterable(
+            user, data, code_key_catalogue, coded_shows_prefix, "humanitarian_priorities")
+        span.count("records_in", len(data))
 
     equal_keys = ["UID", "operator"]
     equal_keys.extend(demog_keys)
@@ -107,45 +111,133 @@ if __name__ == "__main__":
     export_keys.extend(evaluation_keys)
 
     # Set consent withdrawn based on presence of data coded as "stop"
-    ConsentUtils.determine_consent_withdrawn(user, data, export_keys, avf_consent_withdrawn_key)
+    with Instrumentation.span("determine_consent_withdrawn") as span:
+        ConsentUtils.determine_consent_withdrawn(user, data, export_keys, avf_consent_withdrawn_key)
+        span.count("records_in", len(data))
+
+    # Derive the remaining consent withdrawn codes in one pass over the data, with one append_data per message.
+    consent_plan = DerivationPlan()
 
     # Set consent withdrawn based on stop codes from humanitarian priorities.
     # TODO: Update Core Data to set 'stop's instead of '1's?
-    for td in data:
+    @consent_plan.add_rule
+    def set_withdrawn_from_priorities_stop(td):
         if td.get("humanitarian_priorities_stop") == "1":
-            td.append_data({avf_consent_withdrawn_key: Codes.TRUE}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {avf_consent_withdrawn_key: Codes.TRUE}
 
     # Set consent withdrawn based on auto-categorisation in Rapid Pro
-    for td in data:
+    @consent_plan.add_rule
+    def set_withdrawn_from_rapid_pro(td):
         if td.get(rapid_pro_consent_withdrawn_key) == "yes":  # Not using Codes.YES because this is from Rapid Pro
-            td.append_data({avf_consent_withdrawn_key: Codes.TRUE}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {avf_consent_withdrawn_key: Codes.TRUE}
 
-    for td in data:
+    @consent_plan.add_rule
+    def set_not_withdrawn(td):
         if avf_consent_withdrawn_key not in td:
-            td.append_data({avf_consent_withdrawn_key: Codes.FALSE}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {avf_consent_withdrawn_key: Codes.FALSE}
 
-    # Fold data to have one respondent per row
-    to_be_folded = []
-    for td in data:
-        to_be_folded.append(td.copy())
+    with Instrumentation.span("derive_consent_withdrawn") as span:
+        consent_plan.apply(user, data, Metadata.get_call_location())
+        span.count("records_in", len(data))
 
-    folded_data = FoldTracedData.fold_iterable_of_traced_data(
-        user, data, fold_id_fn=lambda td: td["UID"],
+    # Fold data to have one respondent per row
+    folder = TracedDataFolder(
+        user, fold_id_fn=lambda td: td["UID"],
         equal_keys=equal_keys, concat_keys=concat_keys, matrix_keys=matrix_keys, bool_keys=bool_keys
     )
+    with Instrumentation.span("fold") as span:
+        folded_data = folder.fold(data)
+        span.count("records_in", len(data))
+        span.count("records_out", len(folded_data))
 
     # Process consent
     stop_keys = set(export_keys) - {avf_consent_withdrawn_key}
-    ConsentUtils.set_stopped(user, data, avf_consent_withdrawn_key)
-    ConsentUtils.set_stopped(user, folded_data, avf_consent_withdrawn_key)
+    with Instrumentation.span("set_stopped") as span:
+        ConsentUtils.set_stopped(user, data, avf_consent_withdrawn_key)
+        ConsentUtils.set_stopped(user, folded_data, avf_consent_withdrawn_key)
+        span.count("records_in", len(data) + len(folded_data))
 
-    # Output to CSV with one message per row
-    with open(csv_by_message_output_path, "w") as f:
-        TracedDataCSVIO.export_traced_data_iterable_to_csv(data, f, headers=export_keys)
+    # Extract the exported keys once, then write the CSVs and the columnar datasets from the extracted columns
+    with Instrumentation.span("extract_columns") as span:
+        message_columns = ColumnBuffers.from_traced_data(data, export_keys)
+        individual_columns = ColumnBuffers.from_traced_data(folded_data, export_keys)
+        span.count("records_in", len(data) + len(folded_data))
 
-    with open(csv_by_individual_output_path, "w") as f:
-        TracedDataCSVIO.export_traced_data_iterable_to_csv(folded_data, f, headers=export_keys)
+    # Output to CSV with one message per row, and with one respondent per row
+    with Instrumentation.span("export_csv") as span:
+        with open(csv_by_message_output_path, "w") as f:
+            TracedDataCSVIO.export_traced_data_iterable_to_csv(message_columns.rows(), f, headers=export_keys)
 
-    # Export JSON
-    with open(json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_json(folded_data, f, pretty_print=True)
+        with open(csv_by_individual_output_path, "w") as f:
+            TracedDataCSVIO.export_traced_data_iterable_to_csv(individual_columns.rows(), f, headers=export_keys)
+        span.count("records_out", len(data) + len(folded_data))
+
+    with Instrumentation.span("export_columns") as span:
+        ColumnarDataset.write(message_columns, ColumnarDataset.path_for(csv_by_message_output_path))
+        ColumnarDataset.write(individual_columns, ColumnarDataset.path_for(csv_by_individual_output_path))
+        span.count("records_out", len(data) + len(folded_data))
+
+    # Compact the folded data for export
+    with Instrumentation.span("compact_folded_histories") as span:
+        folded_data = TracedDataHistory.compact_iterable(user, folded_data, history_checkpoint_writer)
+        span.count("records_in", len(folded_data))
+    history_checkpoint_writer.close()
+
+    return folded_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates files for analysis from the cleaned and coded show "
+                                                 "and survey responses")
+    parser.add_argument("user", help="User launching this program")
+    parser.add_argument("messages_input_dir", metavar="messages-input-dir",
+                        help="Path to a directory containing JSON files of responses to each of the shows in this "
+                             "project. Each JSON file should contain a list of serialized TracedData objects")
+    parser.add_argument("survey_input_path", metavar="survey-input-path",
+                        help="Path to a coded survey JSON file, containing a list of serialized TracedData objects")
+    parser.add_argument("json_output_path", metavar="json-output-path",
+                        help="Path to a JSON file to write serialized TracedData items to after modification by this"
+                             "pipeline stage")
+    parser.add_argument("csv_by_message_output_path", metavar="csv-by-message-output-path",
+                        help="Analysis dataset where messages are the unit for analysis (i.e. one message per row)")
+    parser.add_argument("csv_by_individual_output_path", metavar="csv-by-individual-output-path",
+                        help="Analysis dataset where respondents are the unit for analysis (i.e. one respondent "
+                             "per row, with all their messages joined into a single cell).")
+    parser.add_argument("--history-checkpoint-path", metavar="history-checkpoint-path",
+                        help="Path to a JSON Lines file to write the full histories of the compacted TracedData in "
+                             "json-output-path to. Defaults to json-output-path followed by '.history.jsonl'")
+    parser.add_argument("--code-key-catalogue-path", metavar="code-key-catalogue-path",
+                        help="Path to the catalogue of matrix code keys written by the apply manual codes stage. "
+                             "Defaults to survey-input-path followed by '.code_keys.json'. If there is no catalogue, "
+                             "the keys of every message are searched instead")
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    user = args.user
+    data_input_path = args.survey_input_path
+    json_output_path = args.json_output_path
+    csv_by_message_output_path = args.csv_by_message_output_path
+    csv_by_individual_output_path = args.csv_by_individual_output_path
+    output_format = args.output_format
+    history_checkpoint_path = args.history_checkpoint_path
+    code_key_catalogue_path = args.code_key_catalogue_path
+    if code_key_catalogue_path is None:
+        code_key_catalogue_path = CodeKeyCatalogue.path_for(data_input_path)
+    if history_checkpoint_path is None:
+        history_checkpoint_path = TracedDataHistory.checkpoint_path_for(json_output_path)
+
+    with Instrumentation.from_args("analysis_file", args):
+        # Load cleaned and coded message/survey data
+        with Instrumentation.span("load") as span:
+            data = TracedDataInterchangeIO.load(data_input_path)
+            code_key_catalogue = CodeKeyCatalogue.load(code_key_catalogue_path)
+            span.count("records_out", len(data))
+
+        folded_data = generate_analysis_files(user, data, code_key_catalogue, history_checkpoint_path,
+                                              csv_by_message_output_path, csv_by_individual_output_path)
+
+        # Export JSON
+        with Instrumentation.span("dump") as span:
+            TracedDataInterchangeIO.dump(folded_data, json_output_path, output_format, pretty_print=True)
+            span.count("records_in", len(folded_data))
@@ -19,7 +19,8 @@ OUTPUT_MESSAGES_CSV=$5
 OUTPUT_INDIVIDUALS_CSV=$6
 
 # Build an image for this pipeline stage.
-docker build -t "$IMAGE_NAME" .
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
 
 # Create a container from the image that was just built.
 container="$(docker container create --env USER="$USER" "$IMAGE_NAME")"
@@ -32,6 +33,9 @@ trap finish EXIT
 
 # Copy input data into the container
 docker cp "$INPUT_SURVEY" "$container:/data/survey-input.json"
+if [ -f "$INPUT_SURVEY.code_keys.json" ]; then
+    docker cp "$INPUT_SURVEY.code_keys.json" "$container:/data/survey-input.json.code_keys.json"
+fi
 docker cp "$INPUT_MESSAGES_DIR/." "$container:/data/messages-input"
 
 # Run the container
@@ -40,9 +44,14 @@ docker start -a -i "$container"
 # Copy the output data back out of the container
 mkdir -p "$(dirname "$OUTPUT_JSON")"
 docker cp "$container:/data/output.json" "$OUTPUT_JSON"
+docker cp "$container:/data/output.json.history.jsonl" "$OUTPUT_JSON.history.jsonl"
 
 mkdir -p "$(dirname "$OUTPUT_MESSAGES_CSV")"
 docker cp "$container:/data/output-messages.csv" "$OUTPUT_MESSAGES_CSV"
+rm -rf "$OUTPUT_MESSAGES_CSV.columns"
+docker cp "$container:/data/output-messages.csv.columns" "$OUTPUT_MESSAGES_CSV.columns"
 
 mkdir -p "$(dirname "$OUTPUT_INDIVIDUALS_CSV")"
 docker cp "$container:/data/output-individuals.csv" "$OUTPUT_INDIVIDUALS_CSV"
+rm -rf "$OUTPUT_INDIVIDUALS_CSV.columns"
+docker cp "$container:/data/output-individuals.csv.columns" "$OUTPUT_INDIVIDUALS_CSV.columns"
@@ -1,10 +1,12 @@
 import time
 
-import pytz  # Timezone library for converting datetime objects between timezones
 from core_data_modules.cleaners import Codes, somali
 from core_data_modules.traced_data import Metadata
 from dateutil.parser import isoparse
 
+from pipeline_lib.bulk_metadata import BulkMetadata
+from pipeline_lib.timestamps import EAT, Timestamps
+
 
 class AnalysisKeys(object):
     # TODO: Move some of these methods to Core Data?
@@ -15,7 +17,18 @@ class AnalysisKeys(object):
 
     @staticmethod
     def get_date_time_eat(td):
-        return isoparse(td["created_on"]).astimezone(pytz.timezone("Africa/Nairobi")).strftime("%Y-%m-%d %H:%M")
+        return AnalysisKeys.get_date_time_eat_iterable([td])[0]
+
+    @staticmethod
+    def get_date_time_eat_iterable(data):
+        """
+        Batch version of get_date_time_eat, which converts the creation times of all of the TracedData objects at once.
+
+        :type data: iterable of TracedData
+        :return: Creation time of each TracedData object in EAT, formatted as "%Y-%m-%d %H:%M", in input order.
+        :rtype: list of str
+        """
+        return Timestamps.date_time_iterable(Timestamps.parse_iterable(td["created_on"] for td in data), EAT)
 
     @staticmethod
     def set_yes_no_matrix_keys(user, td, show_keys, coded_shows_prefix, radio_q_prefix):
@@ -60,8 +73,59 @@ class AnalysisKeys(object):
 
         td.append_data(matrix_d, Metadata(user, Metadata.get_call_location(), time.time()))
 
+    @staticmethod
+    def set_matrix_keys_iterable(user, data, code_key_catalogue, coded_shows_prefix, radio_q_prefix):
+        """
+        Batch version of set_matrix_keys, which maps coded keys to output keys using a catalogue of the coded keys
+        rather than by searching the keys of every TracedData object.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to set the matrix keys of.
+        :type data: iterable of TracedData
+        :param code_key_catalogue: Catalogue of the coded keys in data.
+        :type code_key_catalogue: pipeline_lib.code_keys.CodeKeyCatalogue
+        :type coded_shows_prefix: str
+        :type radio_q_prefix: str
+        :return: Sorted list of the matrix keys which were set (the show keys).
+        :rtype: list of str
+        """
+        key_map = code_key_catalogue.matrix_key_map(coded_shows_prefix, radio_q_prefix)
+        stop_key = "{}_{}".format(coded_shows_prefix, Codes.STOP)
+
+        matrix_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td in data:
+            stopped = td.get(stop_key) == "1"
+
+            matrix_d = dict()
+            for coded_key, code_key in key_map:
+                if coded_key in td:
+                    matrix_d[code_key] = Codes.STOP if stopped else td[coded_key]
+
+            matrix_metadata.append_data(td, matrix_d)
+
+        return [code_key for _, code_key in key_map]
+
     @classmethod
     def set_analysis_keys(cls, user, td):
+        cls._append_analysis_keys(td, Metadata(user, Metadata.get_call_location(), time.time()))
+
+    @classmethod
+    def set_analysis_keys_iterable(cls, user, data):
+        """
+        Batch version of set_analysis_keys, which shares one Metadata object between all of the TracedData objects.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to set the analysis keys of.
+        :type data: iterable of TracedData
+        """
+        analysis_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td in data:
+            cls._append_analysis_keys(td, analysis_metadata.metadata)
+
+    @staticmethod
+    def _append_analysis_keys(td, metadata):
         td.append_data({
             "UID": td["avf_phone_id"],
             "operator": td["operator"],
@@ -93,4 +157,4 @@ class AnalysisKeys(object):
 
             "repeated": td["repeated_esc4jmcna_coded"],
             "repeated_raw": td["repeated_esc4jmcna"],
-        }, Metadata(user, Metadata.get_call_location(), time.time()))
+        }, metadata)
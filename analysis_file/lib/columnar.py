@@ -0,0 +1,225 @@
+import ast
+import json
+import os
+import struct
+import sys
+from array import array
+
+from core_data_modules.util import IOUtils
+
+# Byte order mark of the arrays written by this process, in numpy's dtype notation
+_BYTE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+
+class ColumnBuffers(object):
+    """
+    The values of a fixed list of keys for each of a list of TracedData objects, held as one list per key.
+
+    Extracting the columns reads each key of each TracedData object once. Every export of the dataset is then written
+    from these lists, rather than each export looking the keys up again through the TracedData histories.
+    """
+
+    def __init__(self, keys, columns):
+        """
+        :param keys: Name of each column.
+        :type keys: list of str
+        :param columns: Values of each column, one list per key, all of the same length. Missing values are None.
+        :type columns: list of list
+        """
+        self.keys = keys
+        self.columns = columns
+
+    @classmethod
+    def from_traced_data(cls, data, keys):
+        """
+        :type data: iterable of TracedData
+        :param keys: Keys to extract.
+        :type keys: list of str
+        :rtype: ColumnBuffers
+        """
+        columns = [[] for _ in keys]
+        for td in data:
+            for key, column in zip(keys, columns):
+                column.append(td.get(key))
+        return cls(keys, columns)
+
+    def __len__(self):
+        return 0 if len(self.columns) == 0 else len(self.columns[0])
+
+    def rows(self):
+        """
+        Returns each row as a dictionary of key -> value, for writers which take one mapping per row, such as
+        TracedDataCSVIO.export_traced_data_iterable_to_csv.
+
+        :rtype: generator of dict
+        """
+        for values in zip(*self.columns):
+            yield dict(zip(self.keys, values))
+
+
+class ColumnarDataset(object):
+    """
+    Writes ColumnBuffers to a directory of NumPy .npy files, one or more per column, so that analysts can load the
+    analysis datasets much faster than by parsing the CSVs (e.g. with numpy.load, or RcppCNPy in R).
+
+    The directory contains a manifest, columns.json, which lists the columns in order, with the encoding and files of
+    each. Values are written as strings, and missing values are distinguished from empty strings:
+     - Columns with at most DICTIONARY_MAX_SIZE distinct values (e.g. codes) are dictionary encoded: the manifest lists
+       the distinct values, and '<n>.codes.npy' is an int16 array of the position of each row's value in that list,
+       or -1 if the value is missing.
+     - Other columns (e.g. UIDs and raw messages) are written as UTF-8: '<n>.data.npy' is a uint8 array of all of the
+       values' UTF-8 bytes, concatenated, and '<n>.offsets.npy' is an int64 array of the offset of the start of each
+       row's value in that array, followed by the total length. '<n>.valid.npy' is a bool array of whether each row
+       has a value.
+    The .npy files are written with the standard library, so the pipeline does not depend on NumPy.
+    """
+    VERSION = 1
+    MANIFEST_FILE_NAME = "columns.json"
+    DICTIONARY_MAX_SIZE = 256
+
+    _NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+    @staticmethod
+    def path_for(csv_path):
+        """
+        Returns the path of the columnar dataset directory to write next to a CSV export of the same dataset.
+
+        :type csv_path: str
+        :rtype: str
+        """
+        return "{}.columns".format(csv_path)
+
+    @classmethod
+    def _write_npy(cls, path, descr, values, length):
+        """
+        Writes a one-dimensional array in NumPy's .npy format (version 1.0).
+
+        :param descr: NumPy type of the array, e.g. '<i2'.
+        :type descr: str
+        :param values: The array's data.
+        :type values: array.array | bytes
+        :param length: Number of elements in the array.
+        :type length: int
+        """
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(descr, length)
+        # The header is padded with spaces and ends with a newline, so that the data starts on a 64 byte boundary
+        header_length = len(header) + 1
+        header += " " * (-(len(cls._NPY_MAGIC) + 2 + header_length) % 64) + "\n"
+
+        with open(path, "wb") as f:
+            f.write(cls._NPY_MAGIC)
+            f.write(struct.pack("<H", len(header)))
+            f.write(header.encode("latin1"))
+            f.write(values)
+
+    @classmethod
+    def _read_npy(cls, path, typecode):
+        with open(path, "rb") as f:
+            if f.read(len(cls._NPY_MAGIC)) != cls._NPY_MAGIC:
+                raise ValueError("'{}' is not a version 1.0 .npy file".format(path))
+            header_length = struct.unpack("<H", f.read(2))[0]
+            header = ast.literal_eval(f.read(header_length).decode("latin1"))
+            values = array(typecode, f.read())
+
+        if header["descr"][0] not in {"|", _BYTE_ORDER}:
+            values.byteswap()
+        return values
+
+    @classmethod
+    def _write_dictionary_column(cls, dir_path, file_prefix, values, dictionary):
+        positions = {value: i for i, value in enumerate(dictionary)}
+        codes = array("h", [-1 if value is None else positions[value] for value in values])
+        codes_file = "{}.codes.npy".format(file_prefix)
+        cls._write_npy(os.path.join(dir_path, codes_file), "{}i2".format(_BYTE_ORDER), codes, len(codes))
+        return {"encoding": "dictionary", "dictionary": dictionary, "codes": codes_file}
+
+    @classmethod
+    def _write_utf8_column(cls, dir_path, file_prefix, values):
+        data = bytearray()
+        offsets = array("q", [0])
+        valid = bytearray()
+        for value in values:
+            if value is not None:
+                data.extend(value.encode("utf-8"))
+            offsets.append(len(data))
+            valid.append(value is not None)
+
+        files = {
+            "data": "{}.data.npy".format(file_prefix),
+            "offsets": "{}.offsets.npy".format(file_prefix),
+            "valid": "{}.valid.npy".format(file_prefix)
+        }
+        cls._write_npy(os.path.join(dir_path, files["data"]), "|u1", data, len(data))
+        cls._write_npy(os.path.join(dir_path, files["offsets"]), "{}i8".format(_BYTE_ORDER), offsets, len(offsets))
+        cls._write_npy(os.path.join(dir_path, files["valid"]), "|b1", valid, len(valid))
+
+        column = {"encoding": "utf8"}
+        column.update(files)
+        return column
+
+    @classmethod
+    def write(cls, columns, dir_path):
+        """
+        Writes a columnar dataset, replacing any files from a previous dataset in the same directory.
+
+        :param columns: Columns to write.
+        :type columns: ColumnBuffers
+        :param dir_path: Directory to write the dataset to.
+        :type dir_path: str
+        """
+        IOUtils.ensure_dirs_exist(dir_path)
+        for file_name in os.listdir(dir_path):
+            if file_name.endswith(".npy") or file_name == cls.MANIFEST_FILE_NAME:
+                os.remove(os.path.join(dir_path, file_name))
+
+        manifest_columns = []
+        for i, (key, values) in enumerate(zip(columns.keys, columns.columns)):
+            values = [None if value is None else str(value) for value in values]
+            dictionary = sorted({value for value in values if value is not None})
+
+            file_prefix = "{:03d}".format(i)
+            if len(dictionary) <= cls.DICTIONARY_MAX_SIZE:
+                column = cls._write_dictionary_column(dir_path, file_prefix, values, dictionary)
+            else:
+                column = cls._write_utf8_column(dir_path, file_prefix, values)
+            column["name"] = key
+            manifest_columns.append(column)
+
+        with open(os.path.join(dir_path, cls.MANIFEST_FILE_NAME), "w") as f:
+            json.dump({
+                "version": cls.VERSION,
+                "rows": len(columns),
+                "columns": manifest_columns
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, dir_path):
+        """
+        Reads a columnar dataset written by write, e.g. to audit it without NumPy.
+
+        :param dir_path: Directory the dataset was written to.
+        :type dir_path: str
+        :return: The dataset's columns. All of the values are strings or None.
+        :rtype: ColumnBuffers
+        """
+        with open(os.path.join(dir_path, cls.MANIFEST_FILE_NAME), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != cls.VERSION:
+            raise ValueError("Columnar dataset '{}' has unsupported version {}".format(dir_path, manifest["version"]))
+
+        keys = []
+        columns = []
+        for column in manifest["columns"]:
+            keys.append(column["name"])
+            if column["encoding"] == "dictionary":
+                dictionary = column["dictionary"]
+                codes = cls._read_npy(os.path.join(dir_path, column["codes"]), "h")
+                columns.append([None if code == -1 else dictionary[code] for code in codes])
+            else:
+                data = cls._read_npy(os.path.join(dir_path, column["data"]), "B").tobytes()
+                offsets = cls._read_npy(os.path.join(dir_path, column["offsets"]), "q")
+                valid = cls._read_npy(os.path.join(dir_path, column["valid"]), "B")
+                columns.append([data[start:end].decode("utf-8") if is_valid else None
+                                for start, end, is_valid in zip(offsets, offsets[1:], valid)])
+
+        return ColumnBuffers(keys, columns)
@@ -0,0 +1,168 @@
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata
+
+from pipeline_lib.bulk_metadata import BulkMetadata
+
+
+class FoldReducers(object):
+    """
+    Per-column reducers for TracedDataFolder, matching the semantics of the equal/concat/matrix/bool keys of
+    FoldTracedData.fold_iterable_of_traced_data.
+
+    Each reducer is a pair of functions: `start(td, key)`, which returns the accumulated state for the first message in
+    a group, and `add(state, td, key)`, which returns the state after adding another message.
+    """
+
+    @staticmethod
+    def start_equal(td, key):
+        return td.get(key)
+
+    @staticmethod
+    def add_equal(state, td, key):
+        assert td.get(key) == state, "Key '{}' should be the same in all of the messages being folded but is " \
+                                     "different (has values '{}' and '{}')".format(key, state, td.get(key))
+        return state
+
+    @staticmethod
+    def start_concat(td, key):
+        return str(td[key])
+
+    @staticmethod
+    def add_concat(state, td, key):
+        return "{};{}".format(state, td[key])
+
+    @staticmethod
+    def start_matrix(td, key):
+        return td.get(key, "0")
+
+    @staticmethod
+    def add_matrix(state, td, key):
+        return "1" if state == "1" or td.get(key, "0") == "1" else "0"
+
+    @staticmethod
+    def start_bool(td, key):
+        return td.get(key, Codes.FALSE)
+
+    @staticmethod
+    def add_bool(state, td, key):
+        return Codes.TRUE if state == Codes.TRUE or td.get(key, Codes.FALSE) == Codes.TRUE else Codes.FALSE
+
+
+class TracedDataFolder(object):
+    """
+    Folds messages to one TracedData object per fold id (e.g. per respondent), with typed reducers per column.
+
+    fold makes a single hash-aggregate pass over the data, keeping only the first message and the reduced column values
+    of each group. fold_sorted does the same for input which is sorted by fold id, holding only one group in memory at
+    a time, so that datasets larger than memory can be folded from a stream.
+
+    Groups of one message are returned unchanged (not copied), as in FoldTracedData. Larger groups are returned as a
+    copy of their first message, updated with the reduced values of the equal, concat, matrix and bool keys. Every
+    folded group shares one Metadata object.
+    """
+
+    def __init__(self, user, fold_id_fn, equal_keys=None, concat_keys=None, matrix_keys=None, bool_keys=None):
+        """
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param fold_id_fn: Function which returns the id to fold a message by.
+        :type fold_id_fn: function of TracedData -> hashable
+        :param equal_keys: Keys which must have the same value in all the messages of a group.
+        :type equal_keys: list of str | None
+        :param concat_keys: Keys whose values are joined with ';'.
+        :type concat_keys: list of str | None
+        :param matrix_keys: Matrix keys, which are "1" if they are "1" in any message of a group, and "0" otherwise.
+        :type matrix_keys: list of str | None
+        :param bool_keys: Keys which are Codes.TRUE if they are Codes.TRUE in any message of a group, and Codes.FALSE
+                          otherwise.
+        :type bool_keys: list of str | None
+        """
+        self.user = user
+        self.fold_id_fn = fold_id_fn
+
+        self.columns = []  # of (key, start function, add function)
+        for keys, start, add in [
+            (equal_keys, FoldReducers.start_equal, FoldReducers.add_equal),
+            (concat_keys, FoldReducers.start_concat, FoldReducers.add_concat),
+            (matrix_keys, FoldReducers.start_matrix, FoldReducers.add_matrix),
+            (bool_keys, FoldReducers.start_bool, FoldReducers.add_bool)
+        ]:
+            for key in keys or []:
+                self.columns.append((key, start, add))
+
+    def _start_group(self, td):
+        return _FoldGroup(td, [start(td, key) for key, start, _ in self.columns])
+
+    def _add_to_group(self, group, td):
+        group.size += 1
+        group.values = [add(value, td, key) for (key, _, add), value in zip(self.columns, group.values)]
+
+    def _finish_group(self, group, metadata):
+        if group.size == 1:
+            return group.first
+
+        folded = group.first.copy()
+        metadata.append_data(folded, {key: value for (key, _, _), value in zip(self.columns, group.values)})
+        return folded
+
+    def fold(self, data):
+        """
+        Folds messages in any order, with one pass over the data.
+
+        :type data: iterable of TracedData
+        :return: Folded TracedData objects, in order of the first message of each group.
+        :rtype: list of TracedData
+        """
+        # Metadata.get_call_location walks the stack, so look it up once rather than once per group.
+        metadata = BulkMetadata(self.user, Metadata.get_call_location())
+
+        groups = dict()
+        group_order = []
+        for td in data:
+            fold_id = self.fold_id_fn(td)
+            group = groups.get(fold_id)
+            if group is None:
+                groups[fold_id] = self._start_group(td)
+                group_order.append(fold_id)
+            else:
+                self._add_to_group(group, td)
+
+        return [self._finish_group(groups[fold_id], metadata) for fold_id in group_order]
+
+    def fold_sorted(self, data):
+        """
+        Lazily folds messages which are sorted by fold id, holding one group in memory at a time.
+
+        :param data: TracedData objects, sorted by fold id.
+        :type data: iterable of TracedData
+        :return: Generator of folded TracedData objects, in input order.
+        :rtype: generator of TracedData
+        """
+        metadata = BulkMetadata(self.user, Metadata.get_call_location())
+
+        group = None
+        fold_id = None
+        for td in data:
+            td_fold_id = self.fold_id_fn(td)
+            if group is not None and td_fold_id == fold_id:
+                self._add_to_group(group, td)
+                continue
+
+            if group is not None:
+                if td_fold_id < fold_id:
+                    raise ValueError("Input to fold_sorted is not sorted by fold id (found '{}' after '{}')".format(
+                        td_fold_id, fold_id))
+                yield self._finish_group(group, metadata)
+
+            fold_id = td_fold_id
+            group = self._start_group(td)
+
+        if group is not None:
+            yield self._finish_group(group, metadata)
+
+
+class _FoldGroup(object):
+    def __init__(self, first, values):
+        self.first = first
+        self.values = values
+        self.size = 1
@@ -0,0 +1,96 @@
+import os
+import sys
+import unittest
+
+# The stage's `lib` package is imported relative to the stage directory, and pipeline_lib from the repository root,
+# as they are when the stage is run.
+STAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(STAGE_DIR))
+sys.path.insert(0, STAGE_DIR)
+# Every stage has its own `lib` package, so forget any imported by another stage's tests run in the same process.
+for module in [name for name in sys.modules if name == "lib" or name.startswith("lib.")]:
+    del sys.modules[module]
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.util import FoldTracedData
+
+from lib.fold import TracedDataFolder
+
+
+class TestTracedDataFolder(unittest.TestCase):
+    """
+    Checks that TracedDataFolder folds messages to the same values as FoldTracedData.fold_iterable_of_traced_data.
+    """
+    USER = "test_user"
+    EQUAL_KEYS = ["UID", "gender"]
+    CONCAT_KEYS = ["message"]
+    MATRIX_KEYS = ["water", "food"]
+    BOOL_KEYS = ["withdrawn"]
+
+    @classmethod
+    def make_messages(cls):
+        # Messages from respondents 0-6, where respondents 5 and 6 sent one message each, and some messages are missing
+        # matrix or bool keys
+        messages = []
+        for i in range(26):
+            uid = "uid-{}".format(i % 5 if i < 24 else i - 19)
+            message = {"UID": uid, "gender": "gender of {}".format(uid), "message": "message {}".format(i)}
+            if i % 3 != 0:
+                message["water"] = "1" if i % 4 == 0 else "0"
+            if i % 5 != 1:
+                message["food"] = "1" if i == 7 else "0"
+            if i % 2 == 0:
+                message["withdrawn"] = Codes.TRUE if i == 12 else Codes.FALSE
+            messages.append(TracedData(message, Metadata(cls.USER, "messages", 0)))
+        return messages
+
+    @staticmethod
+    def fold_id(td):
+        return td["UID"]
+
+    @staticmethod
+    def values(data):
+        # The current values of each folded TracedData object, in fold id order
+        return sorted([{key: td[key] for key in td} for td in data], key=lambda values: values["UID"])
+
+    def expected(self, messages):
+        return FoldTracedData.fold_iterable_of_traced_data(
+            self.USER, messages, self.fold_id, self.EQUAL_KEYS, self.CONCAT_KEYS, self.MATRIX_KEYS, self.BOOL_KEYS)
+
+    def folder(self):
+        return TracedDataFolder(self.USER, self.fold_id, equal_keys=self.EQUAL_KEYS, concat_keys=self.CONCAT_KEYS,
+                                matrix_keys=self.MATRIX_KEYS, bool_keys=self.BOOL_KEYS)
+
+    def test_fold(self):
+        messages = self.make_messages()
+        folded = self.folder().fold(messages)
+
+        self.assertEqual(self.values(folded), self.values(self.expected(self.make_messages())))
+        self.assertEqual([self.fold_id(td) for td in folded], ["uid-{}".format(i) for i in range(7)])
+
+        # Groups of one message are returned unchanged, and the messages of larger groups are not modified
+        self.assertIs(folded[5], messages[24])
+        self.assertIs(folded[6], messages[25])
+        self.assertEqual(self.values(messages), self.values(self.make_messages()))
+
+    def test_fold_sorted(self):
+        sorted_messages = sorted(self.make_messages(), key=self.fold_id)
+        folded = list(self.folder().fold_sorted(sorted_messages))
+
+        self.assertEqual(self.values(folded), self.values(self.expected(self.make_messages())))
+
+    def test_fold_sorted_rejects_unsorted_input(self):
+        with self.assertRaises(ValueError):
+            list(self.folder().fold_sorted(self.make_messages()))
+
+    def test_fold_rejects_different_equal_keys(self):
+        messages = self.make_messages()
+        messages[5].append_data({"gender": "different"}, Metadata(self.USER, "messages", 1))
+
+        with self.assertRaises(AssertionError):
+            self.folder().fold(messages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,39 +1,42 @@
 import argparse
-import time
 from os import path
 
 from core_data_modules.cleaners import CharacterCleaner, Codes
 from core_data_modules.cleaners.codes import SomaliaCodes
-from core_data_modules.cleaners.location_tools import SomaliaLocations
 from core_data_modules.traced_data import Metadata
-from core_data_modules.traced_data.io import TracedDataJsonIO, TracedDataCodaIO, TracedDataTheInterfaceIO
+from core_data_modules.traced_data.io import TracedDataTheInterfaceIO
 from core_data_modules.util import IOUtils
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Merges manually cleaned files back into a traced data file.")
-    parser.add_argument("user", help="User launching this program, for use by TracedData Metadata")
-    parser.add_argument("json_input_path", metavar="json-input-path",
-                        help="Path to JSON input file, which contains a list of TracedData objects")
-    parser.add_argument("coded_input_path", metavar="coded-input-path",
-                        help="Directory to read manually-coded Coda files from")
-    parser.add_argument("json_output_path", metavar="json-output-path",
-                        help="Path to a JSON file to write merged results to")
-    parser.add_argument("interface_output_dir", metavar="interface-output-dir",
-                        help="Path to a directory to write The Interface files to")
-
-    args = parser.parse_args()
-    user = args.user
-    json_input_path = args.json_input_path
-    coded_input_path = args.coded_input_path
-    json_output_path = args.json_output_path
-    interface_output_dir = args.interface_output_dir
-
-    class MergePlan:
-        def __init__(self, raw_field, coded_field, coda_name):
-            self.raw_field = raw_field
-            self.coded_field = coded_field
-            self.coda_name = coda_name
-
+from lib.location_enrichment import LocationEnrichment
+from pipeline_lib.coda_index import CodaIndex, CodaMerge
+from pipeline_lib.code_keys import CodeKeyCatalogue
+from pipeline_lib.derivation_plan import DerivationPlan
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+
+
+class MergePlan:
+    def __init__(self, raw_field, coded_field, coda_name):
+        self.raw_field = raw_field
+        self.coded_field = coded_field
+        self.coda_name = coda_name
+
+
+def apply_manual_codes(user, data, coded_input_path, interface_output_dir):
+    """
+    Merges manually coded Coda files into a list of messages, and exports the messages to The Interface.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param data: Messages to merge the codes into. These are updated in place.
+    :type data: list of TracedData
+    :param coded_input_path: Directory to read manually-coded Coda files from.
+    :type coded_input_path: str
+    :param interface_output_dir: Directory to write The Interface files to.
+    :type interface_output_dir: str
+    :return: data, and the catalogue of the matrix code keys which were set.
+    :rtype: (list of TracedData, CodeKeyCatalogue)
+    """
     merge_plan = [
         MergePlan("gender_review", "gender_coded", "Gender"),
         MergePlan("district_review", "district_coded", "District"),
@@ -46,75 +49,93 @@ if __name__ == "__main__":
         MergePlan("repeated_esc4jmcna", "repeated_esc4jmcna_coded", "Repeated")
     ]
 
-    # Load data from JSON file
-    with open(json_input_path, "r") as f:
-        data = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+    # Derive all of the manually coded fields in one pass over the data, with one append_data per message.
+    # Rules run in the order they are added, and each sees the values set by the rules before it.
+    codes_plan = DerivationPlan()
+
+    # Merge manually coded survey/evaluation and activation Coda files into the cleaned dataset.
+    # Each Coda file is indexed once (in parallel), then the codes are looked up by raw text for each message.
+    key_of_raw = "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation"
+    key_of_coded_prefix = "{}_coded_".format(key_of_raw)
+    key_of_coded_relevance = "{}_relevance_coded".format(key_of_raw)
 
-    # Merge manually coded survey/evaluation Coda files into the cleaned dataset
+    coda_merges = []
+    missing_coded_fields = []
     for plan in merge_plan:
         coda_file_path = path.join(coded_input_path, "{}_coded.csv".format(plan.coda_name))
 
         if not path.exists(coda_file_path):
             print("Warning: No Coda file found for key '{}'".format(plan.coda_name))
-            for td in data:
-                td.append_data(
-                    {plan.coded_field: None},
-                    Metadata(user, Metadata.get_call_location(), time.time())
-                )
+            missing_coded_fields.append(plan.coded_field)
             continue
 
-        with open(coda_file_path, "r") as f:
-            TracedDataCodaIO.import_coda_to_traced_data_iterable(
-                user, data, plan.raw_field, {plan.coda_name: plan.coded_field}, f, True)
+        coda_merges.append(CodaMerge.scheme(coda_file_path, plan.raw_field, {plan.coda_name: plan.coded_field}, True))
+
+    coda_file_path = path.join(coded_input_path, "esc4jmcna_activation_coded.csv")
+    if path.exists(coda_file_path):
+        coda_merges.append(CodaMerge.matrix(
+            coda_file_path, key_of_raw, {"Code 1", "Code 2", "Code 3", "Code 4", "Code 5"}, key_of_coded_prefix))
+        coda_merges.append(CodaMerge.scheme(coda_file_path, key_of_raw, {"Relevance": key_of_coded_relevance}))
+
+    coda_index = CodaIndex(coda_merges)
+    with Instrumentation.span("index_coda_files") as span:
+        coda_index.build(user, data)
+        span.count("coda_files", len(coda_merges))
+
+    @codes_plan.add_rule
+    def set_missing_coda_codes(td):
+        return {coded_field: None for coded_field in missing_coded_fields}
+
+    @codes_plan.add_rule
+    def set_coda_codes(td):
+        codes = dict()
+        for merge_codes in coda_index.codes_for(td):
+            codes.update(merge_codes)
+        return codes
 
     # Set districts coded as 'other' to 'NOT_CODED'
-    for td in data:
+    @codes_plan.add_rule
+    def set_other_districts_not_coded(td):
         if td["district_coded"] == "other":
-            td.append_data({"district_coded": Codes.NOT_CODED}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {"district_coded": Codes.NOT_CODED}
 
     # Set district/region/state/zone codes from the coded district field.
-    for td in data:
-        if td["district_review"] in {Codes.TRUE_MISSING, Codes.STOP}:
-            td.append_data({
-                "district_coded": td["district_review"],
-                "region_coded": td["district_review"],
-                "state_coded": td["district_review"],
-                "zone_coded": td["district_review"],
-                "district_coda": td["district_review"]
-            }, Metadata(user, Metadata.get_call_location(), time.time()))
+    # Each distinct location code and operator is looked up once, in a table shared by all of the messages.
+    location_enrichment = LocationEnrichment()
+
+    @codes_plan.add_rule
+    def set_location_codes(td):
+        district_review = td["district_review"]
+        if district_review in {Codes.TRUE_MISSING, Codes.STOP}:
+            return {
+                "district_coded": district_review,
+                "region_coded": district_review,
+                "state_coded": district_review,
+                "zone_coded": district_review,
+                "district_coda": district_review
+            }
         else:
-            td.append_data({
-                "district_coded": SomaliaLocations.district_for_location_code(td["district_coded"]),
-                "region_coded": SomaliaLocations.region_for_location_code(td["district_coded"]),
-                "state_coded": SomaliaLocations.state_for_location_code(td["district_coded"]),
-                "zone_coded": SomaliaLocations.zone_for_location_code(td["district_coded"]),
-                "district_coda": Codes.TRUE_MISSING if td["district_review"] == Codes.TRUE_MISSING else td[
-                    "district_coded"]
-            }, Metadata(user, Metadata.get_call_location(), time.time()))
-
-        # If we failed to find a zone after searching location codes, try inferring from the operator code instead
+            district_coded = td["district_coded"]
+            district, region, state, zone = location_enrichment.location_for_code(district_coded)
+            return {
+                "district_coded": district,
+                "region_coded": region,
+                "state_coded": state,
+                "zone_coded": zone,
+                "district_coda": Codes.TRUE_MISSING if district_review == Codes.TRUE_MISSING else district_coded
+            }
+
+    # If we failed to find a zone after searching location codes, try inferring from the operator code instead
+    @codes_plan.add_rule
+    def set_zone_from_operator(td):
         if td["zone_coded"] not in SomaliaCodes.ZONES:
-            td.append_data({
-                "zone_coded": SomaliaLocations.zone_for_operator_code(td["operator"])
-            }, Metadata(user, Metadata.get_call_location(), time.time()))
-
-    # Merge manually coded activation Coda files into the cleaned dataset
-    coda_file_path = path.join(coded_input_path, "esc4jmcna_activation_coded.csv")
-    key_of_raw = "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation"
-    key_of_coded_prefix = "{}_coded_".format(key_of_raw)
-    key_of_coded_relevance = "{}_relevance_coded".format(key_of_raw)
-    if path.exists(coda_file_path):
-        with open(coda_file_path, "r") as f:
-            TracedDataCodaIO.import_coda_to_traced_data_iterable_as_matrix(
-                user, data, key_of_raw, {"Code 1", "Code 2", "Code 3", "Code 4", "Code 5"}, f, key_of_coded_prefix)
-
-        with open(coda_file_path, "r") as f:
-            TracedDataCodaIO.import_coda_to_traced_data_iterable(
-                user, data, key_of_raw, {"Relevance": key_of_coded_relevance}, f)
+            return {"zone_coded": location_enrichment.zone_for_operator(td["operator"])}
 
     # Fix Not Reviewed to account for data which had relevant set only, to work around a Coda bug
     key_of_coded_nr = "{}{}".format(key_of_coded_prefix, Codes.NOT_REVIEWED)
-    for td in data:
+
+    @codes_plan.add_rule
+    def fix_not_reviewed(td):
         if td.get(key_of_coded_relevance) is not None and td.get(key_of_coded_relevance) != Codes.NOT_REVIEWED \
                 and td.get(key_of_coded_relevance) != Codes.TRUE_MISSING:
             # Note: The third check (on Codes.TRUE_MISSING) here is incorrect behaviour - codes which are TRUE_MISSING
@@ -122,33 +143,97 @@ if __name__ == "__main__":
             # This check is needed to in order to continue producing analysis datasets identical to those used
             # in the report for REACH.
             # This error impacts 1 line in the messages analysis dataset (of about 26,000).
-            td.append_data({key_of_coded_nr: "0"}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {key_of_coded_nr: "0"}
 
     # Assume everything that wasn't reviewed should have been assigned NOT_CODED, to work around a Coda bug
     key_of_coded_nc = "{}{}".format(key_of_coded_prefix, Codes.NOT_CODED)
-    for td in data:
+
+    @codes_plan.add_rule
+    def fix_not_coded(td):
         if td.get(key_of_coded_nr) == "1":
-            td.append_data({key_of_coded_nc: "1"}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {key_of_coded_nc: "1"}
 
     # Set messages that weren't relevant as NOT_CODED
-    for td in data:
+    @codes_plan.add_rule
+    def set_not_relevant_not_coded(td):
         if td.get(key_of_coded_relevance) == Codes.NO or td.get("noise") is not None:
-            td.append_data({key_of_coded_nc: "1"}, Metadata(user, Metadata.get_call_location(), time.time()))
+            return {key_of_coded_nc: "1"}
+
+    # Catalogue the activation matrix keys as they are written, so that the analysis file stage can find them without
+    # searching the keys of every message.
+    key_of_coded_matrix = "{}_coded".format(key_of_raw)
+    code_key_catalogue = CodeKeyCatalogue()
 
-    # Write coded data back out to disk
-    IOUtils.ensure_dirs_exist_for_file(json_output_path)
-    with open(json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=True)
+    @codes_plan.add_rule
+    def catalogue_code_keys(td):
+        code_key_catalogue.add_keys(key_of_coded_matrix, td.updates)
 
-    # Output to The Interface
-    for td in data:
-        td.append_data({
+    with Instrumentation.span("apply_codes") as span:
+        codes_plan.apply(user, data, Metadata.get_call_location())
+        span.count("records_in", len(data))
+        span.count("unresolved_location_codes", sum(location_enrichment.unresolved_location_codes.values()))
+        span.count("unresolved_operators", sum(location_enrichment.unresolved_operators.values()))
+
+    location_enrichment.print_stats()
+
+    # Output to The Interface.
+    # The Interface keys are set on copies of the messages, so that they are not included in the coded data.
+    interface_data = [td.copy() for td in data]
+    interface_plan = DerivationPlan()
+
+    @interface_plan.add_rule
+    def set_interface_keys(td):
+        return {
             "district_review_interface": CharacterCleaner.clean_text(td["district_review"]),
             "gender_review_interface": CharacterCleaner.clean_text(td["gender_review"])
-        }, Metadata(user, Metadata.get_call_location(), time.time()))
+        }
+
+    with Instrumentation.span("export_interface") as span:
+        interface_plan.apply(user, interface_data, Metadata.get_call_location())
+
+        IOUtils.ensure_dirs_exist(interface_output_dir)
+        TracedDataTheInterfaceIO.export_traced_data_iterable_to_the_interface(
+            interface_data, interface_output_dir, "avf_phone_id",
+            "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation",
+            "S07E01_Humanitarian_Priorities (Time EAT) - esc4jmcna_activation",
+            county_key="district_review_interface", gender_key="gender_review_interface")
+        span.count("records_in", len(interface_data))
+
+    return data, code_key_catalogue
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges manually cleaned files back into a traced data file.")
+    parser.add_argument("user", help="User launching this program, for use by TracedData Metadata")
+    parser.add_argument("json_input_path", metavar="json-input-path",
+                        help="Path to JSON input file, which contains a list of TracedData objects")
+    parser.add_argument("coded_input_path", metavar="coded-input-path",
+                        help="Directory to read manually-coded Coda files from")
+    parser.add_argument("json_output_path", metavar="json-output-path",
+                        help="Path to a JSON file to write merged results to")
+    parser.add_argument("interface_output_dir", metavar="interface-output-dir",
+                        help="Path to a directory to write The Interface files to")
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    user = args.user
+    json_input_path = args.json_input_path
+    coded_input_path = args.coded_input_path
+    json_output_path = args.json_output_path
+    interface_output_dir = args.interface_output_dir
+    output_format = args.output_format
+
+    with Instrumentation.from_args("apply_manual_codes", args):
+        # Load data from JSON file
+        with Instrumentation.span("load") as span:
+            data = TracedDataInterchangeIO.load(json_input_path)
+            span.count("records_out", len(data))
+
+        data, code_key_catalogue = apply_manual_codes(user, data, coded_input_path, interface_output_dir)
 
-    IOUtils.ensure_dirs_exist(interface_output_dir)
-    TracedDataTheInterfaceIO.export_traced_data_iterable_to_the_interface(
-        data, interface_output_dir, "avf_phone_id", "S07E01_Humanitarian_Priorities (Text) - esc4jmcna_activation",
-        "S07E01_Humanitarian_Priorities (Time EAT) - esc4jmcna_activation",
-        county_key="district_review_interface", gender_key="gender_review_interface")
+        # Write coded data back out to disk
+        with Instrumentation.span("dump") as span:
+            TracedDataInterchangeIO.dump(data, json_output_path, output_format, pretty_print=True)
+            code_key_catalogue.save(CodeKeyCatalogue.path_for(json_output_path))
+            span.count("records_in", len(data))
@@ -18,7 +18,8 @@ OUTPUT_JSON=$4
 OUTPUT_INTERFACE_DIR=$5
 
 # Build an image for this pipeline stage.
-docker build -t "$IMAGE_NAME" .
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
 
 # Create a container from the image that was just built.
 container="$(docker container create --env USER="$USER" "$IMAGE_NAME")"
@@ -39,6 +40,7 @@ docker start -a -i "$container"
 # Copy the output data back out of the container
 mkdir -p "$(dirname "$OUTPUT_JSON")"
 docker cp "$container:/data/output.json" "$OUTPUT_JSON"
+docker cp "$container:/data/output.json.code_keys.json" "$OUTPUT_JSON.code_keys.json"
 
 mkdir -p "$OUTPUT_INTERFACE_DIR"
 docker cp "$container:/data/output-interface/." "$OUTPUT_INTERFACE_DIR"
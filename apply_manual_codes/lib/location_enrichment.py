@@ -0,0 +1,68 @@
+from collections import Counter
+
+from core_data_modules.cleaners.codes import SomaliaCodes
+from core_data_modules.cleaners.location_tools import SomaliaLocations
+
+
+class LocationEnrichment(object):
+    """
+    Lookup tables of location code -> (district, region, state, zone) and of operator -> zone, built up as a dataset
+    is enriched.
+
+    Every message's coded district, and the operator of every message without a zone, used to be passed through
+    SomaliaLocations once per derived field. There are only a few hundred distinct location codes and a handful of
+    operators, so each is looked up once and each message's location fields are then read from a single table.
+    The codes which could not be resolved to a zone are counted, so that gaps in the location schemes show up in the
+    output of each run.
+    """
+
+    def __init__(self):
+        self.locations = dict()  # of location code -> (district, region, state, zone)
+        self.operator_zones = dict()  # of operator -> zone
+
+        # Number of messages with each location code or operator which did not resolve to a zone
+        self.unresolved_location_codes = Counter()
+        self.unresolved_operators = Counter()
+
+    def location_for_code(self, location_code):
+        """
+        :param location_code: Coded location, e.g. a district code from Coda.
+        :type location_code: str
+        :return: The district, region, state and zone of location_code, as returned by SomaliaLocations.
+        :rtype: (str, str, str, str)
+        """
+        location = self.locations.get(location_code)
+        if location is None:
+            location = (
+                SomaliaLocations.district_for_location_code(location_code),
+                SomaliaLocations.region_for_location_code(location_code),
+                SomaliaLocations.state_for_location_code(location_code),
+                SomaliaLocations.zone_for_location_code(location_code)
+            )
+            self.locations[location_code] = location
+
+        if location[3] not in SomaliaCodes.ZONES:
+            self.unresolved_location_codes[location_code] += 1
+        return location
+
+    def zone_for_operator(self, operator):
+        """
+        :param operator: Operator code, as set by the survey auto-code stage.
+        :type operator: str
+        :return: The zone of operator, as returned by SomaliaLocations.zone_for_operator_code.
+        :rtype: str
+        """
+        if operator not in self.operator_zones:
+            self.operator_zones[operator] = SomaliaLocations.zone_for_operator_code(operator)
+
+        zone = self.operator_zones[operator]
+        if zone not in SomaliaCodes.ZONES:
+            self.unresolved_operators[operator] += 1
+        return zone
+
+    def print_stats(self):
+        print("Location enrichment: {} distinct location codes, of which {} had no zone ({} messages); "
+              "{} distinct operators, of which {} had no zone ({} messages)".format(
+                len(self.locations), len(self.unresolved_location_codes),
+                sum(self.unresolved_location_codes.values()),
+                len(self.operator_zones), len(self.unresolved_operators), sum(self.unresolved_operators.values())))
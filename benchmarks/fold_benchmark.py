@@ -0,0 +1,124 @@
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.util import FoldTracedData
+
+from analysis_file.lib.fold import TracedDataFolder
+
+EQUAL_KEYS = ["UID", "operator", "district", "gender", "age"]
+CONCAT_KEYS = ["humanitarian_priorities_raw"]
+MATRIX_KEYS = ["humanitarian_priorities_{}".format(code) for code in
+               ["education", "food", "health", "shelter", "water", "security", "jobs", "NC", "NR"]]
+BOOL_KEYS = ["withdrawn_consent", "bulk_sms", "sms_ad", "radio_promo", "radio_show", "non_logical_time"]
+
+USER = "benchmark"
+
+
+def generate_messages(messages, respondents, seed=0):
+    """
+    Generates synthetic messages shaped like the input to the analysis_file fold, sorted by UID.
+
+    :param messages: Number of messages to generate.
+    :type messages: int
+    :param respondents: Number of distinct UIDs to spread the messages over.
+    :type respondents: int
+    :param seed: Seed for the random number generator.
+    :type seed: int
+    :rtype: generator of TracedData
+    """
+    rng = random.Random(seed)
+    metadata = Metadata(USER, "fold_benchmark", time.time())
+
+    for respondent in range(respondents):
+        # Spread the messages as evenly as possible over the respondents
+        respondent_messages = messages // respondents + (1 if respondent < messages % respondents else 0)
+
+        uid = "avf-phone-uuid-{:010d}".format(respondent)
+        respondent_values = {
+            "UID": uid,
+            "operator": rng.choice(["hormud", "golis", "somtel", "telesom"]),
+            "district": rng.choice(["mogadishu", "baidoa", "kismayo", "hargeisa"]),
+            "gender": rng.choice(["male", "female"]),
+            "age": str(rng.randint(14, 80))
+        }
+
+        for _ in range(respondent_messages):
+            data = dict(respondent_values)
+            data["humanitarian_priorities_raw"] = "message {}".format(rng.randint(0, 1000000))
+            for key in MATRIX_KEYS:
+                data[key] = "1" if rng.random() < 0.2 else "0"
+            for key in BOOL_KEYS:
+                data[key] = Codes.TRUE if rng.random() < 0.1 else Codes.FALSE
+            yield TracedData(data, metadata)
+
+
+def run_mode(mode, messages, respondents):
+    start = time.perf_counter()
+
+    if mode == "sorted-stream":
+        # Neither the messages nor the folded output are held in memory.
+        folder = TracedDataFolder(USER, lambda td: td["UID"], EQUAL_KEYS, CONCAT_KEYS, MATRIX_KEYS, BOOL_KEYS)
+        folded = 0
+        for _ in folder.fold_sorted(generate_messages(messages, respondents)):
+            folded += 1
+    else:
+        data = list(generate_messages(messages, respondents))
+        random.Random(1).shuffle(data)
+        # Report only the time taken to fold.
+        start = time.perf_counter()
+
+        if mode == "hash":
+            folder = TracedDataFolder(USER, lambda td: td["UID"], EQUAL_KEYS, CONCAT_KEYS, MATRIX_KEYS, BOOL_KEYS)
+            folded = len(folder.fold(data))
+        else:
+            assert mode == "core-data", "Unknown mode '{}'".format(mode)
+            folded = len(FoldTracedData.fold_iterable_of_traced_data(
+                USER, data, fold_id_fn=lambda td: td["UID"], equal_keys=EQUAL_KEYS, concat_keys=CONCAT_KEYS,
+                matrix_keys=MATRIX_KEYS, bool_keys=BOOL_KEYS
+            ))
+
+    return {
+        "mode": mode,
+        "seconds": time.perf_counter() - start,
+        "folded": folded,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the time and peak memory used to fold synthetic messages "
+                                                 "to one row per respondent. Each mode is run in a fresh process. "
+                                                 "Run from the repository root with "
+                                                 "`python -m benchmarks.fold_benchmark`")
+    parser.add_argument("--messages", type=int, default=1000000,
+                        help="Number of messages to fold")
+    parser.add_argument("--respondents", type=int, default=200000,
+                        help="Number of respondents to spread the messages over")
+    parser.add_argument("--modes", nargs="+", default=["hash", "sorted-stream"],
+                        choices=["hash", "sorted-stream", "core-data"],
+                        help="Fold implementations to measure. 'core-data' is "
+                             "FoldTracedData.fold_iterable_of_traced_data, which is slow at large sizes")
+    parser.add_argument("--results-path",
+                        help="Optional path to a JSON file to write the results to")
+
+    args = parser.parse_args()
+
+    results = {"messages": args.messages, "respondents": args.respondents, "modes": []}
+    for mode in args.modes:
+        with multiprocessing.Pool(1) as pool:
+            mode_results = pool.apply(run_mode, (mode, args.messages, args.respondents))
+        results["modes"].append(mode_results)
+        print("{}: {:.2f}s ({:.0f} messages/s), {} folded, peak RSS {:.0f} MB".format(
+            mode, mode_results["seconds"], args.messages / mode_results["seconds"], mode_results["folded"],
+            mode_results["peak_rss_mb"]))
+
+    if args.results_path is not None:
+        with open(args.results_path, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from pipeline_lib.binary_io import TracedDataBinaryIO
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the load time, save time and file size of the JSON and "
+                                                 "binary TracedData interchange formats, using an existing file of "
+                                                 "TracedData objects produced by a pipeline stage. "
+                                                 "Run from the repository root with "
+                                                 "`python -m benchmarks.interchange_benchmark`")
+    parser.add_argument("json_input_path", metavar="json-input-path",
+                        help="Path to a JSON file containing a list of serialized TracedData objects")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of times to repeat each measurement. The fastest time is reported")
+    parser.add_argument("--results-path",
+                        help="Optional path to a JSON file to write the results to")
+
+    args = parser.parse_args()
+    json_input_path = args.json_input_path
+    repeats = args.repeats
+    results_path = args.results_path
+
+    with open(json_input_path, "r") as f:
+        data = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+
+    def best_time(fn):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def save_json(path):
+        with open(path, "w") as f:
+            TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=True)
+
+    def load_json(path):
+        with open(path, "r") as f:
+            TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+
+    def save_binary(path):
+        with open(path, "wb") as f:
+            TracedDataBinaryIO.export_traced_data_iterable_to_binary(data, f)
+
+    def load_binary(path):
+        with open(path, "rb") as f:
+            list(TracedDataBinaryIO.import_binary_to_traced_data_iterable(f))
+
+    results = {"input": json_input_path, "records": len(data), "formats": dict()}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for format_name, save, load in [("json", save_json, load_json), ("binary", save_binary, load_binary)]:
+            path = os.path.join(tmp_dir, format_name)
+            results["formats"][format_name] = {
+                "save_seconds": best_time(lambda: save(path)),
+                "load_seconds": best_time(lambda: load(path)),
+                "size_bytes": os.path.getsize(path)
+            }
+
+    print("Records: {}".format(len(data)))
+    print("{:<8}{:>14}{:>14}{:>16}".format("Format", "Save (s)", "Load (s)", "Size (bytes)"))
+    for format_name, result in results["formats"].items():
+        print("{:<8}{:>14.3f}{:>14.3f}{:>16}".format(
+            format_name, result["save_seconds"], result["load_seconds"], result["size_bytes"]))
+
+    if results_path is not None:
+        with open(results_path, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+from core_data_modules.util import IOUtils
+
+from pipeline_lib.interchange import TracedDataInterchangeIO
+from pipeline_lib.operator_index import OperatorIndex
+
+from benchmarks.synthetic_data import SCALES, SHOW, VARIABLE, SyntheticDataset
+
+REPO_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+USER = "benchmark"
+
+
+def stage_commands(data_root):
+    """
+    Returns the command line of each stage's entry point, with the same arguments as the run_scripts use.
+
+    :param data_root: Data root to run the stages on.
+    :type data_root: str
+    :return: List of (stage name, input file path whose records are counted, command line arguments).
+    :rtype: list of (str, str, list of str)
+    """
+    def data_path(*parts):
+        return path.join(data_root, *parts)
+
+    raw_messages = data_path("01 Raw Messages", "{}.json".format(SHOW))
+    clean_messages = data_path("02 Clean Messages", "{}.json".format(SHOW))
+    messages_and_surveys = data_path("05 Messages & Raw Surveys", "{}.json".format(SHOW))
+    auto_coded = data_path("06 Auto-Coded", "{}.json".format(SHOW))
+    manually_coded = data_path("09 Manually Coded", "{}.json".format(SHOW))
+
+    return [
+        ("messages", raw_messages, [
+            "messages.py", USER, raw_messages, data_path("08 Coded Coda Files", "{}_coded.csv".format(SHOW)), SHOW,
+            VARIABLE, clean_messages, data_path("07 Coda Files", "{}.csv".format(SHOW)),
+            data_path("14 ICR CSVs", "{}_icr.csv".format(SHOW))
+        ]),
+        ("update_messages_with_surveys", clean_messages, [
+            "update_messages_with_surveys.py", USER, clean_messages, data_path("04 Raw Contacts", "contacts.json"),
+            messages_and_surveys
+        ]),
+        ("survey_auto_code", messages_and_surveys, [
+            "survey_auto_code.py", USER, messages_and_surveys, data_path("08 Coded Coda Files"),
+            data_path("00 UUIDs", "operator_index.idx"), auto_coded, data_path("07 Coda Files")
+        ]),
+        ("apply_manual_codes", auto_coded, [
+            "apply_manual_codes.py", USER, auto_coded, data_path("08 Coded Coda Files"), manually_coded,
+            data_path("03 Interface Files")
+        ]),
+        ("analysis_file", manually_coded, [
+            "analysis_file.py", USER, data_path("09 Manually Coded"), manually_coded,
+            data_path("12 Analysis", "analysis.json"),
+            data_path("13 Analysis CSV", "{}_analysis_messages.csv".format(SHOW)),
+            data_path("13 Analysis CSV", "{}_analysis_individuals.csv".format(SHOW))
+        ])
+    ]
+
+
+def run_stage(stage_name, args):
+    """
+    Runs a stage's entry point in a child process, from the stage's directory.
+
+    :param stage_name: Name of the stage's directory.
+    :type stage_name: str
+    :param args: Arguments to the stage's Python interpreter, starting with the script.
+    :type args: list of str
+    :return: Wall time in seconds and peak RSS in MB of the child process.
+    :rtype: (float, float)
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_ROOT] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen([sys.executable] + args, cwd=path.join(REPO_ROOT, stage_name), env=env,
+                                   stdout=devnull)
+        # wait4 reports the resource usage of just this child, rather than the maximum over all children
+        _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+
+    # Tell the Popen object the process has been reaped
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if process.returncode != 0:
+        raise RuntimeError("Stage '{}' failed with exit code {}".format(stage_name, process.returncode))
+
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, rusage.ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a synthetic dataset and runs each pipeline stage's entry "
+                                                 "point on it in turn, recording the wall time, peak memory and "
+                                                 "records per second of each stage. "
+                                                 "Run from the repository root with "
+                                                 "`python -m benchmarks.stage_benchmark`")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k",
+                        help="Number of Rapid Pro runs to generate")
+    parser.add_argument("--messages", type=int,
+                        help="Number of Rapid Pro runs to generate, overriding --scale")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic data generator")
+    parser.add_argument("--data-root",
+                        help="Directory to generate the dataset in and run the stages on. Defaults to a temporary "
+                             "directory, which is deleted afterwards")
+    parser.add_argument("--stages", nargs="+",
+                        help="Stages to time. All of the stages are run, as each needs the outputs of the stages "
+                             "before it, but only these are reported. Defaults to all of the stages")
+    parser.add_argument("--results-path",
+                        help="Optional path to a JSON file to write the results to")
+
+    args = parser.parse_args()
+    messages = args.messages if args.messages is not None else SCALES[args.scale]
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "messages": messages,
+        "seed": args.seed,
+        "stages": []
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root = args.data_root if args.data_root is not None else tmp_dir
+
+        print("Generating {} messages in '{}'".format(messages, data_root))
+        start = time.perf_counter()
+        SyntheticDataset(messages, args.seed).write(data_root)
+        results["generate_seconds"] = time.perf_counter() - start
+
+        # Not all of the stages create the directories they write to
+        for output_dir in ["12 Analysis", "13 Analysis CSV"]:
+            IOUtils.ensure_dirs_exist(path.join(data_root, output_dir))
+
+        # Build the operator index the survey auto-code stage reads, as the run_scripts do before running that stage
+        OperatorIndex.update(path.join(data_root, "00 UUIDs", "operator_index.idx"),
+                             path.join(data_root, "00 UUIDs", "phone_uuids.json"))
+
+        for stage_name, input_path, stage_args in stage_commands(data_root):
+            records = sum(1 for _ in TracedDataInterchangeIO.iterate(input_path))
+            seconds, peak_rss_mb = run_stage(stage_name, stage_args)
+            if args.stages is not None and stage_name not in args.stages:
+                continue
+
+            results["stages"].append({
+                "stage": stage_name,
+                "records": records,
+                "seconds": seconds,
+                "records_per_second": records / seconds,
+                "peak_rss_mb": peak_rss_mb
+            })
+            print("{}: {:.2f}s ({:.0f} records/s), peak RSS {:.0f} MB".format(
+                stage_name, seconds, records / seconds, peak_rss_mb))
+
+    if args.results_path is not None:
+        with open(args.results_path, "w") as f:
+            json.dump(results, f, indent=2)
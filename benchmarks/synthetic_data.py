@@ -0,0 +1,224 @@
+import argparse
+import random
+import uuid
+from datetime import timedelta, timezone
+from os import path
+
+from core_data_modules.cleaners import Codes, somali
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataCodaIO
+from core_data_modules.util import IOUtils, PhoneNumberUuidTable
+from dateutil.parser import isoparse
+
+from pipeline_lib.interchange import TracedDataInterchangeIO
+
+SHOW = "esc4jmcna_activation"
+VARIABLE = "S07E01_Humanitarian_Priorities"
+MESSAGE_KEY = "{} (Text) - {}".format(VARIABLE, SHOW)
+TIME_KEY = "{} (Time) - {}".format(VARIABLE, SHOW)
+RUN_ID_KEY = "{} (Run ID) - {}".format(VARIABLE, SHOW)
+CONSENT_KEY = "esc4jmcna_consent_s07e01_complete"
+
+SCALES = {"10k": 10000, "100k": 100000, "1M": 1000000}
+MESSAGES_PER_RESPONDENT = 2.5
+
+# Channel time windows, as in pipeline_lib.channels.Channels.RANGES, and the weight of messages sent in each.
+# Messages are also sent outside of every window (which are labelled as non-logical times), and outside of the project
+# run period (which the messages stage drops).
+TIME_WINDOWS = [
+    (("2018-09-14T21:25:00+03:00", "2018-09-14T23:59:00+03:00"), 25),  # Bulk SMS
+    (("2018-09-09T19:00:00+03:00", "2018-09-10T07:00:00+03:00"), 10),  # SMS ad
+    (("2018-09-09T00:00:00+03:00", "2018-09-09T19:00:00+03:00"), 10),  # Radio promo
+    (("2018-09-10T07:00:00+03:00", "2018-09-11T23:59:00+03:00"), 15),  # Radio promo
+    (("2018-09-14T07:00:00+03:00", "2018-09-15T16:00:00+03:00"), 30),  # Radio show
+    (("2018-09-12T00:00:00+03:00", "2018-09-14T07:00:00+03:00"), 8),  # No channel
+    (("2018-09-17T00:00:00+03:00", "2018-09-19T00:00:00+03:00"), 2)  # After the project run period
+]
+
+PRIORITIES = {
+    "food": ["cunto", "raashin", "food", "cunto iyo raashin"],
+    "water": ["biyo", "biyo nadiif ah", "water", "ceelal biyo"],
+    "health": ["caafimaad", "isbitaal", "dawo", "health"],
+    "education": ["waxbarasho", "dugsiyo", "iskuul", "education"],
+    "shelter": ["hoy", "guryo", "shelter", "teendhooyin"],
+    "security": ["nabad", "amni", "nabadgelyo", "security"],
+    "jobs": ["shaqo", "shaqo abuur", "jobs", "ganacsi"]
+}
+NOISE_MESSAGES = ["ok", "hi", "salaan", "?", "asc", "mahadsanid", "haye", "1"]
+STOP_MESSAGES = ["stop", "STOP", "jooji"]
+
+GENDER_ANSWERS = ["lab", "dhedig", "rag", "naag", "male", "female", "Lab", "Dheddig", "wiil", "gabar"]
+DISTRICT_ANSWERS = ["muqdisho", "mogadishu", "baydhabo", "kismaayo", "hargeysa", "boosaaso", "garoowe", "beledweyne",
+                    "gaalkacyo", "burco", "berbera", "marka", "jowhar", "dhuusamareeb", "ceerigaabo", "laascaanood",
+                    "xamar", "muqdishu", "baidoa", "kismayo"]
+URBAN_RURAL_ANSWERS = ["magaalo", "miyi", "tuulo", "urban", "rural", "magaalada", "reer miyi"]
+AGE_ANSWERS = ["18", "19", "21", "24", "25", "27", "30", "32", "35", "40", "45", "50", "sanad 22", "28 sano",
+               "lix iyo toban", "labaatan", "soddon"]
+YES_NO_ANSWERS = ["haa", "maya", "yes", "no", "Haa", "Maya", "haa waan", "maya ma"]
+
+# (Raw key, Coda file name, example answers, cleaner) of each survey question
+SURVEY_QUESTIONS = [
+    ("gender_review", "Gender", GENDER_ANSWERS, somali.DemographicCleaner.clean_gender),
+    ("district_review", "District", DISTRICT_ANSWERS, somali.DemographicCleaner.clean_somalia_district),
+    ("urban_rural_review", "Urban_Rural", URBAN_RURAL_ANSWERS, somali.DemographicCleaner.clean_urban_rural),
+    ("age_review", "Age", AGE_ANSWERS, somali.DemographicCleaner.clean_age),
+    ("assessment_review", "Assessment", YES_NO_ANSWERS, somali.DemographicCleaner.clean_yes_no),
+    ("idp_review", "IDP", YES_NO_ANSWERS, somali.DemographicCleaner.clean_yes_no),
+    ("involved_esc4jmcna", "Involved", YES_NO_ANSWERS, somali.DemographicCleaner.clean_yes_no),
+    ("repeated_esc4jmcna", "Repeated", YES_NO_ANSWERS, somali.DemographicCleaner.clean_yes_no)
+]
+
+# Prefixes of the mobile numbers of the Somali operators
+OPERATOR_PREFIXES = ["25261", "25268", "25262", "25265", "25290", "25263"]
+
+
+class SyntheticDataset(object):
+    """
+    Generates a deterministic synthetic dataset for the pipeline, in the layout of the data root used by the
+    run_scripts: Rapid Pro runs for the activation flow, contacts with survey answers, the phone number UUID table, and
+    manually coded Coda files for every Coda file which the pipeline imports.
+
+    The same seed and number of messages always produce the same files.
+    """
+
+    def __init__(self, messages, seed=0):
+        """
+        :param messages: Number of runs to generate.
+        :type messages: int
+        :param seed: Seed for the random number generator.
+        :type seed: int
+        """
+        self.messages = messages
+        self.respondents = max(1, int(messages / MESSAGES_PER_RESPONDENT))
+        self.seed = seed
+        self.metadata = Metadata("synthetic", "synthetic_data", 0)
+
+    def _uuid(self, rng):
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    def generate_phone_uuids(self, rng):
+        phone_to_uuid = dict()
+        for respondent in range(self.respondents):
+            phone = "{}{:07d}".format(rng.choice(OPERATOR_PREFIXES), respondent)
+            phone_to_uuid[phone] = "avf-phone-uuid-{}".format(self._uuid(rng))
+        return PhoneNumberUuidTable(phone_to_uuid), sorted(phone_to_uuid.values())
+
+    def generate_message_text(self, rng):
+        roll = rng.random()
+        if roll < 0.15:
+            return rng.choice(NOISE_MESSAGES)
+        if roll < 0.17:
+            return rng.choice(STOP_MESSAGES)
+
+        themes = rng.sample(sorted(PRIORITIES), rng.choice([1, 1, 1, 2, 2, 3]))
+        return " iyo ".join(rng.choice(PRIORITIES[theme]) for theme in themes)
+
+    def generate_time(self, rng, windows):
+        start, end = rng.choices([window for window, _ in windows], weights=[weight for _, weight in windows])[0]
+        seconds = rng.uniform(0, (end - start).total_seconds())
+        return (start + timedelta(seconds=seconds)).astimezone(timezone.utc).isoformat()
+
+    def generate_runs(self, rng, uuids):
+        windows = [((isoparse(start), isoparse(end)), weight) for (start, end), weight in TIME_WINDOWS]
+        runs = []
+        for run in range(self.messages):
+            runs.append(TracedData({
+                "avf_phone_id": rng.choice(uuids),
+                RUN_ID_KEY: str(100000000 + run),
+                TIME_KEY: self.generate_time(rng, windows),
+                MESSAGE_KEY: self.generate_message_text(rng)
+            }, self.metadata))
+        return runs
+
+    def generate_contacts(self, rng, uuids):
+        contacts = []
+        for phone_uuid in uuids:
+            contact = {"avf_phone_id": phone_uuid}
+            for raw_key, _, answers, _ in SURVEY_QUESTIONS:
+                # Not every respondent answers every question
+                if rng.random() < 0.8:
+                    contact[raw_key] = rng.choice(answers)
+            if rng.random() < 0.02:
+                contact[CONSENT_KEY] = "yes"
+            contacts.append(TracedData(contact, self.metadata))
+        return contacts
+
+    def export_coded_surveys(self, contacts, coded_dir):
+        for raw_key, coda_name, _, cleaner in SURVEY_QUESTIONS:
+            coded_key = "{}_coded".format(raw_key)
+            coded = []
+            for text in sorted({contact[raw_key] for contact in contacts if raw_key in contact}):
+                code = cleaner(text)
+                coded.append(TracedData({raw_key: text, coded_key: code if code is not None else Codes.NOT_CODED},
+                                        self.metadata))
+            with open(path.join(coded_dir, "{}_coded.csv".format(coda_name)), "w") as f:
+                TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
+                    coded, raw_key, {coda_name: coded_key}, f)
+
+    def export_coded_messages(self, runs, coded_dir):
+        code_keys = ["Code 1", "Code 2", "Code 3"]
+        coded = []
+        for text in sorted({td[MESSAGE_KEY] for td in runs}):
+            themes = [theme for theme in sorted(PRIORITIES) if any(word in text for word in PRIORITIES[theme])]
+            d = {key: None for key in ["Relevance"] + code_keys}
+            d[MESSAGE_KEY] = text
+            if text in STOP_MESSAGES:
+                d["Relevance"] = Codes.NO
+                d["Code 1"] = Codes.STOP
+            elif len(themes) == 0:
+                d["Relevance"] = Codes.NO
+            else:
+                d["Relevance"] = Codes.YES
+                for code_key, theme in zip(code_keys, themes):
+                    d[code_key] = theme
+            coded.append(TracedData(d, self.metadata))
+
+        with open(path.join(coded_dir, "{}_coded.csv".format(SHOW)), "w") as f:
+            TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
+                coded, MESSAGE_KEY, {key: key for key in ["Relevance"] + code_keys}, f)
+
+    def write(self, data_root):
+        """
+        Writes the dataset to a data root.
+
+        :param data_root: Directory to write to, in the layout used by the run_scripts.
+        :type data_root: str
+        """
+        rng = random.Random(self.seed)
+
+        phone_uuids, uuids = self.generate_phone_uuids(rng)
+        runs = self.generate_runs(rng, uuids)
+        contacts = self.generate_contacts(rng, uuids)
+
+        phone_uuids_path = path.join(data_root, "00 UUIDs", "phone_uuids.json")
+        IOUtils.ensure_dirs_exist_for_file(phone_uuids_path)
+        with open(phone_uuids_path, "w") as f:
+            phone_uuids.dump(f)
+
+        TracedDataInterchangeIO.dump(runs, path.join(data_root, "01 Raw Messages", "{}.json".format(SHOW)))
+        TracedDataInterchangeIO.dump(contacts, path.join(data_root, "04 Raw Contacts", "contacts.json"))
+
+        coded_dir = path.join(data_root, "08 Coded Coda Files")
+        IOUtils.ensure_dirs_exist(coded_dir)
+        self.export_coded_surveys(contacts, coded_dir)
+        self.export_coded_messages(runs, coded_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a deterministic synthetic dataset for the pipeline, in the "
+                                                 "layout of the data root used by the run_scripts. "
+                                                 "Run from the repository root with "
+                                                 "`python -m benchmarks.synthetic_data`")
+    parser.add_argument("data_root", metavar="data-root",
+                        help="Directory to write the dataset to")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k",
+                        help="Number of Rapid Pro runs to generate")
+    parser.add_argument("--messages", type=int,
+                        help="Number of Rapid Pro runs to generate, overriding --scale")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random number generator")
+
+    args = parser.parse_args()
+    messages = args.messages if args.messages is not None else SCALES[args.scale]
+
+    SyntheticDataset(messages, args.seed).write(args.data_root)
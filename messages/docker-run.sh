@@ -5,8 +5,10 @@ set -e
 IMAGE_NAME=esc4jmcna-messages
 
 # Check that the correct number of arguments were provided.
-if [ $# -ne 8 ]; then
-    echo "Usage: sh docker-run.sh <user> <json-input-path> <prev-coda-input-path> <flow-name> <variable-name> <json-output-path> <coda-output-path> <icr-output-path>"
+if [ $# -lt 9 ]; then
+    echo "Usage: sh docker-run.sh <user> <json-input-path> <prev-coda-input-path> <flow-name> <variable-name> <json-output-path> <coda-output-path> <icr-output-path> <noise-cache-path> [--incremental] [--workers <workers>]"
+    echo "Note: The noise cache is read from <noise-cache-path> if it exists, and is saved back to it"
+    echo "Note: With --incremental, the previous output is read from <json-output-path> if it exists"
     exit
 fi
 
@@ -19,12 +21,23 @@ VARIABLE_NAME=$5
 OUTPUT_JSON=$6
 OUTPUT_CODA=$7
 OUTPUT_ICR=$8
+NOISE_CACHE=$9
+shift 9
+MESSAGES_ARGS="$*"
+
+INCREMENTAL=false
+for arg in "$@"; do
+    if [ "$arg" = "--incremental" ]; then
+        INCREMENTAL=true
+    fi
+done
 
 # Build an image for this pipeline stage.
-docker build -t "$IMAGE_NAME" .
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
 
 # Create a container from the image that was just built.
-container="$(docker container create --env USER="$USER" --env FLOW_NAME="$FLOW_NAME" --env VARIABLE_NAME="$VARIABLE_NAME" "$IMAGE_NAME")"
+container="$(docker container create --env USER="$USER" --env FLOW_NAME="$FLOW_NAME" --env VARIABLE_NAME="$VARIABLE_NAME" --env MESSAGES_ARGS="$MESSAGES_ARGS" "$IMAGE_NAME")"
 
 function finish {
     # Tear down the container when done.
@@ -35,6 +48,12 @@ trap finish EXIT
 # Copy input data into the container
 docker cp "$INPUT_JSON" "$container:/data/input.json"
 docker cp "$INPUT_CODA" "$container:/data/input-coda.csv"
+if [ "$INCREMENTAL" = true ] && [ -f "$OUTPUT_JSON" ]; then
+    docker cp "$OUTPUT_JSON" "$container:/data/output.json"
+fi
+if [ -f "$NOISE_CACHE" ]; then
+    docker cp "$NOISE_CACHE" "$container:/data/noise-cache.json"
+fi
 
 # Run the container
 docker start -a -i "$container"
@@ -48,3 +67,6 @@ docker cp "$container:/data/output-coda.csv" "$OUTPUT_CODA"
 
 mkdir -p "$(dirname "$OUTPUT_ICR")"
 docker cp "$container:/data/output-icr.csv" "$OUTPUT_ICR"
+
+mkdir -p "$(dirname "$NOISE_CACHE")"
+docker cp "$container:/data/noise-cache.json" "$NOISE_CACHE"
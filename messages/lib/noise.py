@@ -0,0 +1,139 @@
+import json
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.cleaners import somali
+from core_data_modules.util import IOUtils
+
+
+def _classify_texts(texts, min_length):
+    return [somali.DemographicCleaner.is_noise(text, min_length=min_length) for text in texts]
+
+
+class NoiseClassifier(object):
+    """
+    Classifies message texts as noise with somali.DemographicCleaner.is_noise, classifying each distinct text once.
+
+    Texts of at least min_length are never noise, so they are not classified or cached. Responses to broadcasts contain
+    large numbers of identical short texts (e.g. short replies), so the verdict for each distinct short text is cached,
+    keeping the MAX_CACHED_TEXTS most recently seen texts. The cache can be persisted to a JSON file shared by every
+    show and every run, so that only texts which have not been seen recently are classified. Large batches of new texts
+    are classified across a pool of processes.
+    """
+    FILE_VERSION = 1
+    PARALLEL_MIN_TEXTS = 5000  # Minimum number of new distinct texts in a batch for it to be classified in parallel
+    MAX_CACHED_TEXTS = 200000  # Maximum number of verdicts to keep in the cache
+
+    def __init__(self, min_length=20, workers=1):
+        """
+        :param min_length: Texts of at least this length are never noise. See DemographicCleaner.is_noise.
+        :type min_length: int
+        :param workers: Number of processes to classify large batches of new texts with.
+        :type workers: int
+        """
+        self.min_length = min_length
+        self.workers = workers
+        self.verdicts = OrderedDict()  # of short text -> whether the text is noise, least recently seen first
+
+        self.messages = 0
+        self.long = 0
+        self.classified = 0
+        self.noise = 0
+
+        # Verdicts of the classifiers with other values of min_length which were in the loaded file, so that they can
+        # be written back.
+        self._other_verdicts = dict()
+
+    def classify_iterable(self, texts):
+        """
+        Classifies a batch of message texts.
+
+        :param texts: Texts to classify.
+        :type texts: list of str
+        :return: Whether each text is noise, in input order.
+        :rtype: list of bool
+        """
+        new_texts = []
+        seen = set()
+        for text in texts:
+            if len(text) < self.min_length and text not in self.verdicts and text not in seen:
+                seen.add(text)
+                new_texts.append(text)
+
+        if self.workers > 1 and len(new_texts) >= self.PARALLEL_MIN_TEXTS:
+            shard_size = int(math.ceil(len(new_texts) / self.workers))
+            shards = [new_texts[i:i + shard_size] for i in range(0, len(new_texts), shard_size)]
+            with ProcessPoolExecutor(self.workers) as executor:
+                new_verdicts = []
+                for shard_verdicts in executor.map(_classify_texts, shards, [self.min_length] * len(shards)):
+                    new_verdicts.extend(shard_verdicts)
+        else:
+            new_verdicts = _classify_texts(new_texts, self.min_length)
+        new_verdicts = dict(zip(new_texts, new_verdicts))
+
+        verdicts = []
+        for text in texts:
+            if len(text) >= self.min_length:
+                self.long += 1
+                verdicts.append(False)
+            elif text in new_verdicts:
+                verdicts.append(new_verdicts[text])
+            else:
+                self.verdicts.move_to_end(text)
+                verdicts.append(self.verdicts[text])
+
+        self._cache(new_verdicts.items())
+        self.messages += len(verdicts)
+        self.classified += len(new_texts)
+        self.noise += sum(verdicts)
+        return verdicts
+
+    def _cache(self, verdicts):
+        # Adds (text, verdict) pairs as the most recently seen texts, then drops the least recently seen texts which
+        # are over the limit.
+        for text, is_noise in verdicts:
+            if len(text) < self.min_length:
+                self.verdicts[text] = is_noise
+                self.verdicts.move_to_end(text)
+        while len(self.verdicts) > self.MAX_CACHED_TEXTS:
+            self.verdicts.popitem(last=False)
+
+    def load(self, path):
+        """
+        Warms the cache from a file previously written by save. Does nothing if the file does not exist.
+
+        The file must have been written with the same version of is_noise, so it should be deleted when
+        CoreDataModules is upgraded.
+        """
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r") as f:
+            saved = json.load(f, object_pairs_hook=OrderedDict)
+        if saved.get("version") != self.FILE_VERSION:
+            print("Warning: Ignoring noise cache file '{}', which has an unsupported version".format(path))
+            return
+
+        for min_length, verdicts in saved["verdicts"].items():
+            if min_length == str(self.min_length):
+                self._cache(verdicts.items())
+            else:
+                self._other_verdicts[min_length] = verdicts
+
+    def save(self, path):
+        verdicts = dict(self._other_verdicts)
+        verdicts[str(self.min_length)] = self.verdicts
+
+        IOUtils.ensure_dirs_exist_for_file(path)
+        with open(path, "w") as f:
+            json.dump({
+                "version": self.FILE_VERSION,
+                "verdicts": verdicts
+            }, f)
+
+    def print_stats(self):
+        print("Noise classifier: {} messages, {} long enough to never be noise, {} distinct texts classified, "
+              "{} answered from the cache, {} classified as noise".format(
+                  self.messages, self.long, self.classified, self.messages - self.long - self.classified, self.noise))
@@ -1,15 +1,264 @@
 import argparse
+import itertools
 import os
-import time
-import random
+import shutil
+from contextlib import ExitStack, closing
 
-import pytz
-from core_data_modules.cleaners import somali
 from core_data_modules.traced_data import Metadata
-from core_data_modules.traced_data.io import TracedDataJsonIO, TracedDataCodaIO, TracedDataCSVIO
+from core_data_modules.traced_data.io import TracedDataCodaIO, TracedDataCSVIO
 from core_data_modules.util import IOUtils
 from dateutil.parser import isoparse
 
+from lib.noise import NoiseClassifier
+from pipeline_lib.bulk_metadata import BulkMetadata
+from pipeline_lib.coda_dedup import DeduplicatedCodaIO
+from pipeline_lib.icr_sampler import IcrSampling
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+from pipeline_lib.timestamps import EAT, Timestamps
+
+BATCH_SIZE = 10000  # Number of messages to convert to EAT, filter by time and classify as noise at once
+
+# Project run period. Messages sent outside of this period are dropped.
+START_TIME = isoparse("2018-09-09T00+03:00")
+END_TIME = isoparse("2018-09-17T00+03:00")
+
+
+def clean_messages(user, show_messages, flow_name, variable_name, prev_coda_path, coda_output_path, icr_output_path,
+                   json_writer=None, previous_messages=None, noise_classifier=None,
+                   deduplicate_coda=False, icr_sampling=None):
+    """
+    Cleans the messages for one show, and exports the messages which aren't noise to Coda and to an ICR CSV.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param show_messages: Messages to clean.
+    :type show_messages: iterable of TracedData
+    :param flow_name: Name of activation flow from which this data was derived.
+    :type flow_name: str
+    :param variable_name: Name of message variable in flow.
+    :type variable_name: str
+    :param prev_coda_path: Path to a Coda file containing previously coded messages.
+    :type prev_coda_path: str
+    :param coda_output_path: Path to a Coda file to write processed messages to.
+    :type coda_output_path: str
+    :param icr_output_path: Path to a CSV file to write messages for inter-coder reliability evaluation to.
+    :type icr_output_path: str
+    :param json_writer: If set, messages are processed one at a time and written to json_writer as they pass through,
+                        so that peak memory use does not grow with the size of the input. See
+                        TracedDataInterchangeIO.writer.
+    :param previous_messages: If set, the messages written to the JSON output by previous incremental runs. Only the
+                              messages with a run id which is not in previous_messages are cleaned, and are written
+                              to json_writer (which must be set). The Coda and ICR outputs are regenerated from the
+                              messages which aren't noise in both previous_messages and the new messages.
+    :type previous_messages: iterable of TracedData | None
+    :param noise_classifier: Classifier to label noise with, e.g. with a cache loaded from a previous run. If None,
+                             a new NoiseClassifier is used.
+    :type noise_classifier: NoiseClassifier | None
+    :param deduplicate_coda: Whether to export one Coda message per distinct text, with a multiplicity column. See
+                             DeduplicatedCodaIO.
+    :type deduplicate_coda: bool
+    :param icr_sampling: How to sample the messages which aren't noise for the ICR CSV. If None, the default
+                         IcrSampling is used.
+    :type icr_sampling: IcrSampling | None
+    :return: The cleaned messages, or None if json_writer is set.
+    :rtype: list of TracedData | None
+    """
+    stream = json_writer is not None
+    assert previous_messages is None or stream, "Incremental cleaning requires a json_writer"
+
+    # Filter out test messages sent by AVF.
+    show_messages = (td for td in show_messages if not td.get("test_run", False))
+
+    # Filter for runs which contain a response to this week's question.
+    show_message_key = "{} (Text) - {}".format(variable_name, flow_name)
+    show_messages = (td for td in show_messages if show_message_key in td)
+
+    # In incremental mode, only process the messages which are not in the previous output, identified by their run
+    # ids so that messages which are fetched late are still processed. The run ids in the previous output are
+    # collected as it is read, below, which happens before any new messages are filtered.
+    utc_key = "{} (Time) - {}".format(variable_name, flow_name)
+    run_id_key = "{} (Run ID) - {}".format(variable_name, flow_name)
+    processed_run_ids = set()
+
+    def filter_unprocessed(messages):
+        for td in messages:
+            if td[run_id_key] not in processed_run_ids:
+                processed_run_ids.add(td[run_id_key])
+                yield td
+
+    if previous_messages is not None:
+        show_messages = filter_unprocessed(show_messages)
+
+    # Convert date/time of messages to EAT and filter out messages sent outwith the project run period
+    eat_key = "{} (Time EAT) - {}".format(variable_name, flow_name)
+    time_counts = {"total": 0, "inside": 0}
+
+    def filter_time_window(messages):
+        eat_metadata = BulkMetadata(user, Metadata.get_call_location())
+        # Messages are converted in chunks, so that each chunk's times are parsed, converted and windowed as a batch
+        # while the messages can still be streamed.
+        messages = iter(messages)
+        while True:
+            chunk = list(itertools.islice(messages, BATCH_SIZE))
+            if len(chunk) == 0:
+                return
+
+            timestamps = Timestamps.parse_iterable(td[utc_key] for td in chunk)
+            eat_times = Timestamps.isoformat_iterable(timestamps, EAT)
+            in_window = Timestamps.window_mask(timestamps, START_TIME, END_TIME)
+
+            time_counts["total"] += len(chunk)
+            for td, eat_time, inside in zip(chunk, eat_times, in_window):
+                eat_metadata.append_data(td, {eat_key: eat_time})
+
+                if inside:
+                    time_counts["inside"] += 1
+                    yield td
+                else:
+                    print("Dropping: {}".format(td[utc_key]))
+
+    def print_time_counts():
+        print("{}:{} Dropped as outside time/Total".format(
+            time_counts["total"] - time_counts["inside"], time_counts["total"]))
+
+    show_messages = filter_time_window(show_messages)
+    if not stream:
+        with Instrumentation.span("filter_time_window") as span:
+            show_messages = list(show_messages)
+            span.count("records_in", time_counts["total"])
+            span.count("records_out", time_counts["inside"])
+        print_time_counts()
+
+    # Filter out messages containing only noise
+    if noise_classifier is None:
+        noise_classifier = NoiseClassifier()
+    noise_counts = {"total": 0, "not_noise": 0}
+    noise_metadata = BulkMetadata(user, Metadata.get_call_location())
+
+    def label_noise(messages, batch_size):
+        # Classifies the texts of each batch of messages together, so that each distinct text is classified once.
+        # Yields (message, whether it is noise) for each message.
+        messages = iter(messages)
+        while True:
+            batch = list(itertools.islice(messages, batch_size))
+            if len(batch) == 0:
+                return
+
+            verdicts = noise_classifier.classify_iterable([td[show_message_key] for td in batch])
+            for td, is_noise in zip(batch, verdicts):
+                noise_counts["total"] += 1
+                if is_noise:
+                    noise_metadata.append_data(td, {"noise": "true"})
+                else:
+                    noise_counts["not_noise"] += 1
+                yield td, is_noise
+
+    def print_noise_counts():
+        print("{}:{} Dropped as noise/Total".format(
+            noise_counts["total"] - noise_counts["not_noise"], noise_counts["total"]))
+        noise_classifier.print_stats()
+
+    # Output messages which aren't noise to Coda
+    def export_coda(messages):
+        IOUtils.ensure_dirs_exist_for_file(coda_output_path)
+        if os.path.exists(prev_coda_path):
+            # TODO: Modifying this line once the coding frame has been developed to include lots of Nones feels a bit
+            # TODO: cumbersome. We could instead modify export_traced_data_iterable_to_coda to support a prev_f argument.
+            scheme_keys = {"Relevance": None, "Code 1": None, "Code 2": None, "Code 3": None, "Code 4": None}
+            with open(coda_output_path, "w") as f, open(prev_coda_path, "r") as prev_f:
+                if deduplicate_coda:
+                    DeduplicatedCodaIO.export_traced_data_iterable_to_coda_with_scheme(
+                        user, messages, show_message_key, scheme_keys, f, prev_f=prev_f)
+                else:
+                    TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
+                        messages, show_message_key, scheme_keys, f, prev_f=prev_f)
+        else:
+            with open(coda_output_path, "w") as f:
+                if deduplicate_coda:
+                    DeduplicatedCodaIO.export_traced_data_iterable_to_coda(user, messages, show_message_key, f)
+                else:
+                    TracedDataCodaIO.export_traced_data_iterable_to_coda(messages, show_message_key, f)
+
+    # Output ICR data to a CSV file.
+    # The ICR sample is drawn as the messages which aren't noise pass through, stratified by the time they were sent.
+    raw_text_key = "{} (Text) - {}".format(variable_name, flow_name)
+    icr_headers = [run_id_key, raw_text_key]
+    if icr_sampling is None:
+        icr_sampling = IcrSampling()
+    icr_sampler = icr_sampling.sampler(utc_key, run_id_key)
+
+    def export_icr():
+        icr_messages = icr_sampler.sample()
+        print("Sampled {} of {} messages for ICR, from {} strata".format(
+            len(icr_messages), icr_sampler.messages, len(icr_sampler.stratum_counts())))
+        IOUtils.ensure_dirs_exist_for_file(icr_output_path)
+        with open(icr_output_path, "w") as f:
+            TracedDataCSVIO.export_traced_data_iterable_to_csv(icr_messages, f, headers=icr_headers)
+
+    if not stream:
+        with Instrumentation.span("label_noise") as span:
+            # All of the messages are in memory, so classify them as one batch.
+            not_noise = [td for td, is_noise in label_noise(show_messages, max(1, len(show_messages)))
+                         if not is_noise]
+            span.count("records_in", noise_counts["total"])
+            span.count("records_out", noise_counts["not_noise"])
+            span.count("distinct_texts_classified", noise_classifier.classified)
+        print_noise_counts()
+
+        with Instrumentation.span("export_coda") as span:
+            export_coda(not_noise)
+            span.count("records_in", len(not_noise))
+
+        with Instrumentation.span("export_icr"):
+            icr_sampler.add_iterable(not_noise)
+            export_icr()
+
+        return show_messages
+    else:
+        # Drive the whole pipeline from the Coda export: each message is written to the JSON output as it passes
+        # through, and messages which aren't noise are forwarded to Coda and offered to the ICR sampler, which only
+        # retains the messages it might sample.
+        def read_previous_not_noise(messages):
+            for td in messages:
+                processed_run_ids.add(td[run_id_key])
+                if td.get("noise") is None:
+                    yield td
+
+        # The messages from previous runs which aren't noise are exported to Coda and sampled for ICR again, so that
+        # both outputs are the same as they would be after processing all of the messages at once.
+        previous_not_noise = []
+        if previous_messages is not None:
+            previous_not_noise = read_previous_not_noise(previous_messages)
+
+        def write_and_filter_noise(messages):
+            for td, is_noise in label_noise(messages, BATCH_SIZE):
+                json_writer.write(td)
+                if not is_noise:
+                    yield td
+
+        # The filters are lazy, so their time is all recorded in this span. Use --profile to break it down.
+        with Instrumentation.span("clean_and_export_coda") as span:
+            not_noise = icr_sampler.sample_iterable(
+                itertools.chain(previous_not_noise, write_and_filter_noise(show_messages)))
+            export_coda(not_noise)
+            for _ in not_noise:
+                # Write any messages left after the last message forwarded to Coda
+                pass
+            span.count("records_in", time_counts["total"])
+            span.count("records_in_time_window", time_counts["inside"])
+            span.count("records_out", noise_counts["not_noise"])
+            span.count("distinct_texts_classified", noise_classifier.classified)
+
+        print_time_counts()
+        print_noise_counts()
+
+        # The sample only depends on the messages sampled, so this selects the same messages as the non-streaming
+        # mode does.
+        with Instrumentation.span("export_icr"):
+            export_icr()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Cleans a list of messages, and outputs to formats "
                                                  "suitable for subsequent analysis")
@@ -27,8 +276,28 @@ if __name__ == "__main__":
     parser.add_argument("coda_output_path", metavar="coda-output-path",
                         help="Path to a Coda file to write processed messages to")
     parser.add_argument("icr_output_path", metavar="icr-output-path",
-                        help="Path to a CSV file to write 200 messages and run ids to, for use in inter-coder "
-                             "reliability evaluation")
+                        help="Path to a CSV file to write a sample of messages and run ids to, for use in "
+                             "inter-coder reliability evaluation")
+    parser.add_argument("--stream", action="store_true",
+                        help="Process messages one at a time, so that peak memory use does not grow with the size "
+                             "of the input. Produces the same outputs as the default mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only clean the messages which are not already in json-output-path, appending them to "
+                             "it. The Coda and ICR files are still regenerated from all of the messages in "
+                             "json-output-path. If json-output-path does not exist, all of the messages are "
+                             "processed. Implies --stream")
+    parser.add_argument("--noise-cache-path",
+                        help="JSON file to load cached noise classifications from at the start of the run, and to "
+                             "save them to at the end, so that texts seen by previous runs (of any show) are not "
+                             "classified again. Delete this file when CoreDataModules is upgraded")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to classify large batches of new message texts as noise with")
+    parser.add_argument("--deduplicate-coda", action="store_true",
+                        help="Export one Coda message per distinct text, with a column of the number of messages "
+                             "with that text, rather than one Coda message per message")
+    IcrSampling.add_arguments(parser)
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
     user = args.user
@@ -39,81 +308,68 @@ if __name__ == "__main__":
     json_output_path = args.json_output_path
     coda_output_path = args.coda_output_path
     icr_output_path = args.icr_output_path
-    
-    ICR_MESSAGES_COUNT = 200  # Number of messages to export in the ICR file
+    stream = args.stream
+    incremental = args.incremental
+    noise_cache_path = args.noise_cache_path
+    workers = args.workers
+    deduplicate_coda = args.deduplicate_coda
+    icr_sampling = IcrSampling.from_args(args)
+    output_format = args.output_format
 
-    # Load data from JSON file
-    with open(json_input_path, "r") as f:
-        show_messages = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+    with Instrumentation.from_args("messages", args):
+        noise_classifier = NoiseClassifier(workers=workers)
+        if noise_cache_path is not None:
+            noise_classifier.load(noise_cache_path)
 
-    # Filter out test messages sent by AVF.
-    show_messages = [td for td in show_messages if not td.get("test_run", False)]
+        # Load data from JSON file.
+        # In streaming mode, messages are instead parsed one at a time as they are consumed by clean_messages.
+        if incremental:
+            append = os.path.exists(json_output_path)
+            if not append:
+                print("No output from a previous run; processing all messages")
 
-    # Filter for runs which contain a response to this week's question.
-    show_message_key = "{} (Text) - {}".format(variable_name, flow_name)
-    show_messages = [td for td in show_messages if show_message_key in td]
+            # The new messages are appended to a copy of the previous output, which replaces it once all of them have
+            # been written, so a run which fails leaves the output as it was.
+            partial_output_path = "{}.partial".format(json_output_path)
+            if append:
+                shutil.copyfile(json_output_path, partial_output_path)
+            try:
+                with ExitStack() as stack:
+                    # The input files are closed by closing their generators, which happens here even if cleaning fails
+                    show_messages = stack.enter_context(closing(TracedDataInterchangeIO.iterate(json_input_path)))
+                    previous_messages = []
+                    if append:
+                        previous_messages = stack.enter_context(
+                            closing(TracedDataInterchangeIO.iterate(json_output_path)))
+                    json_writer = stack.enter_context(TracedDataInterchangeIO.writer(
+                        partial_output_path, output_format, pretty_print=True, append=append))
 
-    # Convert date/time of messages to EAT and filter out messages sent outwith the project run period
-    utc_key = "{} (Time) - {}".format(variable_name, flow_name)
-    eat_key = "{} (Time EAT) - {}".format(variable_name, flow_name)
-    inside_time_window = []
-    START_TIME = isoparse("2018-09-09T00+03:00")
-    END_TIME = isoparse("2018-09-17T00+03:00")
-    for td in show_messages:
-        utc_time = isoparse(td[utc_key])
-        eat_time = utc_time.astimezone(pytz.timezone("Africa/Nairobi")).isoformat()
-
-        td.append_data(
-            {eat_key: eat_time},
-            Metadata(user, Metadata.get_call_location(), time.time())
-        )
-
-        if START_TIME <= utc_time <= END_TIME:
-            inside_time_window.append(td)
+                    clean_messages(user, show_messages, flow_name, variable_name, prev_coda_path, coda_output_path,
+                                   icr_output_path, json_writer, previous_messages, noise_classifier,
+                                   deduplicate_coda, icr_sampling)
+                os.replace(partial_output_path, json_output_path)
+            finally:
+                if os.path.exists(partial_output_path):
+                    os.remove(partial_output_path)
+        elif stream:
+            # The input file is closed by closing its generator, which happens here even if cleaning fails
+            with closing(TracedDataInterchangeIO.iterate(json_input_path)) as show_messages, \
+                    TracedDataInterchangeIO.writer(json_output_path, output_format, pretty_print=True) as json_writer:
+                clean_messages(user, show_messages, flow_name, variable_name, prev_coda_path, coda_output_path,
+                               icr_output_path, json_writer, noise_classifier=noise_classifier,
+                               deduplicate_coda=deduplicate_coda, icr_sampling=icr_sampling)
         else:
-            print("Dropping: {}".format(utc_time))
+            with Instrumentation.span("load") as span:
+                show_messages = TracedDataInterchangeIO.load(json_input_path)
+                span.count("records_out", len(show_messages))
+            show_messages = clean_messages(user, show_messages, flow_name, variable_name, prev_coda_path,
+                                           coda_output_path, icr_output_path, noise_classifier=noise_classifier,
+                                           deduplicate_coda=deduplicate_coda, icr_sampling=icr_sampling)
 
-    print("{}:{} Dropped as outside time/Total".format(len(show_messages) - len(inside_time_window), len(show_messages)))
-    show_messages = inside_time_window
+            # Output to JSON
+            with Instrumentation.span("dump") as span:
+                TracedDataInterchangeIO.dump(show_messages, json_output_path, output_format, pretty_print=True)
+                span.count("records_in", len(show_messages))
 
-    # Filter out messages containing only noise
-    print("Messages classified as noise:")
-    not_noise = []
-    for td in show_messages:
-        if somali.DemographicCleaner.is_noise(td[show_message_key], min_length=20):
-            print("Dropping: {}".format(td[show_message_key]))
-            td.append_data({"noise": "true"}, Metadata(user, Metadata.get_call_location(), time.time()))
-        else:
-            not_noise.append(td)
-    
-    print("{}:{} Dropped as noise/Total".format(len(show_messages) - len(not_noise), len(show_messages)))
-
-    # Output messages which aren't noise to Coda
-    IOUtils.ensure_dirs_exist_for_file(coda_output_path)
-    if os.path.exists(prev_coda_path):
-        # TODO: Modifying this line once the coding frame has been developed to include lots of Nones feels a bit
-        # TODO: cumbersome. We could instead modify export_traced_data_iterable_to_coda to support a prev_f argument.
-        scheme_keys = {"Relevance": None, "Code 1": None, "Code 2": None, "Code 3": None, "Code 4": None}
-        with open(coda_output_path, "w") as f, open(prev_coda_path, "r") as prev_f:
-            TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
-                not_noise, show_message_key, scheme_keys, f, prev_f=prev_f)
-    else:
-        with open(coda_output_path, "w") as f:
-            TracedDataCodaIO.export_traced_data_iterable_to_coda(not_noise, show_message_key, f)
-
-    # Randomly select some messages to export for ICR
-    random.seed(0)
-    random.shuffle(not_noise)
-    icr_messages = not_noise[:ICR_MESSAGES_COUNT]
-
-    # Output ICR data to a CSV file
-    run_id_key = "{} (Run ID) - {}".format(variable_name, flow_name)
-    raw_text_key = "{} (Text) - {}".format(variable_name, flow_name)
-    IOUtils.ensure_dirs_exist_for_file(icr_output_path)
-    with open(icr_output_path, "w") as f:
-        TracedDataCSVIO.export_traced_data_iterable_to_csv(icr_messages, f, headers=[run_id_key, raw_text_key])
-
-    # Output to JSON
-    IOUtils.ensure_dirs_exist_for_file(json_output_path)
-    with open(json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_json(show_messages, f, pretty_print=True)
+        if noise_cache_path is not None:
+            noise_classifier.save(noise_cache_path)
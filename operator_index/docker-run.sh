@@ -0,0 +1,42 @@
+#!/bin/bash
+
+set -e
+
+IMAGE_NAME=esc4jmcna-operator-index
+
+# Check that the correct number of arguments were provided.
+if [ $# -ne 2 ]; then
+    echo "Usage: sh docker-run.sh <phone-uuid-table> <operator-index>"
+    echo "Note: The file at <operator-index> need not exist for this script to run. If it does, it is updated in place"
+    exit
+fi
+
+# Assign the program arguments to bash variables.
+PHONE_UUID_TABLE=$1
+OPERATOR_INDEX=$2
+
+# Build an image for this pipeline stage.
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
+
+# Create a container from the image that was just built.
+container="$(docker container create "$IMAGE_NAME")"
+
+function finish {
+    # Tear down the container when done.
+    docker container rm "$container" >/dev/null
+}
+trap finish EXIT
+
+# Copy input data into the container
+docker cp "$PHONE_UUID_TABLE" "$container:/data/phone-uuid-table.json"
+if [ -f "$OPERATOR_INDEX" ]; then
+    docker cp "$OPERATOR_INDEX" "$container:/data/operator-index.idx"
+fi
+
+# Run the image as a container.
+docker start -a -i "$container"
+
+# Copy the output data back out of the container
+mkdir -p "$(dirname "$OPERATOR_INDEX")"
+docker cp "$container:/data/operator-index.idx" "$OPERATOR_INDEX"
@@ -0,0 +1,21 @@
+import argparse
+
+from pipeline_lib.operator_index import OperatorIndex
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates or updates the index of phone number UUID -> operator which "
+                                                 "the survey auto-code stage labels contacts with, so that the stage "
+                                                 "does not need the phone number <-> UUID table itself")
+    parser.add_argument("phone_uuid_table_path", metavar="phone-uuid-table-path",
+                        help="JSON file containing an existing phone number <-> UUID lookup table")
+    parser.add_argument("operator_index_path", metavar="operator-index-path",
+                        help="Path to the operator index to update. If this file does not exist, it is created")
+
+    args = parser.parse_args()
+    phone_uuid_table_path = args.phone_uuid_table_path
+    operator_index_path = args.operator_index_path
+
+    derived = OperatorIndex.update(operator_index_path, phone_uuid_table_path)
+    with OperatorIndex(operator_index_path) as operator_index:
+        print("Derived the operators of {} new phone number UUIDs. The index has {} UUIDs".format(
+            derived, len(operator_index)))
@@ -0,0 +1,192 @@
+import json
+import struct
+
+from core_data_modules.traced_data import Metadata, TracedData
+
+from pipeline_lib.history import TracedDataHistory
+
+
+class TracedDataBinaryIO(object):
+    """
+    Reads and writes lists of TracedData objects in a compact binary format, for handing data between pipeline stages
+    faster than TracedDataJsonIO can.
+
+    A file consists of a header (MAGIC followed by a format version byte), then a sequence of frames. Each frame is a
+    4-byte big-endian length followed by a UTF-8 JSON object of:
+     - "metadata": a table of the distinct Metadata in the frame, each as [user, source, timestamp].
+     - "records": a list of up to FRAME_SIZE TracedData objects. Each is the list of its history entries, oldest first,
+       where each entry is [metadata id, data] or [metadata id, data, nested], metadata id is a position in the
+       metadata table, and nested is a dictionary of key -> TracedData nested in the entry's data, in the same form.
+    Frames are independent, so files can be written and read incrementally. Lineages are walked with loops rather than
+    recursion, so long histories do not overflow the stack.
+
+    The format only holds data, so files from any source can be read safely. Records are rebuilt with the public
+    TracedData and Metadata constructors, so the format does not depend on the internals of CoreDataModules. The values
+    in the records must be serializable as JSON.
+    """
+    MAGIC = b"AVFTDB"
+    VERSION = 3
+    # Versions 1 and 2 were pickles, which are not read because unpickling a file can run arbitrary code
+    READABLE_VERSIONS = {3}
+    FRAME_SIZE = 1000
+
+    _FRAME_LENGTH = struct.Struct(">I")
+
+    class _FrameEncoder(object):
+        def __init__(self):
+            self.metadata_table = []
+            self.metadata_ids = dict()
+            # Metadata objects shared between records (see BulkMetadata) are looked up by identity, which skips
+            # building their keys. The objects are all referenced by the data being encoded, so ids are not reused.
+            self.metadata_ids_by_object = dict()
+
+        def metadata_id(self, metadata):
+            metadata_id = self.metadata_ids_by_object.get(id(metadata))
+            if metadata_id is not None:
+                return metadata_id
+
+            metadata_key = (metadata.user, metadata.source, metadata.timestamp)
+            if metadata_key not in self.metadata_ids:
+                self.metadata_ids[metadata_key] = len(self.metadata_table)
+                self.metadata_table.append(list(metadata_key))
+            metadata_id = self.metadata_ids[metadata_key]
+            self.metadata_ids_by_object[id(metadata)] = metadata_id
+            return metadata_id
+
+        def encode(self, td):
+            entries = []
+            for node in TracedDataHistory.lineage(td):
+                data = dict()
+                nested = dict()
+                for key, value in node._data.items():
+                    if isinstance(value, TracedData):
+                        nested[key] = self.encode(value)
+                    else:
+                        data[key] = value
+
+                entry = [self.metadata_id(node._metadata), data]
+                if len(nested) > 0:
+                    entry.append(nested)
+                entries.append(entry)
+            return entries
+
+    @staticmethod
+    def _decode(entries, metadata):
+        td = None
+        for entry in entries:
+            data = entry[1]
+            if len(entry) > 2:
+                for key, nested_entries in entry[2].items():
+                    data[key] = TracedDataBinaryIO._decode(nested_entries, metadata)
+            td = TracedData(data, metadata[entry[0]], td)
+        return td
+
+    @classmethod
+    def is_binary_file(cls, f):
+        """
+        Checks whether a file opened in binary mode starts with this format's header, without consuming any of it.
+
+        :param f: File to check. Must be seekable.
+        :type f: file-like
+        :rtype: bool
+        """
+        position = f.tell()
+        magic = f.read(len(cls.MAGIC))
+        f.seek(position)
+        return magic == cls.MAGIC
+
+    @classmethod
+    def write_header(cls, f):
+        f.write(cls.MAGIC)
+        f.write(bytes([cls.VERSION]))
+
+    @classmethod
+    def read_header(cls, f):
+        """
+        Reads the header of a file in this binary format.
+
+        :param f: File to read from, opened in binary mode and positioned at the start of the file.
+        :type f: file-like
+        :return: The version of the format the file is in.
+        :rtype: int
+        :raises ValueError: If the file is not in a readable version of this format.
+        """
+        if f.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise ValueError("File is not in the TracedData binary format")
+        version_bytes = f.read(1)
+        if len(version_bytes) != 1:
+            raise ValueError("Unexpected end of file while reading a TracedData binary header")
+        version = version_bytes[0]
+        if version not in cls.READABLE_VERSIONS:
+            raise ValueError("Unsupported TracedData binary format version {}. Files written by versions of the "
+                             "pipeline before version {} must be regenerated".format(version, cls.VERSION))
+        return version
+
+    @classmethod
+    def write_frame(cls, data, f):
+        """
+        Writes a frame containing the given TracedData objects.
+
+        :param data: TracedData objects to write.
+        :type data: list of TracedData
+        :param f: File to write to, opened in binary mode, and positioned after the header or a previous frame.
+        :type f: file-like
+        """
+        encoder = cls._FrameEncoder()
+        records = [encoder.encode(td) for td in data]
+
+        frame = json.dumps({"metadata": encoder.metadata_table, "records": records},
+                           separators=(",", ":")).encode("utf-8")
+        f.write(cls._FRAME_LENGTH.pack(len(frame)))
+        f.write(frame)
+
+    @classmethod
+    def export_traced_data_iterable_to_binary(cls, data, f):
+        """
+        Writes TracedData objects to a file in this binary format.
+
+        :param data: TracedData objects to write.
+        :type data: iterable of TracedData
+        :param f: File to write to, opened in binary mode.
+        :type f: file-like
+        """
+        cls.write_header(f)
+
+        frame = []
+        for td in data:
+            frame.append(td)
+            if len(frame) == cls.FRAME_SIZE:
+                cls.write_frame(frame, f)
+                frame = []
+        if len(frame) > 0:
+            cls.write_frame(frame, f)
+
+    @classmethod
+    def import_binary_to_traced_data_iterable(cls, f):
+        """
+        Lazily reads TracedData objects from a file in this binary format.
+
+        :param f: File to read from, opened in binary mode.
+        :type f: file-like
+        :return: Generator of the TracedData objects in f, in file order.
+        :rtype: generator of TracedData
+        """
+        cls.read_header(f)
+
+        while True:
+            length_bytes = f.read(cls._FRAME_LENGTH.size)
+            if len(length_bytes) == 0:
+                return
+            if len(length_bytes) != cls._FRAME_LENGTH.size:
+                raise ValueError("Unexpected end of file while reading a TracedData binary frame length")
+            frame_length, = cls._FRAME_LENGTH.unpack(length_bytes)
+
+            frame_bytes = f.read(frame_length)
+            if len(frame_bytes) != frame_length:
+                raise ValueError("Unexpected end of file while reading a TracedData binary frame")
+            frame = json.loads(frame_bytes.decode("utf-8"))
+
+            # Records in the frame share one Metadata object per distinct Metadata, as they do after BulkMetadata
+            metadata = [Metadata(user, source, timestamp) for user, source, timestamp in frame["metadata"]]
+            for entries in frame["records"]:
+                yield cls._decode(entries, metadata)
@@ -0,0 +1,46 @@
+import time
+
+from core_data_modules.traced_data import Metadata, TracedData
+
+
+class BulkMetadata(object):
+    """
+    One Metadata object shared by all of the TracedData updates made by a loop over a dataset.
+
+    Metadata.get_call_location walks the Python stack, so constructing
+    `Metadata(user, Metadata.get_call_location(), time.time())` for every append_data in a loop costs one stack walk
+    per record. Instead, construct a BulkMetadata once before the loop, passing it the call location of the function
+    making the updates, and append every record's updates with it. The source of each update is the same as it would
+    have been (the file and function of the loop), and every update in the batch has the time the batch was started.
+
+    The binary interchange format writes each distinct Metadata once per frame, so sharing one object between the
+    records of a batch also shrinks its output.
+    """
+
+    def __init__(self, user, source):
+        """
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param source: Location of the code making the updates, as returned by Metadata.get_call_location() when
+                       called from that code.
+        :type source: str
+        """
+        self.metadata = Metadata(user, source, time.time())
+
+    def append_data(self, td, new_data):
+        """
+        Appends new data to a TracedData object, with this batch's Metadata.
+
+        :type td: TracedData
+        :type new_data: dict
+        """
+        td.append_data(new_data, self.metadata)
+
+    def traced_data(self, data):
+        """
+        Creates a new TracedData object with this batch's Metadata.
+
+        :type data: dict
+        :rtype: TracedData
+        """
+        return TracedData(data, self.metadata)
@@ -0,0 +1,139 @@
+from bisect import bisect_right
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata
+from dateutil.parser import isoparse
+
+from pipeline_lib.bulk_metadata import BulkMetadata
+from pipeline_lib.timestamps import Timestamps
+
+
+class ChannelIndex(object):
+    """
+    Classifies timestamps into channels using a precompiled index of a table of channel time ranges.
+
+    The endpoints of all the ranges split the time line into segments, in which the channels a timestamp belongs to
+    are constant. The channel codes for every segment are computed once, when the index is built, so classifying a
+    timestamp is a single binary search over the segment boundaries, regardless of the number of channels or ranges.
+    """
+
+    def __init__(self, ranges, non_logical_key):
+        """
+        :param ranges: Dictionary of channel key -> list of (start, end) ISO 8601 strings. Each range includes its start
+                       and excludes its end.
+        :type ranges: dict of str -> list of (str, str)
+        :param non_logical_key: Key to set to Codes.TRUE for timestamps which are not in any range.
+        :type non_logical_key: str
+        """
+        compiled_ranges = {
+            key: [(isoparse(start).timestamp(), isoparse(end).timestamp()) for start, end in key_ranges]
+            for key, key_ranges in ranges.items()
+        }
+
+        self.boundaries = sorted({t for key_ranges in compiled_ranges.values() for r in key_ranges for t in r})
+
+        # Segment 0 is before the first boundary; segment i is from boundaries[i - 1] up to boundaries[i].
+        self.segment_codes = []
+        segment_starts = [None] + self.boundaries
+        for segment_start in segment_starts:
+            codes = dict()
+            time_range_matches = 0
+            for key, key_ranges in compiled_ranges.items():
+                if segment_start is not None and any(start <= segment_start < end for start, end in key_ranges):
+                    time_range_matches += 1
+                    codes[key] = Codes.TRUE
+                else:
+                    codes[key] = Codes.FALSE
+
+            if time_range_matches == 0:
+                codes[non_logical_key] = Codes.TRUE
+            else:
+                codes[non_logical_key] = Codes.FALSE
+
+            self.segment_codes.append(codes)
+
+    def classify(self, timestamp):
+        """
+        Returns the channel codes for a timestamp.
+
+        :param timestamp: Timestamp to classify, as seconds since the Unix epoch.
+        :type timestamp: float
+        :return: Dictionary of channel key -> Codes.TRUE or Codes.FALSE, including the non-logical time key.
+                 This is a new dictionary which the caller may modify.
+        :rtype: dict of str -> str
+        """
+        return dict(self.segment_codes[bisect_right(self.boundaries, timestamp)])
+
+    def classify_iterable(self, timestamps):
+        """
+        Returns the channel codes for each of a batch of timestamps, in the same order as the timestamps.
+
+        :param timestamps: Timestamps to classify, as seconds since the Unix epoch.
+        :type timestamps: iterable of float
+        :rtype: list of dict of str -> str
+        """
+        boundaries = self.boundaries
+        segment_codes = self.segment_codes
+        return [dict(segment_codes[bisect_right(boundaries, timestamp)]) for timestamp in timestamps]
+
+
+class Channels(object):
+    BULK_SMS_KEY = "bulk_sms"
+    SMS_AD_KEY = "sms_ad"
+    RADIO_PROMO_KEY = "radio_promo"
+    RADIO_SHOW_KEY = "radio_show"
+    NON_LOGICAL_KEY = "non_logical_time"
+
+    BULK_SMS_RANGES = [
+        ("2018-09-14T21:25:00+03:00", "2018-09-14T23:59:00+03:00")
+    ]
+    SMS_AD_RANGES = [
+        ("2018-09-09T19:00:00+03:00", "2018-09-10T07:00:00+03:00")
+    ]
+    RADIO_PROMO_RANGES = [
+        ("2018-09-09T00:00:00+03:00", "2018-09-09T19:00:00+03:00"),
+        ("2018-09-10T07:00:00+03:00", "2018-09-11T23:59:00+03:00")
+    ]
+    RADIO_SHOW_RANGES = [
+        ("2018-09-14T07:00:00+03:00", "2018-09-15T16:00:00+03:00")
+    ]
+
+    RANGES = {
+        BULK_SMS_KEY: BULK_SMS_RANGES,
+        SMS_AD_KEY: SMS_AD_RANGES,
+        RADIO_PROMO_KEY: RADIO_PROMO_RANGES,
+        RADIO_SHOW_KEY: RADIO_SHOW_RANGES
+    }
+
+    TIMESTAMP_KEY = "S07E01_Humanitarian_Priorities (Time) - esc4jmcna_activation"
+
+    _index = None
+
+    @classmethod
+    def index(cls):
+        """
+        Returns the ChannelIndex for RANGES, compiling it on first use.
+
+        :rtype: ChannelIndex
+        """
+        if cls._index is None:
+            cls._index = ChannelIndex(cls.RANGES, cls.NON_LOGICAL_KEY)
+        return cls._index
+
+    @classmethod
+    def set_channel_keys_for_iterable(cls, user, data):
+        """
+        Labels each TracedData object in a batch with channel keys, classifying all of their timestamps in one call to
+        the channel index.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to label.
+        :type data: list of TracedData
+        """
+        timestamps = [timestamp / 1e6 for timestamp in Timestamps.parse_iterable(td[cls.TIMESTAMP_KEY] for td in data)]
+        channel_dicts = cls.index().classify_iterable(timestamps)
+
+        channel_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td, channel_dict in zip(data, channel_dicts):
+            channel_metadata.append_data(td, channel_dict)
@@ -0,0 +1,131 @@
+import csv
+import io
+from collections import OrderedDict
+
+from core_data_modules.traced_data import Metadata
+from core_data_modules.traced_data.io import TracedDataCodaIO
+
+from pipeline_lib.bulk_metadata import BulkMetadata
+
+
+class DeduplicatedCodaIO(object):
+    """
+    Exports TracedData to Coda with one message per distinct raw text, rather than one per TracedData object.
+
+    Survey answers such as gender or yes/no questions have only a handful of distinct texts across tens of thousands
+    of contacts, and Coda codes depend only on the raw text, so exporting each text once makes much smaller Coda files
+    without losing anything that can be coded. Each row also has a MULTIPLICITY_COLUMN, with the number of TracedData
+    objects which have that row's text, so that coders can see how many messages each code applies to.
+
+    Codes are imported from these files as from any other Coda file (see pipeline_lib.coda_index.CodaIndex, which
+    fans the codes of each text out to every TracedData object with that text), after dropping the multiplicity
+    column with without_multiplicity.
+    """
+    MULTIPLICITY_COLUMN = "multiplicity"
+
+    # Layout of the Coda files written by TracedDataCodaIO
+    CODA_DELIMITER = ";"
+    CODA_TEXT_COLUMN = "data"
+
+    @staticmethod
+    def _deduplicate(user, data, key_of_raw, keys):
+        """
+        :return: One TracedData object per distinct raw text, with the values of keys of the first TracedData object
+                 with that text, and the number of TracedData objects with each text.
+        :rtype: (list of TracedData, dict of str -> int)
+        """
+        firsts = OrderedDict()  # of raw text -> values of the first TracedData object with that text
+        multiplicities = dict()
+        for td in data:
+            text = td[key_of_raw]
+            if text not in firsts:
+                firsts[text] = {key: td.get(key) for key in keys}
+                multiplicities[text] = 0
+            multiplicities[text] += 1
+
+        metadata = BulkMetadata(user, Metadata.get_call_location())
+        return [metadata.traced_data(values) for values in firsts.values()], multiplicities
+
+    @classmethod
+    def _write_with_multiplicity(cls, coda_file, multiplicities, f):
+        reader = csv.reader(io.StringIO(coda_file), delimiter=cls.CODA_DELIMITER)
+        writer = csv.writer(f, delimiter=cls.CODA_DELIMITER, lineterminator="\n")
+
+        header = next(reader)
+        text_column = header.index(cls.CODA_TEXT_COLUMN)
+        writer.writerow(header + [cls.MULTIPLICITY_COLUMN])
+        for row in reader:
+            writer.writerow(row + [multiplicities.get(row[text_column], 0)])
+
+    @classmethod
+    def without_multiplicity(cls, coda_file):
+        """
+        Removes the multiplicity column from the contents of a Coda file, if it has one, so that the file can be read
+        by TracedDataCodaIO.
+
+        :param coda_file: Contents of a Coda file.
+        :type coda_file: str
+        :return: The contents of the Coda file, without the multiplicity column.
+        :rtype: str
+        """
+        header = next(csv.reader(io.StringIO(coda_file), delimiter=cls.CODA_DELIMITER), [])
+        if cls.MULTIPLICITY_COLUMN not in header:
+            return coda_file
+
+        multiplicity_column = header.index(cls.MULTIPLICITY_COLUMN)
+        f = io.StringIO()
+        writer = csv.writer(f, delimiter=cls.CODA_DELIMITER, lineterminator="\n")
+        for row in csv.reader(io.StringIO(coda_file), delimiter=cls.CODA_DELIMITER):
+            writer.writerow(row[:multiplicity_column] + row[multiplicity_column + 1:])
+        return f.getvalue()
+
+    @classmethod
+    def export_traced_data_iterable_to_coda(cls, user, data, key_of_raw, f):
+        """
+        Deduplicating version of TracedDataCodaIO.export_traced_data_iterable_to_coda.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to export.
+        :type data: iterable of TracedData
+        :param key_of_raw: Key of the raw text to export.
+        :type key_of_raw: str
+        :param f: File to write the Coda file to.
+        :type f: file-like
+        """
+        texts, multiplicities = cls._deduplicate(user, data, key_of_raw, [key_of_raw])
+
+        coda_file = io.StringIO()
+        TracedDataCodaIO.export_traced_data_iterable_to_coda(texts, key_of_raw, coda_file)
+        cls._write_with_multiplicity(coda_file.getvalue(), multiplicities, f)
+
+    @classmethod
+    def export_traced_data_iterable_to_coda_with_scheme(cls, user, data, key_of_raw, scheme_keys, f, prev_f=None):
+        """
+        Deduplicating version of TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme.
+
+        The codes exported for each text are those of the first TracedData object with that text, so the values of
+        scheme_keys should depend only on the raw text (as automatic cleaners' outputs do).
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to export.
+        :type data: iterable of TracedData
+        :param key_of_raw: Key of the raw text to export.
+        :type key_of_raw: str
+        :param scheme_keys: Dictionary of Coda scheme name -> key of the codes to export for that scheme.
+        :type scheme_keys: dict of str -> str
+        :param f: File to write the Coda file to.
+        :type f: file-like
+        :param prev_f: Optional previously coded Coda file, deduplicated or not, whose codes should be kept.
+        :type prev_f: file-like | None
+        """
+        texts, multiplicities = cls._deduplicate(
+            user, data, key_of_raw, [key_of_raw] + [key for key in scheme_keys.values() if key is not None])
+        if prev_f is not None:
+            prev_f = io.StringIO(cls.without_multiplicity(prev_f.read()))
+
+        coda_file = io.StringIO()
+        TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
+            texts, key_of_raw, scheme_keys, coda_file, prev_f)
+        cls._write_with_multiplicity(coda_file.getvalue(), multiplicities, f)
@@ -0,0 +1,176 @@
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.traced_data import Metadata
+from core_data_modules.traced_data.io import TracedDataCodaIO
+
+from pipeline_lib.bulk_metadata import BulkMetadata
+from pipeline_lib.coda_dedup import DeduplicatedCodaIO
+
+
+class CodaMerge(object):
+    """
+    Describes one import of codes from a Coda file, equivalent to a call to
+    TracedDataCodaIO.import_coda_to_traced_data_iterable or import_coda_to_traced_data_iterable_as_matrix.
+    Construct with CodaMerge.scheme or CodaMerge.matrix.
+    """
+    SCHEME = "scheme"
+    MATRIX = "matrix"
+
+    def __init__(self, kind, coda_file_path, key_of_raw, scheme_keys=None, overwrite_existing_codes=False,
+                 coda_keys=None, key_of_coded_prefix=""):
+        self.kind = kind
+        self.coda_file_path = coda_file_path
+        self.key_of_raw = key_of_raw
+        self.scheme_keys = scheme_keys
+        self.overwrite_existing_codes = overwrite_existing_codes
+        self.coda_keys = coda_keys
+        self.key_of_coded_prefix = key_of_coded_prefix
+
+    @classmethod
+    def scheme(cls, coda_file_path, key_of_raw, scheme_keys, overwrite_existing_codes=False):
+        """
+        Import equivalent to TracedDataCodaIO.import_coda_to_traced_data_iterable.
+
+        :param coda_file_path: Path to the coded Coda file to import.
+        :type coda_file_path: str
+        :param key_of_raw: Key of the raw text which was coded in Coda.
+        :type key_of_raw: str
+        :param scheme_keys: Dictionary of Coda scheme name -> key to write that scheme's code to.
+        :type scheme_keys: dict of str -> str
+        :param overwrite_existing_codes: Whether to replace codes which are already set.
+        :type overwrite_existing_codes: bool
+        """
+        return cls(cls.SCHEME, coda_file_path, key_of_raw, scheme_keys=scheme_keys,
+                   overwrite_existing_codes=overwrite_existing_codes)
+
+    @classmethod
+    def matrix(cls, coda_file_path, key_of_raw, coda_keys, key_of_coded_prefix=""):
+        """
+        Import equivalent to TracedDataCodaIO.import_coda_to_traced_data_iterable_as_matrix.
+
+        :param coda_file_path: Path to the coded Coda file to import.
+        :type coda_file_path: str
+        :param key_of_raw: Key of the raw text which was coded in Coda.
+        :type key_of_raw: str
+        :param coda_keys: Names of the Coda schemes to combine into the matrix.
+        :type coda_keys: set of str
+        :param key_of_coded_prefix: Prefix of the matrix keys to write.
+        :type key_of_coded_prefix: str
+        """
+        return cls(cls.MATRIX, coda_file_path, key_of_raw, coda_keys=coda_keys,
+                   key_of_coded_prefix=key_of_coded_prefix)
+
+    def import_codes(self, user, data, f):
+        if self.kind == self.SCHEME:
+            TracedDataCodaIO.import_coda_to_traced_data_iterable(
+                user, data, self.key_of_raw, self.scheme_keys, f, self.overwrite_existing_codes)
+        else:
+            assert self.kind == self.MATRIX, "Unknown CodaMerge kind '{}'".format(self.kind)
+            TracedDataCodaIO.import_coda_to_traced_data_iterable_as_matrix(
+                user, data, self.key_of_raw, self.coda_keys, f, self.key_of_coded_prefix)
+
+
+class CodaIndex(object):
+    """
+    Applies the codes from several Coda imports to a dataset in a single pass.
+
+    Coda codes depend only on the raw text which was coded, so each import is run once by TracedDataCodaIO over one
+    placeholder TracedData per distinct raw text in the dataset, producing a lookup table of raw text -> coded values.
+    Each Coda file is read once, and the files are indexed in parallel. The lookup tables are then applied to every
+    TracedData object in one pass over the dataset, with codes_for. Coda files exported by DeduplicatedCodaIO, with one
+    row per distinct text, are read in the same way.
+    """
+
+    def __init__(self, merges):
+        """
+        :param merges: Imports to apply, in the order they should be applied.
+        :type merges: list of CodaMerge
+        """
+        self.merges = merges
+        self.lookups = None
+
+    def build(self, user, data, workers=None):
+        """
+        Builds the lookup tables for the raw texts in data.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects which will be coded.
+        :type data: iterable of TracedData
+        :param workers: Maximum number of processes to index Coda files with. Defaults to the number of CPUs.
+        :type workers: int | None
+        """
+        # Collect the distinct raw texts for every key of raw, in one pass over the dataset
+        raw_texts = {merge.key_of_raw: set() for merge in self.merges}
+        for td in data:
+            for key_of_raw, texts in raw_texts.items():
+                if key_of_raw in td:
+                    texts.add(td[key_of_raw])
+
+        merges_by_file = OrderedDict()
+        for merge in self.merges:
+            merges_by_file.setdefault(merge.coda_file_path, []).append(merge)
+
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [
+                pool.submit(_index_coda_file, user, coda_file_path, merges,
+                            {merge.key_of_raw: raw_texts[merge.key_of_raw] for merge in merges})
+                for coda_file_path, merges in merges_by_file.items()
+            ]
+            file_lookups = [future.result() for future in futures]
+
+        lookups_by_merge = dict()
+        for merges, lookups in zip(merges_by_file.values(), file_lookups):
+            for merge, lookup in zip(merges, lookups):
+                lookups_by_merge[id(merge)] = lookup
+        self.lookups = [lookups_by_merge[id(merge)] for merge in self.merges]
+
+    def codes_for(self, td):
+        """
+        Returns the coded values which each import would set on a TracedData object, in import order.
+
+        Imports which do not overwrite existing codes check each code against the value an earlier import in the list
+        sets, as they would if the imports were applied one after another, and against td otherwise. Imports whose
+        key_of_raw td does not have set no codes on it.
+
+        :type td: TracedData
+        :rtype: list of dict of str -> str
+        """
+        assert self.lookups is not None, "CodaIndex.build must be called before applying codes"
+
+        updates = []
+        gathered = dict()  # Codes set by the imports so far, which later imports would see on td
+        for merge, lookup in zip(self.merges, self.lookups):
+            if merge.key_of_raw not in td:
+                continue
+            codes = lookup.get(td[merge.key_of_raw])
+            if codes is None:
+                continue
+
+            if merge.kind == CodaMerge.SCHEME and not merge.overwrite_existing_codes:
+                codes = {key: value for key, value in codes.items()
+                         if (gathered[key] if key in gathered else td.get(key)) is None}
+            if len(codes) > 0:
+                updates.append(codes)
+                gathered.update(codes)
+        return updates
+
+
+def _index_coda_file(user, coda_file_path, merges, raw_texts):
+    with open(coda_file_path, "r") as f:
+        coda_file = DeduplicatedCodaIO.without_multiplicity(f.read())
+
+    lookups = []
+    for merge in merges:
+        texts = sorted(raw_texts[merge.key_of_raw])
+        metadata = BulkMetadata(user, Metadata.get_call_location())
+        placeholders = [metadata.traced_data({merge.key_of_raw: text}) for text in texts]
+        merge.import_codes(user, placeholders, io.StringIO(coda_file))
+
+        lookups.append({
+            text: {key: td[key] for key in td if key != merge.key_of_raw}
+            for text, td in zip(texts, placeholders)
+        })
+    return lookups
@@ -0,0 +1,118 @@
+import json
+import os
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.util import IOUtils
+
+
+class CodeKeyCatalogue(object):
+    """
+    Catalogue of the matrix code keys in a dataset, for each prefix that coded matrix keys are written under
+    (e.g. "<raw key>_coded", for keys "<raw key>_coded_<code>").
+
+    The catalogue is built by the stage which applies the codes, as it writes them, and saved next to that stage's
+    output. Later stages can then map every coded key to its output key without scanning the keys of every record.
+    """
+    FILE_VERSION = 1
+
+    def __init__(self):
+        self.codes = dict()  # of coded prefix -> set of the code suffixes of the keys under that prefix
+
+    @staticmethod
+    def path_for(json_path):
+        """
+        Returns the path of the catalogue file which describes a JSON file of TracedData objects.
+
+        :type json_path: str
+        :rtype: str
+        """
+        return "{}.code_keys.json".format(json_path)
+
+    def add_keys(self, coded_prefix, keys):
+        """
+        Adds the keys which start with coded_prefix to the catalogue.
+
+        :type coded_prefix: str
+        :type keys: iterable of str
+        """
+        codes = self.codes.setdefault(coded_prefix, set())
+        for key in keys:
+            if key.startswith(coded_prefix):
+                codes.add(key[len(coded_prefix):])
+
+    @classmethod
+    def from_data(cls, data, coded_prefixes):
+        """
+        Builds a catalogue by scanning the keys of every TracedData object in a dataset, for datasets which were coded
+        without saving a catalogue.
+
+        :type data: iterable of TracedData
+        :type coded_prefixes: list of str
+        :rtype: CodeKeyCatalogue
+        """
+        catalogue = cls()
+        for coded_prefix in coded_prefixes:
+            catalogue.codes[coded_prefix] = set()
+        for td in data:
+            for coded_prefix in coded_prefixes:
+                catalogue.add_keys(coded_prefix, td)
+        return catalogue
+
+    def coded_keys(self, coded_prefix):
+        """
+        Returns the catalogued keys under a prefix.
+
+        :type coded_prefix: str
+        :rtype: list of str
+        """
+        return sorted(coded_prefix + code for code in self.codes.get(coded_prefix, set()))
+
+    def matrix_key_map(self, coded_prefix, output_prefix):
+        """
+        Returns the output key for each catalogued coded key under coded_prefix, with coded_prefix replaced by
+        output_prefix. Keys for the Codes.STOP code are omitted.
+
+        :type coded_prefix: str
+        :type output_prefix: str
+        :return: List of (coded key, output key), sorted by output key.
+        :rtype: list of (str, str)
+        """
+        key_map = []
+        for code in self.codes.get(coded_prefix, set()):
+            output_key = output_prefix + code
+            if output_key.endswith(Codes.STOP):
+                continue
+            key_map.append((coded_prefix + code, output_key))
+        key_map.sort(key=lambda keys: keys[1])
+        return key_map
+
+    def save(self, path):
+        IOUtils.ensure_dirs_exist_for_file(path)
+        with open(path, "w") as f:
+            json.dump({
+                "version": self.FILE_VERSION,
+                "codes": {coded_prefix: sorted(codes) for coded_prefix, codes in self.codes.items()}
+            }, f, sort_keys=True, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a catalogue written by save.
+
+        :type path: str
+        :return: The catalogue, or None if there is no catalogue at path.
+        :rtype: CodeKeyCatalogue | None
+        """
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "r") as f:
+            saved = json.load(f)
+        if saved.get("version") != cls.FILE_VERSION:
+            print("Warning: Ignoring code key catalogue '{}', which has an unsupported version".format(path))
+            return None
+
+        catalogue = cls()
+        for coded_prefix, codes in saved["codes"].items():
+            catalogue.codes[coded_prefix] = set(codes)
+        return catalogue
@@ -0,0 +1,26 @@
+import argparse
+
+from pipeline_lib.interchange import TracedDataInterchangeIO, InterchangeFormats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a file of TracedData objects between the JSON and binary "
+                                                 "interchange formats, e.g. so that binary files can be audited. "
+                                                 "Run from the repository root with "
+                                                 "`python -m pipeline_lib.convert_traced_data`")
+    parser.add_argument("input_path", metavar="input-path",
+                        help="Path to a file of TracedData objects, in either JSON or binary format")
+    parser.add_argument("output_path", metavar="output-path",
+                        help="Path to write the converted file to. The output format is binary if this path ends in "
+                             "'{}', and JSON otherwise".format(InterchangeFormats.BINARY_EXTENSION))
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    parser.add_argument("--no-pretty-print", action="store_true",
+                        help="Write compact JSON rather than the pretty-printed JSON written by the pipeline stages")
+
+    args = parser.parse_args()
+    input_path = args.input_path
+    output_path = args.output_path
+    output_format = args.output_format
+    pretty_print = not args.no_pretty_print
+
+    data = TracedDataInterchangeIO.load(input_path)
+    TracedDataInterchangeIO.dump(data, output_path, output_format, pretty_print=pretty_print)
@@ -0,0 +1,106 @@
+from pipeline_lib.bulk_metadata import BulkMetadata
+
+
+class DerivationView(object):
+    """
+    Read-only view of a TracedData object with the updates derived so far in a DerivationPlan applied on top, so that
+    each rule sees the values written by the rules before it.
+    """
+
+    def __init__(self, td):
+        self.td = td
+        self.updates = dict()
+
+    def __getitem__(self, key):
+        if key in self.updates:
+            return self.updates[key]
+        return self.td[key]
+
+    def __contains__(self, key):
+        return key in self.updates or key in self.td
+
+    def __iter__(self):
+        keys = set(self.updates)
+        for key in self.updates:
+            yield key
+        for key in self.td:
+            if key not in keys:
+                yield key
+
+    def get(self, key, default=None):
+        if key in self.updates:
+            return self.updates[key]
+        return self.td.get(key, default)
+
+
+class DerivationPlan(object):
+    """
+    Ordered list of rules which derive new values for each TracedData object in a dataset.
+
+    A rule is a function of DerivationView -> dict of updates (or None if there is nothing to update). The rules are
+    run in the order they were added, in a single pass over the data, and see the updates of the earlier rules as if
+    they had already been written. All of the updates to a TracedData object are then written in one call to
+    append_data, so the final values are the same as running each rule in its own pass with its own append_data.
+    """
+
+    def __init__(self):
+        self.rules = []
+
+    def add_rule(self, rule):
+        """
+        Adds a rule to the end of this plan.
+
+        :param rule: Function of the values derived so far -> dictionary of values to update.
+        :type rule: function of DerivationView -> (dict | None)
+        :return: rule, so that this can be used as a decorator.
+        :rtype: function of DerivationView -> (dict | None)
+        """
+        self.rules.append(rule)
+        return rule
+
+    def _derive(self, td):
+        view = DerivationView(td)
+        rule_names = []
+        for rule in self.rules:
+            updates = rule(view)
+            if updates:
+                view.updates.update(updates)
+                rule_names.append(rule.__qualname__)
+        return view.updates, tuple(rule_names)
+
+    def derive(self, td):
+        """
+        Runs the rules over a TracedData object, without modifying it.
+
+        :type td: TracedData
+        :return: The values which changed.
+        :rtype: dict
+        """
+        updates, _ = self._derive(td)
+        return updates
+
+    def apply(self, user, data, source):
+        """
+        Runs the rules over each TracedData object, writing the results of all the rules with one append_data per
+        object. Objects which no rule updates are left unchanged.
+
+        The source of each object's update is the source given here followed by the qualified names of the rules which
+        wrote it, so that the history still records which rules set each value.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param data: TracedData objects to update. These are updated in place.
+        :type data: iterable of TracedData
+        :param source: Location of the code applying this plan, as returned by Metadata.get_call_location() when called
+                       from that code.
+        :type source: str
+        """
+        # One BulkMetadata per distinct set of rules, so that the records written by the same rules share Metadata
+        metadata_by_rules = dict()
+        for td in data:
+            updates, rule_names = self._derive(td)
+            if len(updates) == 0:
+                continue
+            if rule_names not in metadata_by_rules:
+                metadata_by_rules[rule_names] = BulkMetadata(user, "{} [{}]".format(source, ", ".join(rule_names)))
+            metadata_by_rules[rule_names].append_data(td, updates)
@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import time
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.util import IOUtils
+
+
+class TracedDataHistory(object):
+    """
+    Compacts the histories of TracedData objects at a stage boundary, so that later stages do not have to carry (or
+    recursively serialize) the lineage built by every stage before them.
+
+    A compacted TracedData object has a single history entry holding its current values, with the values of any nested
+    TracedData merged in, whose Metadata source is CHECKPOINT_SOURCE_PREFIX followed by the SHA-256 of its previous
+    history. The previous history is written to a checkpoint file, a JSON Lines file of {"sha": ..., "history": [...]},
+    so that the full audit trail can be recovered with HistoryCheckpoints.restore.
+
+    Lineages are walked with loops rather than recursion, so compaction cost is bounded by the length of a lineage,
+    not by the interpreter's stack. This reads the _prev chains of TracedData objects directly, as there is no public
+    API for walking a lineage iteratively.
+    """
+    CHECKPOINT_SOURCE_PREFIX = "history_checkpoint:"
+    TRACED_DATA_REFERENCE_KEY = "traced_data_sha"
+
+    @staticmethod
+    def checkpoint_path_for(output_path):
+        """
+        Returns the path of the history checkpoint file to write next to an output file.
+
+        :type output_path: str
+        :rtype: str
+        """
+        return "{}.history.jsonl".format(output_path)
+
+    @staticmethod
+    def lineage(td):
+        """
+        Returns the history entries of a TracedData object, oldest first.
+
+        :type td: TracedData
+        :rtype: list of TracedData
+        """
+        nodes = []
+        node = td
+        while node is not None:
+            nodes.append(node)
+            node = node._prev
+        nodes.reverse()
+        return nodes
+
+    @classmethod
+    def compact(cls, user, td, checkpoint_writer):
+        """
+        Returns a compacted copy of a TracedData object, writing its history to a checkpoint file.
+
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :type td: TracedData
+        :param checkpoint_writer: Writer for the checkpoint file.
+        :type checkpoint_writer: HistoryCheckpointWriter
+        :rtype: TracedData
+        """
+        sha = checkpoint_writer.write(td)
+        return TracedData(cls.current_values(td),
+                          Metadata(user, "{}{}".format(cls.CHECKPOINT_SOURCE_PREFIX, sha), time.time()))
+
+    @classmethod
+    def current_values(cls, td):
+        """
+        Returns the current value of every key of a TracedData object, as a dictionary which contains no TracedData.
+
+        The lineage is flattened with a loop, as looking up each key of td walks its lineage recursively. The values of
+        TracedData nested in td are flattened in the same way and merged in place of the key the nested object was
+        appended under, as those are the values looking them up in td returns.
+
+        :type td: TracedData
+        :rtype: dict
+        """
+        data = dict()
+        for entry in cls.lineage(td):
+            for key, value in entry._data.items():
+                if isinstance(value, TracedData):
+                    data.pop(key, None)
+                    data.update(cls.current_values(value))
+                else:
+                    data[key] = value
+        return data
+
+    @classmethod
+    def compact_iterable(cls, user, data, checkpoint_writer):
+        """
+        Compacts a list of TracedData objects. See TracedDataHistory.compact.
+
+        :type user: str
+        :type data: iterable of TracedData
+        :type checkpoint_writer: HistoryCheckpointWriter
+        :rtype: list of TracedData
+        """
+        return [cls.compact(user, td, checkpoint_writer) for td in data]
+
+
+class HistoryCheckpointWriter(object):
+    """
+    Writes the histories of TracedData objects to a checkpoint file for TracedDataHistory.compact.
+
+    TracedData objects nested inside the data of a history entry are written as checkpoints of their own, and
+    referenced by {TracedDataHistory.TRACED_DATA_REFERENCE_KEY: sha}. Each distinct history is written once.
+    """
+
+    def __init__(self, path):
+        IOUtils.ensure_dirs_exist_for_file(path)
+        self.path = path
+        self.f = open(path, "w")
+        self._written_shas = set()
+
+    def write(self, td):
+        """
+        Writes the history of a TracedData object (and of any TracedData nested within it) to the checkpoint file.
+
+        :type td: TracedData
+        :return: SHA-256 of the history of td.
+        :rtype: str
+        """
+        shas = dict()  # of id(TracedData) -> sha of its history
+
+        # Post-order walk, so that nested TracedData are written before the histories which reference them
+        stack = [(td, False)]
+        while len(stack) > 0:
+            node, children_written = stack.pop()
+            if id(node) in shas:
+                continue
+
+            lineage = TracedDataHistory.lineage(node)
+            if not children_written:
+                stack.append((node, True))
+                for entry in lineage:
+                    for value in entry._data.values():
+                        if isinstance(value, TracedData) and id(value) not in shas:
+                            stack.append((value, False))
+                continue
+
+            history = [
+                {
+                    "data": {
+                        key: {TracedDataHistory.TRACED_DATA_REFERENCE_KEY: shas[id(value)]}
+                        if isinstance(value, TracedData) else value
+                        for key, value in entry._data.items()
+                    },
+                    "metadata": entry._metadata.__dict__
+                }
+                for entry in lineage
+            ]
+            shas[id(node)] = self._write_history(history)
+
+        return shas[id(td)]
+
+    def _write_history(self, history):
+        serialized_history = json.dumps(history, sort_keys=True)
+        sha = hashlib.sha256(serialized_history.encode("utf-8")).hexdigest()
+        if sha not in self._written_shas:
+            self._written_shas.add(sha)
+            self.f.write('{{"sha": "{}", "history": {}}}\n'.format(sha, serialized_history))
+        return sha
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HistoryCheckpoints(object):
+    """Reads checkpoint files written by HistoryCheckpointWriter, to recover the full histories of compacted data."""
+
+    def __init__(self):
+        self.histories = dict()  # of sha -> list of history entries, oldest first
+        self._restored = dict()
+
+    def load(self, path):
+        """
+        Adds the checkpoints in a checkpoint file. Does nothing if the file does not exist.
+
+        :type path: str
+        """
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r") as f:
+            for line in f:
+                checkpoint = json.loads(line)
+                self.histories[checkpoint["sha"]] = checkpoint["history"]
+
+    def restore(self, td):
+        """
+        Returns a copy of a TracedData object with the histories of any checkpoints in its lineage restored.
+
+        Checkpoint entries are kept in the restored lineage, after the history they replaced. Checkpoints which
+        are not loaded are left as they are.
+
+        :type td: TracedData
+        :rtype: TracedData
+        """
+        restored = None
+        for entry in TracedDataHistory.lineage(td):
+            sha = self._checkpoint_sha(entry._metadata.source)
+            if restored is None and sha in self.histories:
+                restored = self._restore_history(sha)
+            restored = TracedData(entry._data, entry._metadata, restored)
+        return restored
+
+    def _restore_history(self, sha):
+        # Post-order walk, so that nested TracedData are restored before the histories which reference them
+        stack = [(sha, False)]
+        while len(stack) > 0:
+            node_sha, children_restored = stack.pop()
+            if node_sha in self._restored:
+                continue
+
+            history = self.histories[node_sha]
+            # A history which was itself compacted earlier starts with an earlier checkpoint
+            earlier_sha = self._checkpoint_sha(history[0]["metadata"]["source"])
+            if earlier_sha not in self.histories:
+                earlier_sha = None
+
+            if not children_restored:
+                stack.append((node_sha, True))
+                if earlier_sha is not None and earlier_sha not in self._restored:
+                    stack.append((earlier_sha, False))
+                for entry in history:
+                    for value in entry["data"].values():
+                        if self._is_reference(value) and value[TracedDataHistory.TRACED_DATA_REFERENCE_KEY] \
+                                not in self._restored:
+                            stack.append((value[TracedDataHistory.TRACED_DATA_REFERENCE_KEY], False))
+                continue
+
+            td = None if earlier_sha is None else self._restored[earlier_sha]
+            for entry in history:
+                data = {
+                    key: self._restored[value[TracedDataHistory.TRACED_DATA_REFERENCE_KEY]]
+                    if self._is_reference(value) else value
+                    for key, value in entry["data"].items()
+                }
+                metadata = Metadata.__new__(Metadata)
+                metadata.__dict__.update(entry["metadata"])
+                td = TracedData(data, metadata, td)
+            self._restored[node_sha] = td
+
+        return self._restored[sha]
+
+    @staticmethod
+    def _checkpoint_sha(source):
+        if not source.startswith(TracedDataHistory.CHECKPOINT_SOURCE_PREFIX):
+            return None
+        return source[len(TracedDataHistory.CHECKPOINT_SOURCE_PREFIX):]
+
+    @staticmethod
+    def _is_reference(value):
+        return isinstance(value, dict) and list(value.keys()) == [TracedDataHistory.TRACED_DATA_REFERENCE_KEY]
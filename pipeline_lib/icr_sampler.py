@@ -0,0 +1,249 @@
+import hashlib
+import heapq
+import itertools
+
+from core_data_modules.cleaners import Codes
+
+from pipeline_lib.channels import Channels
+from pipeline_lib.timestamps import EAT, Timestamps
+
+
+class IcrStrata(object):
+    """
+    Ways of stratifying messages for inter-coder reliability (ICR) samples, by the time each message was sent.
+    """
+    CHANNEL_DAY = "channel-day"
+    CHANNEL = "channel"
+    DAY = "day"
+    NONE = "none"
+
+    NAMES = [CHANNEL_DAY, CHANNEL, DAY, NONE]
+
+    @classmethod
+    def strata_iterable(cls, strata, timestamps):
+        """
+        Returns the stratum of each of a batch of timestamps.
+
+        :param strata: Way of stratifying, one of NAMES.
+        :type strata: str
+        :param timestamps: Microseconds since the Unix epoch.
+        :type timestamps: array.array of int
+        :return: Stratum of each timestamp, in input order.
+        :rtype: list of str
+        """
+        assert strata in cls.NAMES, "Unknown ICR strata '{}'".format(strata)
+        if strata == cls.NONE:
+            return [""] * len(timestamps)
+
+        # Days are in EAT, the time zone the shows are broadcast in
+        days = [date_time[:10] for date_time in Timestamps.date_time_iterable(timestamps, EAT)]
+        if strata == cls.DAY:
+            return days
+
+        # Channels are the channel windows each timestamp is in, e.g. 'radio_show', or 'bulk_sms+radio_show' where
+        # windows overlap
+        channel_dicts = Channels.index().classify_iterable(timestamp / 1e6 for timestamp in timestamps)
+        channels = ["+".join(sorted(key for key, code in channel_dict.items() if code == Codes.TRUE))
+                    for channel_dict in channel_dicts]
+        if strata == cls.CHANNEL:
+            return channels
+
+        return ["{} {}".format(channel, day) for channel, day in zip(channels, days)]
+
+
+class StratifiedIcrSampler(object):
+    """
+    Draws a sample of messages for inter-coder reliability (ICR) evaluation in one pass over a stream of messages, with
+    the sample shared equally between strata (e.g. channel windows and days), so that the busiest window does not
+    dominate it.
+
+    Each message is given a pseudo-random priority by hashing its id with the seed, and each stratum keeps a reservoir
+    of the sample_size messages with the lowest priorities seen so far, so memory use is bounded by the number of strata
+    rather than the number of messages. The sample only depends on the set of messages and the seed, not the order the
+    messages arrive in, so an incremental run which samples the previous messages and the new ones selects the same
+    messages as sampling all of them at once.
+    """
+    BATCH_SIZE = 10000  # Number of messages to parse the times of and stratify at once
+
+    def __init__(self, sample_size, time_key, id_key, strata=IcrStrata.CHANNEL_DAY, seed=0):
+        """
+        :param sample_size: Number of messages to sample. If there are fewer messages, all of them are sampled.
+        :type sample_size: int
+        :param time_key: Key of the ISO 8601 time of each message, for stratifying.
+        :type time_key: str
+        :param id_key: Key of the id of each message, e.g. its run id. Ids must be unique.
+        :type id_key: str
+        :param strata: Way of stratifying the messages, one of IcrStrata.NAMES.
+        :type strata: str
+        :param seed: Seed for the messages' priorities. The same seed and messages always give the same sample.
+        :type seed: int
+        """
+        self.sample_size = sample_size
+        self.time_key = time_key
+        self.id_key = id_key
+        self.strata = strata
+        self.seed = seed
+
+        self.messages = 0
+        self._pending = []
+        # Dictionary of stratum -> heap of (-priority, id, sequence number, message), holding the messages with the
+        # lowest priorities in that stratum
+        self._reservoirs = dict()
+        self._sequence_numbers = itertools.count()
+
+    def _priority(self, message_id):
+        digest = hashlib.blake2b("{}\x00{}".format(self.seed, message_id).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def _flush(self):
+        batch = self._pending
+        self._pending = []
+        if len(batch) == 0:
+            return
+
+        timestamps = Timestamps.parse_iterable(td[self.time_key] for td in batch)
+        for td, stratum in zip(batch, IcrStrata.strata_iterable(self.strata, timestamps)):
+            message_id = str(td[self.id_key])
+            entry = (-self._priority(message_id), message_id, next(self._sequence_numbers), td)
+
+            reservoir = self._reservoirs.setdefault(stratum, [])
+            if len(reservoir) < self.sample_size:
+                heapq.heappush(reservoir, entry)
+            elif entry[:3] > reservoir[0][:3]:
+                heapq.heapreplace(reservoir, entry)
+
+    def add(self, td):
+        """
+        Offers a message to the sample.
+
+        :type td: TracedData | dict
+        """
+        self.messages += 1
+        self._pending.append(td)
+        if len(self._pending) >= self.BATCH_SIZE:
+            self._flush()
+
+    def add_iterable(self, data):
+        """
+        :type data: iterable of (TracedData | dict)
+        """
+        for td in data:
+            self.add(td)
+
+    def sample_iterable(self, data):
+        """
+        Offers each message in an iterable to the sample as it passes through, for sampling a stream which is also
+        consumed by something else (e.g. a Coda export).
+
+        :type data: iterable of (TracedData | dict)
+        :return: Generator of the messages in data.
+        :rtype: generator of (TracedData | dict)
+        """
+        for td in data:
+            self.add(td)
+            yield td
+
+    def _allocate(self):
+        """
+        Shares sample_size between the strata as equally as possible. Strata with fewer messages than their share give
+        the rest of it to the other strata.
+
+        :return: Dictionary of stratum -> number of messages to sample from it.
+        :rtype: dict of str -> int
+        """
+        sizes = {stratum: len(reservoir) for stratum, reservoir in self._reservoirs.items()}
+        allocation = {stratum: 0 for stratum in sizes}
+        remaining = self.sample_size
+        open_strata = sorted(stratum for stratum, size in sizes.items() if size > 0)
+        while remaining > 0 and len(open_strata) > 0:
+            share, extra = divmod(remaining, len(open_strata))
+            still_open = []
+            for i, stratum in enumerate(open_strata):
+                n = min(share + (1 if i < extra else 0), sizes[stratum] - allocation[stratum])
+                allocation[stratum] += n
+                remaining -= n
+                if allocation[stratum] < sizes[stratum]:
+                    still_open.append(stratum)
+            open_strata = still_open
+        return allocation
+
+    def sample(self):
+        """
+        Returns the sample of the messages offered so far.
+
+        :return: The sampled messages, in priority order (which is a pseudo-random order).
+        :rtype: list of (TracedData | dict)
+        """
+        self._flush()
+
+        sampled = []
+        for stratum, n in self._allocate().items():
+            sampled.extend(heapq.nlargest(n, self._reservoirs[stratum], key=lambda entry: entry[:3]))
+        sampled.sort(key=lambda entry: entry[:3], reverse=True)
+        return [td for _, _, _, td in sampled]
+
+    def stratum_counts(self):
+        """
+        :return: Dictionary of stratum -> number of messages sampled from it.
+        :rtype: dict of str -> int
+        """
+        self._flush()
+        return {stratum: n for stratum, n in self._allocate().items() if n > 0}
+
+
+class IcrSampling(object):
+    """
+    Settings for drawing ICR samples with StratifiedIcrSampler, which can be set from the command line of any stage that
+    exports to Coda.
+    """
+    DEFAULT_SAMPLE_SIZE = 200
+
+    def __init__(self, sample_size=DEFAULT_SAMPLE_SIZE, strata=IcrStrata.CHANNEL_DAY, seed=0):
+        """
+        :param sample_size: Number of messages to sample for each ICR file.
+        :type sample_size: int
+        :param strata: Way of stratifying the messages, one of IcrStrata.NAMES.
+        :type strata: str
+        :param seed: Seed for the samples.
+        :type seed: int
+        """
+        self.sample_size = sample_size
+        self.strata = strata
+        self.seed = seed
+
+    def sampler(self, time_key, id_key):
+        """
+        :param time_key: Key of the ISO 8601 time of each message, for stratifying.
+        :type time_key: str
+        :param id_key: Key of the unique id of each message.
+        :type id_key: str
+        :rtype: StratifiedIcrSampler
+        """
+        return StratifiedIcrSampler(self.sample_size, time_key, id_key, self.strata, self.seed)
+
+    def to_dict(self):
+        return {"sample_size": self.sample_size, "strata": self.strata, "seed": self.seed}
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Adds the --icr-sample-size, --icr-strata and --icr-seed arguments to an argparse parser.
+
+        :type parser: argparse.ArgumentParser
+        """
+        parser.add_argument("--icr-sample-size", type=int, default=IcrSampling.DEFAULT_SAMPLE_SIZE,
+                            help="Number of messages to sample for each ICR file")
+        parser.add_argument("--icr-strata", choices=IcrStrata.NAMES, default=IcrStrata.CHANNEL_DAY,
+                            help="How to stratify the messages sampled for ICR, so that each channel window and/or "
+                                 "day is sampled equally")
+        parser.add_argument("--icr-seed", type=int, default=0,
+                            help="Seed for the ICR samples. The same seed and messages always give the same sample")
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        :param args: Arguments parsed by a parser which add_arguments was called on.
+        :type args: argparse.Namespace
+        :rtype: IcrSampling
+        """
+        return cls(args.icr_sample_size, args.icr_strata, args.icr_seed)
@@ -0,0 +1,182 @@
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from core_data_modules.util import IOUtils
+
+
+class Span(object):
+    """
+    A named, timed section of a pipeline stage, with counters (e.g. of the records into and out of the section).
+    """
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.counters = dict()
+        self.peak_rss_mb = None
+
+    def count(self, counter, n=1):
+        """
+        Adds n to one of this span's counters.
+
+        :type counter: str
+        :type n: int
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+
+class _DisabledSpan(object):
+    def count(self, counter, n=1):
+        pass
+
+
+class Instrumentation(object):
+    """
+    Opt-in instrumentation for pipeline stages, which records named spans with counters and the peak memory use of the
+    process, and optionally profiles the whole stage with cProfile.
+
+    Stages record spans with `with Instrumentation.span(name) as span: ...`, which does nothing unless instrumentation
+    was requested on the command line (see add_arguments), so the spans can be left in place permanently.
+
+    Spans are written as a Trace Event Format JSON file (as read by chrome://tracing and Perfetto). Each span is a
+    complete ("X") event, whose args are its counters and the peak RSS of the process when the span ended.
+    """
+    _active = None
+    _disabled_span = _DisabledSpan()
+
+    def __init__(self, stage_name, trace_path=None, profile_path=None):
+        """
+        :param stage_name: Name of the stage being instrumented.
+        :type stage_name: str
+        :param trace_path: Path to write the trace of spans to, or None to not record spans.
+        :type trace_path: str | None
+        :param profile_path: Path to write cProfile statistics to, or None to not profile.
+        :type profile_path: str | None
+        """
+        self.stage_name = stage_name
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+
+        self.spans = []
+        self._profiler = None
+        self._stage_span = None
+
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Adds the optional --trace-path and --profile arguments to a pipeline stage's argparse.ArgumentParser.
+        """
+        parser.add_argument("--trace-path",
+                            help="Path to write a JSON trace (in the Trace Event Format) of the time taken by each "
+                                 "step of this stage to, with counts of the records processed and the peak memory use")
+        parser.add_argument("--profile", metavar="profile-path",
+                            help="Run this stage under cProfile, and write the statistics to this path. Load them "
+                                 "with pstats, or a viewer such as snakeviz")
+
+    @classmethod
+    def from_args(cls, stage_name, args):
+        """
+        :param stage_name: Name of the stage being instrumented.
+        :type stage_name: str
+        :param args: Arguments parsed by a parser set up with add_arguments.
+        :type args: argparse.Namespace
+        :rtype: Instrumentation
+        """
+        return cls(stage_name, args.trace_path, args.profile)
+
+    @classmethod
+    @contextmanager
+    def span(cls, name):
+        """
+        Records a span around the body of a with statement, if instrumentation is active.
+
+        :param name: Name of the span.
+        :type name: str
+        :return: Context manager which yields the Span, which may be used to count records.
+        """
+        instrumentation = cls._active
+        if instrumentation is None or instrumentation.trace_path is None:
+            yield cls._disabled_span
+            return
+
+        span = Span(name, time.perf_counter())
+        try:
+            yield span
+        finally:
+            instrumentation._end_span(span)
+
+    def _end_span(self, span):
+        span.end = time.perf_counter()
+        # ru_maxrss is in kilobytes on Linux
+        span.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.spans.append(span)
+
+    def __enter__(self):
+        if self.trace_path is None and self.profile_path is None:
+            return self
+
+        Instrumentation._active = self
+        self._stage_span = Span(self.stage_name, time.perf_counter())
+        if self.profile_path is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if Instrumentation._active is not self:
+            return
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            IOUtils.ensure_dirs_exist_for_file(self.profile_path)
+            self._profiler.dump_stats(self.profile_path)
+
+        self._end_span(self._stage_span)
+        Instrumentation._active = None
+
+        if self.trace_path is not None:
+            self.write_trace(self.trace_path)
+
+    def write_trace(self, path):
+        """
+        Writes the spans recorded so far to a Trace Event Format JSON file.
+
+        :type path: str
+        """
+        origin = min(span.start for span in self.spans)
+        pid = os.getpid()
+
+        trace_events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            args = dict(span.counters)
+            args["peak_rss_mb"] = span.peak_rss_mb
+            trace_events.append({
+                "name": span.name,
+                "cat": self.stage_name,
+                "ph": "X",
+                "ts": (span.start - origin) * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": pid,
+                "tid": 0,
+                "args": args
+            })
+            trace_events.append({
+                "name": "peak_rss_mb",
+                "ph": "C",
+                "ts": (span.end - origin) * 1e6,
+                "pid": pid,
+                "args": {"peak_rss_mb": span.peak_rss_mb}
+            })
+
+        IOUtils.ensure_dirs_exist_for_file(path)
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": trace_events,
+                "displayTimeUnit": "ms",
+                "otherData": {"stage": self.stage_name}
+            }, f, indent=2)
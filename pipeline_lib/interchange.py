@@ -0,0 +1,208 @@
+import os
+
+from core_data_modules.util import IOUtils
+
+from pipeline_lib.binary_io import TracedDataBinaryIO
+from pipeline_lib.json_stream import TracedDataJsonStreamIO, TracedDataJsonStreamWriter
+
+
+class InterchangeFormats(object):
+    JSON = "json"
+    BINARY = "binary"
+
+    BINARY_EXTENSION = ".tdb"
+
+    ALL = [JSON, BINARY]
+
+
+class TracedDataInterchangeIO(object):
+    """
+    Loads and saves the TracedData files which are passed between pipeline stages, in either the JSON format written
+    by TracedDataJsonIO or the binary format written by TracedDataBinaryIO.
+
+    The format of a file being read is detected from its contents. The format of a file being written is the one
+    requested, if any, otherwise it is chosen from the file's extension: paths ending in
+    InterchangeFormats.BINARY_EXTENSION are written as binary, and all other paths as JSON.
+    """
+
+    @staticmethod
+    def add_output_format_argument(parser):
+        """
+        Adds the optional --output-format argument, which overrides the format chosen from output file extensions,
+        to a pipeline stage's argparse.ArgumentParser.
+        """
+        parser.add_argument("--output-format", choices=InterchangeFormats.ALL,
+                            help="Format to write TracedData output files in. Defaults to binary for paths ending in "
+                                 "'{}' and to JSON otherwise. Input files may be in either format".format(
+                                     InterchangeFormats.BINARY_EXTENSION))
+
+    @staticmethod
+    def output_format_for_path(path, output_format=None):
+        if output_format is not None:
+            assert output_format in InterchangeFormats.ALL, "Unknown interchange format '{}'".format(output_format)
+            return output_format
+
+        if path.endswith(InterchangeFormats.BINARY_EXTENSION):
+            return InterchangeFormats.BINARY
+        return InterchangeFormats.JSON
+
+    @staticmethod
+    def input_format_for_path(path):
+        with open(path, "rb") as f:
+            if TracedDataBinaryIO.is_binary_file(f):
+                return InterchangeFormats.BINARY
+        return InterchangeFormats.JSON
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads all the TracedData objects in a JSON or binary file.
+
+        :param path: Path to the file to load.
+        :type path: str
+        :return: TracedData objects in the file.
+        :rtype: list of TracedData
+        """
+        if cls.input_format_for_path(path) == InterchangeFormats.BINARY:
+            with open(path, "rb") as f:
+                return list(TracedDataBinaryIO.import_binary_to_traced_data_iterable(f))
+
+        with open(path, "r") as f:
+            return TracedDataJsonStreamIO.load(f)
+
+    @classmethod
+    def iterate(cls, path):
+        """
+        Lazily loads the TracedData objects in a JSON or binary file, one object at a time.
+
+        See TracedDataJsonStreamIO for the restrictions on the JSON files which may be read this way.
+
+        :param path: Path to the file to load.
+        :type path: str
+        :return: Generator of the TracedData objects in the file.
+        :rtype: generator of TracedData
+        """
+        if cls.input_format_for_path(path) == InterchangeFormats.BINARY:
+            with open(path, "rb") as f:
+                for td in TracedDataBinaryIO.import_binary_to_traced_data_iterable(f):
+                    yield td
+        else:
+            with open(path, "r") as f:
+                for td in TracedDataJsonStreamIO.import_json_to_traced_data_iterable(f):
+                    yield td
+
+    @classmethod
+    def dump(cls, data, path, output_format=None, pretty_print=True):
+        """
+        Writes TracedData objects to a JSON or binary file, creating the file's parent directories if needed.
+
+        :param data: TracedData objects to write.
+        :type data: iterable of TracedData
+        :param path: Path to write to.
+        :type path: str
+        :param output_format: Format to write, one of InterchangeFormats.ALL. If None, the format is chosen from the
+                              extension of path.
+        :type output_format: str | None
+        :param pretty_print: Whether to pretty-print JSON output. Ignored for binary output.
+        :type pretty_print: bool
+        """
+        IOUtils.ensure_dirs_exist_for_file(path)
+
+        if cls.output_format_for_path(path, output_format) == InterchangeFormats.BINARY:
+            with open(path, "wb") as f:
+                TracedDataBinaryIO.export_traced_data_iterable_to_binary(data, f)
+        else:
+            with open(path, "w") as f:
+                TracedDataJsonStreamWriter.export_traced_data_iterable_to_json(data, f, pretty_print=pretty_print)
+
+    @classmethod
+    def writer(cls, path, output_format=None, pretty_print=True, append=False):
+        """
+        Opens a file for writing TracedData objects one at a time. The returned writer has write(td) and close()
+        methods, and can be used as a context manager.
+
+        The file contains the same objects as dump would write for the list of all the objects written, but JSON files
+        are written without jsonpickle references, so objects which are shared are written in full each time (see
+        TracedDataJsonStreamWriter). When used as a context manager, the file is left unfinished if the block raises an
+        exception.
+
+        If append is True and the file already exists, the objects written are added to the end of the objects already
+        in the file. The existing file must be in the requested format, and JSON files must have been written with the
+        same pretty_print option.
+        """
+        IOUtils.ensure_dirs_exist_for_file(path)
+
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            existing_format = cls.input_format_for_path(path)
+            if output_format is not None and output_format != existing_format:
+                raise ValueError("Cannot append {} output to '{}', which is in the {} format".format(
+                    output_format, path, existing_format))
+            if existing_format == InterchangeFormats.BINARY:
+                return _BinaryFileWriter(path, append=True)
+            return _JsonFileWriter(path, pretty_print, append=True)
+
+        if cls.output_format_for_path(path, output_format) == InterchangeFormats.BINARY:
+            return _BinaryFileWriter(path)
+        return _JsonFileWriter(path, pretty_print)
+
+
+class _FileWriter(object):
+    def abort(self):
+        """
+        Closes the file without finishing it, so that the output of a failed run cannot be mistaken for a complete
+        file.
+        """
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _JsonFileWriter(_FileWriter):
+    def __init__(self, path, pretty_print, append=False):
+        if append:
+            self.stream_writer = TracedDataJsonStreamWriter.open_for_append(path, pretty_print=pretty_print)
+            self.f = self.stream_writer.f
+        else:
+            self.f = open(path, "w")
+            self.stream_writer = TracedDataJsonStreamWriter(self.f, pretty_print=pretty_print)
+
+    def write(self, td):
+        self.stream_writer.write(td)
+
+    def close(self):
+        if not self.f.closed:
+            self.stream_writer.close()
+            self.f.close()
+
+
+class _BinaryFileWriter(_FileWriter):
+    def __init__(self, path, append=False):
+        self.frame = []
+        if append:
+            # Frames are self-contained, so new frames can be added to the end of any readable existing file.
+            with open(path, "rb") as f:
+                TracedDataBinaryIO.read_header(f)
+            self.f = open(path, "ab")
+        else:
+            self.f = open(path, "wb")
+            TracedDataBinaryIO.write_header(self.f)
+
+    def write(self, td):
+        self.frame.append(td)
+        if len(self.frame) == TracedDataBinaryIO.FRAME_SIZE:
+            TracedDataBinaryIO.write_frame(self.frame, self.f)
+            self.frame = []
+
+    def close(self):
+        if not self.f.closed:
+            if len(self.frame) > 0:
+                TracedDataBinaryIO.write_frame(self.frame, self.f)
+                self.frame = []
+            self.f.close()
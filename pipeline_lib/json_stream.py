@@ -0,0 +1,480 @@
+import copy
+import io
+import json
+import re
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from pipeline_lib.history import TracedDataHistory
+
+
+class _TracedDataJsonCodec(object):
+    """
+    Encodes and decodes single TracedData objects in the jsonpickle format written by TracedDataJsonIO, walking their
+    lineages with loops.
+
+    jsonpickle writes each entry of a lineage nested inside the next one as its "_prev", and recurses once per entry
+    to encode or decode it, so objects with long histories overflow the stack. Here, the entries are written and parsed
+    one after another, and the json module only handles the values of each entry.
+
+    Objects which this does not handle, such as those with nested TracedData, with values which jsonpickle tags with
+    "py/" keys, or with jsonpickle references to other objects, are left to TracedDataJsonIO. The codec never writes
+    references: a Metadata object shared by several entries (e.g. by BulkMetadata) is written in full for each entry,
+    where TracedDataJsonIO would write a reference to its first occurrence.
+    """
+    TRACED_DATA_CLASS = "{}.{}".format(TracedData.__module__, TracedData.__name__)
+    METADATA_CLASS = "{}.{}".format(Metadata.__module__, Metadata.__name__)
+
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+    _PLAIN_TYPES = {str, int, float, bool, type(None)}
+    _UNSUPPORTED = object()
+
+    def __init__(self, pretty_print):
+        self.indent = "  " if pretty_print else None
+        self._decoder = json.JSONDecoder()
+
+    @classmethod
+    def _is_plain(cls, value):
+        # Whether json and jsonpickle write value in the same way
+        if type(value) in cls._PLAIN_TYPES:
+            return True
+        if type(value) == list:
+            return all(cls._is_plain(item) for item in value)
+        if type(value) == dict:
+            return all(type(key) == str and not key.startswith("py/") and cls._is_plain(item)
+                       for key, item in value.items())
+        return False
+
+    def _member(self, key, value, indent):
+        text = json.dumps(value, sort_keys=True, indent=None if self.indent is None else len(self.indent),
+                          separators=(", ", ": "))
+        if self.indent is not None:
+            text = text.replace("\n", "\n" + indent)
+        return "{}: {}".format(json.dumps(key), text)
+
+    def can_encode(self, td):
+        """
+        Returns whether encode can serialize a TracedData object.
+
+        :type td: TracedData
+        :rtype: bool
+        """
+        return all(self._is_plain(node._data) and self._is_plain(node._metadata.__dict__)
+                   for node in TracedDataHistory.lineage(td))
+
+    def encode(self, td, indent=""):
+        """
+        Serializes a TracedData object as TracedDataJsonIO would serialize it as an item of a list, except that shared
+        Metadata objects are written in full rather than as references.
+
+        :param td: TracedData object to serialize.
+        :type td: TracedData
+        :param indent: Indentation of the line the object starts on, when pretty-printing.
+        :type indent: str
+        :return: The serialized object, or None if it must be serialized by TracedDataJsonIO.
+        :rtype: str | None
+        """
+        heads = []
+        tails = []
+        for node in reversed(TracedDataHistory.lineage(td)):
+            metadata = dict(node._metadata.__dict__)
+            if not self._is_plain(node._data) or not self._is_plain(metadata):
+                return None
+            metadata["py/object"] = self.METADATA_CLASS
+            fields = dict(node.__dict__)
+            fields["_metadata"] = metadata
+            fields["py/object"] = self.TRACED_DATA_CLASS
+
+            if self.indent is None:
+                member_indent, start, separator, end = indent, "{", ", ", "}"
+            else:
+                member_indent = indent + self.indent
+                start, separator, end = "{\n" + member_indent, ", \n" + member_indent, "\n" + indent + "}"
+
+            if node._prev is None:
+                heads.append(start + separator.join(self._member(key, value, member_indent)
+                                                    for key, value in sorted(fields.items())) + end)
+                break
+
+            # The previous entry is written in place of this entry's "_prev" value, after this entry's head
+            keys = sorted(fields)
+            prev_index = keys.index("_prev")
+            heads.append(start + "".join(self._member(key, fields[key], member_indent) + separator
+                                         for key in keys[:prev_index]) + json.dumps("_prev") + ": ")
+            tails.append("".join(separator + self._member(key, fields[key], member_indent)
+                                 for key in keys[prev_index + 1:]) + end)
+            indent = member_indent
+
+        return "".join(heads) + "".join(reversed(tails))
+
+    def decode(self, s, pos=0):
+        """
+        Deserializes the TracedData object which starts at an index of a string.
+
+        :param s: String containing the object.
+        :type s: str
+        :param pos: Index of the start of the object in s.
+        :type pos: int
+        :return: The object, or None if it must be deserialized by TracedDataJsonIO, and the index after the end of
+                 the object.
+        :rtype: (TracedData | None, int)
+        :raises ValueError: If s does not contain a complete JSON object at pos.
+        """
+        try:
+            td, pos = self._decode(s, pos)
+        except IndexError:
+            raise ValueError("Unexpected end of a serialized TracedData object")
+        return (None if td is self._UNSUPPORTED else td), pos
+
+    def _skip(self, s, pos, separator=None):
+        # Skips the whitespace at pos, and the separator and the whitespace after it if there is one
+        pos = self._WHITESPACE.match(s, pos).end()
+        if separator is not None and s[pos] == separator:
+            pos = self._WHITESPACE.match(s, pos + 1).end()
+        return pos
+
+    def _decode(self, s, pos):
+        # The fields of the entries being parsed, newest first. Each entry's "_prev" is the next entry on the stack.
+        pos = self._skip(s, pos)
+        if s[pos] != "{":
+            raise ValueError("Expected a serialized TracedData object at position {}".format(pos))
+        stack = [dict()]
+        pos = self._skip(s, pos + 1)
+
+        while True:
+            if s[pos] == "}":
+                td = self._to_traced_data(stack.pop())
+                if len(stack) == 0:
+                    return td, pos + 1
+                stack[-1]["_prev"] = td
+                pos = self._skip(s, pos + 1, ",")
+                continue
+
+            key, pos = self._decoder.raw_decode(s, pos)
+            pos = self._skip(s, pos)
+            if s[pos] != ":":
+                raise ValueError("Expected ':' at position {}".format(pos))
+            pos = self._skip(s, pos + 1)
+
+            if key == "_prev" and s[pos] == "{":
+                stack.append(dict())
+                pos = self._skip(s, pos + 1)
+                continue
+
+            stack[-1][key], pos = self._decoder.raw_decode(s, pos)
+            pos = self._skip(s, pos, ",")
+
+    def _to_traced_data(self, fields):
+        prev = fields.get("_prev", self._UNSUPPORTED)
+        metadata = fields.get("_metadata")
+        data = fields.get("_data")
+        if fields.get("py/object") != self.TRACED_DATA_CLASS or prev is self._UNSUPPORTED or \
+                type(metadata) != dict or metadata.pop("py/object", None) != self.METADATA_CLASS or \
+                not self._is_plain(metadata) or type(data) != dict or not self._is_plain(data):
+            return self._UNSUPPORTED
+
+        # Metadata is restored as jsonpickle restores it. TracedData is rebuilt with its constructor, which derives
+        # any other fields jsonpickle wrote from the data, metadata and previous entry.
+        restored_metadata = Metadata.__new__(Metadata)
+        restored_metadata.__dict__.update(metadata)
+        return TracedData(data, restored_metadata, prev)
+
+
+class TracedDataJsonStreamIO(object):
+    """
+    Reads the JSON files produced by TracedDataJsonIO one TracedData object at a time, so that memory use does not
+    grow with the number of objects in a file.
+
+    Objects are parsed one history entry at a time, so objects with long histories can be read. Objects which that
+    parser does not handle are decoded by TracedDataJsonIO on their own, so import_json_to_traced_data_iterable cannot
+    read objects with jsonpickle references, which TracedDataJsonIO writes for objects shared by several list items
+    (or several times within one). Files written by TracedDataJsonStreamWriter never contain references. load reads
+    any file written by TracedDataJsonIO.
+    """
+    READ_SIZE = 1024 * 1024
+
+    # A jsonpickle reference to another object in the file. References are written as dictionaries with one of these
+    # keys, so they can't be confused with a string with the same contents, which would be escaped.
+    _REFERENCE = re.compile(r'"py/(?:id|ref)"\s*:')
+
+    @classmethod
+    def import_json_to_traced_data_iterable(cls, f):
+        """
+        Lazily deserializes a JSON list of TracedData objects.
+
+        :param f: File to read the list from.
+        :type f: file-like
+        :return: Generator of the TracedData objects in f, in file order.
+        :rtype: generator of TracedData
+        :raises ValueError: If an object in f contains a jsonpickle reference. Use load to read such files.
+        """
+        for td, text in cls._items(f):
+            if td is None:
+                # jsonpickle numbers references from the start of the file, so they would resolve to the wrong
+                # objects when an item is decoded on its own.
+                if cls._REFERENCE.search(text) is not None:
+                    raise ValueError("Cannot stream a JSON file containing jsonpickle references between objects; "
+                                     "load the whole file instead")
+                td = TracedDataJsonIO.import_json_to_traced_data_iterable(io.StringIO("[{}]".format(text)))[0]
+            yield td
+
+    @classmethod
+    def load(cls, f):
+        """
+        Deserializes a JSON list of TracedData objects, which may reference each other (as files written by
+        TracedDataJsonIO can). If any object cannot be read by this class, the whole file is read by TracedDataJsonIO.
+
+        :param f: File to read the list from, positioned at the start of the file. Must be seekable.
+        :type f: file-like
+        :return: The TracedData objects in f, in file order.
+        :rtype: list of TracedData
+        """
+        data = []
+        for td, _ in cls._items(f):
+            if td is None:
+                f.seek(0)
+                return TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+            data.append(td)
+        return data
+
+    @classmethod
+    def _items(cls, f):
+        # Generator of (TracedData or None if it must be decoded by TracedDataJsonIO, JSON text) of each list item
+        codec = _TracedDataJsonCodec(pretty_print=False)
+        buffer = ""
+        pos = 0
+        read_size = cls.READ_SIZE
+        started = False
+        eof = False
+
+        while True:
+            # Skip the whitespace and item separators between list items
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+                pos += 1
+
+            if pos < len(buffer):
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError("Expected a JSON list, but found '{}'".format(buffer[pos]))
+                    started = True
+                    pos += 1
+                    continue
+
+                if buffer[pos] == "]":
+                    return
+
+                try:
+                    td, end = codec.decode(buffer, pos)
+                except ValueError:
+                    # The item is incomplete, so read more of the file. Read increasingly large chunks so that
+                    # large items are not re-scanned many times.
+                    if eof:
+                        raise
+                    read_size *= 2
+                else:
+                    yield td, buffer[pos:end]
+                    pos = end
+                    read_size = cls.READ_SIZE
+                    continue
+            elif eof:
+                raise ValueError("Unexpected end of file while reading a JSON list")
+
+            chunk = f.read(read_size)
+            eof = chunk == ""
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+class TracedDataJsonStreamWriter(object):
+    """
+    Incrementally writes TracedData objects to a JSON list in the format written by
+    TracedDataJsonIO.export_traced_data_iterable_to_json.
+
+    Each object is written on its own, so objects which are shared, whether by several of the objects written (such as
+    a contact joined to several messages) or several times within one (such as Metadata shared by BulkMetadata), are
+    written in full each time, where TracedDataJsonIO would write jsonpickle references to their first occurrence.
+    The output is the same as TracedDataJsonIO's if no objects are shared, and otherwise is larger, and is read back
+    as equal but separate objects. Use export_traced_data_iterable_to_json to write a whole list with references.
+
+    Use as a context manager, or call close() once all objects have been written.
+    """
+
+    def __init__(self, f, pretty_print=False, continues_list=False):
+        """
+        :param f: File to write to.
+        :type f: file-like
+        :param pretty_print: Whether to pretty-print the output, as TracedDataJsonIO does.
+        :type pretty_print: bool
+        :param continues_list: Whether f already contains the start of a non-empty list (see open_for_append), so
+                               that written objects should continue that list.
+        :type continues_list: bool
+        """
+        self.f = f
+        self.pretty_print = pretty_print
+        self.continues_list = continues_list
+        self.items_written = 0
+        self._owns_file = False
+
+        self._head, self._separator, self._tail, self._empty = self._list_framing()
+
+        # Objects are written by the codec, which walks their lineages with loops, if it writes the same text as
+        # TracedDataJsonIO. Otherwise they are all written by TracedDataJsonIO.
+        self._codec = _TracedDataJsonCodec(pretty_print)
+        self._codec_indent = self._head[self._head.rfind("\n") + 1:] if "\n" in self._head else ""
+        probe = TracedData({"probe": "1"}, Metadata("", "", 0))
+        probe.append_data({"probe": "2"}, Metadata("", "", 1))
+        if self._codec.encode(probe, self._codec_indent) != \
+                self._item_text(self._export([probe]), self._head, self._tail):
+            self._codec = None
+
+    @classmethod
+    def export_traced_data_iterable_to_json(cls, data, f, pretty_print=False):
+        """
+        Serializes a list of TracedData objects. Lists which the codec can write are written one history entry at a
+        time, so objects with long histories can be written, but shared Metadata objects are written in full each time.
+        Other lists are written by TracedDataJsonIO, with references to the objects which are shared.
+
+        :param data: TracedData objects to write.
+        :type data: iterable of TracedData
+        :param f: File to write to.
+        :type f: file-like
+        :param pretty_print: Whether to pretty-print the output, as TracedDataJsonIO does.
+        :type pretty_print: bool
+        """
+        data = list(data)
+        writer = cls(f, pretty_print)
+        if writer._codec is None or not all(writer._codec.can_encode(td) for td in data):
+            TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=pretty_print)
+            return
+
+        with writer:
+            for td in data:
+                writer.write(td)
+
+    @classmethod
+    def open_for_append(cls, path, pretty_print=False):
+        """
+        Opens a JSON file written by TracedDataJsonIO or by this class, so that more objects can be appended to the
+        end of its list. The file is left unchanged apart from the new objects, so it must have been written with the
+        same pretty_print option.
+
+        :param path: Path to the file to append to.
+        :type path: str
+        :param pretty_print: Whether the file is pretty-printed.
+        :type pretty_print: bool
+        :return: A writer which appends to the file. The writer owns the file, which is closed by close().
+        :rtype: TracedDataJsonStreamWriter
+        """
+        writer = cls(None, pretty_print)
+        tail = writer._tail.encode("utf-8")
+        empty = writer._empty.encode("utf-8")
+
+        # Cut the end of the list off the file, so that new objects can be written after the last object.
+        with open(path, "rb+") as f:
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - max(len(tail), len(empty))))
+            end = f.read()
+
+            if size == len(empty) and end == empty:
+                f.truncate(0)
+            elif end.endswith(tail):
+                f.truncate(size - len(tail))
+                writer.continues_list = True
+            else:
+                raise ValueError("Cannot append to '{}', because it does not end with a list of TracedData "
+                                 "formatted with pretty_print={}".format(path, pretty_print))
+
+        writer.f = open(path, "a")
+        writer._owns_file = True
+        return writer
+
+    def _export(self, data):
+        f = io.StringIO()
+        TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=self.pretty_print)
+        return f.getvalue()
+
+    def _list_framing(self):
+        # Rather than duplicating the encoder options used by TracedDataJsonIO, derive the text which surrounds and
+        # separates list items from the output of TracedDataJsonIO for some small probe lists.
+        # (The probes are built separately so that they share no objects).
+        single = self._export([TracedData({"probe": "1"}, Metadata("", "", 0))])
+        other = self._export([TracedData({"probe": "2"}, Metadata("", "", 0))])
+        pair = self._export([TracedData({"probe": "1"}, Metadata("", "", 0)),
+                             TracedData({"probe": "2"}, Metadata("", "", 0))])
+        empty = self._export([])
+
+        head = re.match(r"\[\s*", single).group(0)
+        tail = re.search(r"\s*\]\s*$", single).group(0)
+        item_1 = self._item_text(single, head, tail)
+        item_2 = self._item_text(other, head, tail)
+        separator = pair[len(head) + len(item_1):len(pair) - len(tail) - len(item_2)]
+
+        return head, separator, tail, empty
+
+    @staticmethod
+    def _item_text(text, head, tail):
+        return text[len(head):len(text) - len(tail)]
+
+    def _export_item(self, td):
+        text = self._export([td])
+        if TracedDataJsonStreamIO._REFERENCE.search(text) is not None:
+            # The references in text are numbered from the start of this item, so would resolve to the wrong objects
+            # once it is in the file. Write a copy of td which shares no objects instead.
+            text = self._export([self._unshared(td)])
+            if TracedDataJsonStreamIO._REFERENCE.search(text) is not None:
+                raise ValueError("Cannot write a TracedData object with shared values of unsupported types to a "
+                                 "JSON stream")
+        return self._item_text(text, self._head, self._tail)
+
+    @classmethod
+    def _unshared(cls, value):
+        # A copy of value in which each object only appears once, so that jsonpickle writes it without references
+        if isinstance(value, TracedData):
+            unshared = copy.copy(value)
+            unshared._data = cls._unshared(value._data)
+            unshared._metadata = copy.copy(value._metadata)
+            if value._prev is not None:
+                unshared._prev = cls._unshared(value._prev)
+            return unshared
+        if type(value) == dict:
+            return {key: cls._unshared(item) for key, item in value.items()}
+        if type(value) == list:
+            return [cls._unshared(item) for item in value]
+        return copy.copy(value)
+
+    def write(self, td):
+        """
+        Serializes a TracedData object and appends it to the list being written.
+
+        :param td: TracedData object to write.
+        :type td: TracedData
+        """
+        item = None if self._codec is None else self._codec.encode(td, self._codec_indent)
+        if item is None:
+            item = self._export_item(td)
+
+        if self.items_written == 0 and not self.continues_list:
+            self.f.write(self._head)
+        else:
+            self.f.write(self._separator)
+        self.f.write(item)
+
+        self.items_written += 1
+
+    def close(self):
+        if self.items_written == 0 and not self.continues_list:
+            self.f.write(self._empty)
+        else:
+            self.f.write(self._tail)
+
+        if self._owns_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,188 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+
+from core_data_modules.cleaners import PhoneCleaner
+from core_data_modules.util import IOUtils
+
+
+class _RecordKeys(object):
+    """
+    The sorted UUIDs of an OperatorIndex's records, as a read-only sequence which bisect can search.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.record_count
+
+    def __getitem__(self, i):
+        offset = self.index.records_offset + i * self.index.record_size
+        return self.index.mm[offset:offset + self.index.uuid_width]
+
+
+class OperatorIndex(object):
+    """
+    Lookup table of avf_phone_id -> operator, precomputed from the phone number UUID table.
+
+    The operator of a contact depends only on their phone number, so it can be derived once per UUID when new UUIDs are
+    added to the phone number UUID table, rather than on every run of the survey auto-code stage. Stages which only need
+    operators can then read this index instead of loading the whole phone number <-> UUID table, so the phone numbers
+    themselves never enter their memory.
+
+    An index file is a header, the distinct operators as a JSON list, and then one fixed-width record per UUID, sorted
+    by UUID: the UUID's UTF-8 bytes padded with NULs to the width of the longest UUID, followed by a byte giving the
+    position of its operator in the list. Index files are memory-mapped and searched in place, so opening one costs
+    the same however many UUIDs it has.
+    """
+    MAGIC = b"AVFOPIX1"
+    # Magic, size and mtime (in ns) of the phone number UUID table the index was built from, number of records,
+    # width of the UUIDs, and the length of the operators JSON.
+    _HEADER = struct.Struct("<8sQqQHQ")
+    _OPERATOR = struct.Struct("<B")
+
+    def __init__(self, path):
+        """
+        Opens an index file written by update.
+
+        :param path: Path to the index file.
+        :type path: str
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.source_size, self.source_mtime_ns, self.record_count, self.uuid_width, operators_length = \
+            self._HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC:
+            self.mm.close()
+            raise ValueError("'{}' is not an operator index file".format(path))
+
+        operators_offset = self._HEADER.size
+        self.operators = json.loads(self.mm[operators_offset:operators_offset + operators_length].decode("utf-8"))
+        self.records_offset = operators_offset + operators_length
+        self.record_size = self.uuid_width + self._OPERATOR.size
+        self._keys = _RecordKeys(self)
+
+    def __reduce__(self):
+        # Worker processes re-open the file rather than copying the mapped bytes
+        return OperatorIndex, (self.path,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.record_count
+
+    def get_operator(self, avf_phone_id):
+        """
+        :param avf_phone_id: UUID of a phone number.
+        :type avf_phone_id: str
+        :return: Operator of that phone number, as cleaned by PhoneCleaner.clean_operator.
+        :rtype: str
+        :raises KeyError: If the UUID is not in the index.
+        """
+        key = avf_phone_id.encode("utf-8")
+        if len(key) > self.uuid_width:
+            raise KeyError(avf_phone_id)
+        key = key.ljust(self.uuid_width, b"\0")
+
+        i = bisect.bisect_left(self._keys, key)
+        if i == self.record_count or self._keys[i] != key:
+            raise KeyError(avf_phone_id)
+
+        operator_offset = self.records_offset + i * self.record_size + self.uuid_width
+        return self.operators[self._OPERATOR.unpack_from(self.mm, operator_offset)[0]]
+
+    def items(self):
+        """
+        :return: Generator of (avf_phone_id, operator) for every UUID in the index, in UUID order.
+        :rtype: generator of (str, str)
+        """
+        for i in range(self.record_count):
+            offset = self.records_offset + i * self.record_size
+            avf_phone_id = self.mm[offset:offset + self.uuid_width].rstrip(b"\0").decode("utf-8")
+            operator = self.operators[self._OPERATOR.unpack_from(self.mm, offset + self.uuid_width)[0]]
+            yield avf_phone_id, operator
+
+    @classmethod
+    def is_up_to_date(cls, index_path, phone_uuid_table_path):
+        """
+        :return: Whether the index file exists and was built from the current version of the phone number UUID table.
+        :rtype: bool
+        """
+        if not os.path.exists(index_path):
+            return False
+
+        table_stat = os.stat(phone_uuid_table_path)
+        with cls(index_path) as index:
+            return index.source_size == table_stat.st_size and index.source_mtime_ns == table_stat.st_mtime_ns
+
+    @classmethod
+    def update(cls, index_path, phone_uuid_table_path):
+        """
+        Brings an index file up to date with a phone number UUID table, creating it if it does not exist.
+
+        Does nothing if the table has not changed since the index was last updated. Otherwise, only the operators of
+        UUIDs which are not already in the index are derived, as the UUID table only ever has UUIDs added to it by
+        the fetch stages.
+
+        :param index_path: Path to the index file.
+        :type index_path: str
+        :param phone_uuid_table_path: Path to a phone number UUID table, as written by PhoneNumberUuidTable.dump.
+        :type phone_uuid_table_path: str
+        :return: The number of UUIDs whose operators were derived.
+        :rtype: int
+        """
+        if cls.is_up_to_date(index_path, phone_uuid_table_path):
+            return 0
+
+        operators = dict()  # of avf_phone_id -> operator
+        if os.path.exists(index_path):
+            with cls(index_path) as index:
+                operators.update(index.items())
+
+        # Stat the table before reading it, so that if it is written to while being read the next update reads it again
+        table_stat = os.stat(phone_uuid_table_path)
+        with open(phone_uuid_table_path, "r") as f:
+            phone_to_uuid = json.load(f)
+
+        derived = 0
+        for phone_number, avf_phone_id in phone_to_uuid.items():
+            if avf_phone_id not in operators:
+                operators[avf_phone_id] = PhoneCleaner.clean_operator(phone_number)
+                derived += 1
+
+        cls._write(index_path, operators, table_stat)
+        return derived
+
+    @classmethod
+    def _write(cls, index_path, operators, table_stat):
+        distinct_operators = sorted(set(operators.values()))
+        assert len(distinct_operators) <= 256, "Too many distinct operators for an operator index"
+        operator_ids = {operator: i for i, operator in enumerate(distinct_operators)}
+        operators_json = json.dumps(distinct_operators).encode("utf-8")
+
+        keys = sorted(avf_phone_id.encode("utf-8") for avf_phone_id in operators)
+        uuid_width = max([len(key) for key in keys], default=0)
+
+        # Write to a temporary file and move it into place, so that readers never see a partially written index
+        IOUtils.ensure_dirs_exist_for_file(index_path)
+        temp_path = "{}.tmp".format(index_path)
+        with open(temp_path, "wb") as f:
+            f.write(cls._HEADER.pack(cls.MAGIC, table_stat.st_size, table_stat.st_mtime_ns, len(keys), uuid_width,
+                                     len(operators_json)))
+            f.write(operators_json)
+            for key in keys:
+                f.write(key.ljust(uuid_width, b"\0"))
+                f.write(cls._OPERATOR.pack(operator_ids[operators[key.decode("utf-8")]]))
+        os.replace(temp_path, index_path)
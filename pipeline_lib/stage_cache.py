@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import shutil
+from os import path
+
+from core_data_modules.util import IOUtils
+
+from pipeline_lib.interchange import InterchangeFormats, TracedDataInterchangeIO
+
+
+class StageKey(object):
+    """
+    Content-addressed key of one run of a pipeline stage.
+
+    The key is a hash of named components, each of which is itself a hash: of the stage's code, of its arguments, of
+    each of its input files, and of the keys of the stages whose outputs it takes as input. The components are kept so
+    that differences from a previous run can be explained.
+    """
+
+    def __init__(self, stage_name, components):
+        """
+        :param stage_name: Name of the stage.
+        :type stage_name: str
+        :param components: Dictionary of component name -> hex digest.
+        :type components: dict of str -> str
+        """
+        self.stage_name = stage_name
+        self.components = components
+        self.digest = hashlib.sha256(json.dumps(components, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class StageCache(object):
+    """
+    Cache of the outputs of pipeline stages, keyed by StageKey, for skipping stages whose inputs have not changed.
+
+    Each entry holds the TracedData output of a stage in the binary interchange format, and copies of the other files
+    and directories the stage wrote (e.g. Coda files). Only the latest entry for each stage is kept.
+
+    The cache directory has one subdirectory per stage, which contains:
+     - `<key digest>/data.tdb`, the stage's TracedData output.
+     - `<key digest>/outputs/<name>`, a copy of each of the stage's other outputs.
+     - `latest.json`, the components of the key of the latest entry.
+    """
+    MISSING_FILE_DIGEST = "missing"
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: Directory to store the cache in.
+        :type cache_dir: str
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def hash_path(file_or_dir_path):
+        """
+        Returns the hex digest of the contents of a file or, for a directory, of the relative paths and contents of all
+        of the files beneath it. Paths which do not exist have the digest StageCache.MISSING_FILE_DIGEST.
+
+        :type file_or_dir_path: str
+        :rtype: str
+        """
+        if not path.exists(file_or_dir_path):
+            return StageCache.MISSING_FILE_DIGEST
+
+        if path.isdir(file_or_dir_path):
+            file_paths = []
+            for dir_path, dir_names, file_names in os.walk(file_or_dir_path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    file_paths.append(path.join(dir_path, file_name))
+        else:
+            file_paths = [file_or_dir_path]
+
+        sha = hashlib.sha256()
+        for file_path in file_paths:
+            sha.update(path.relpath(file_path, file_or_dir_path).encode("utf-8"))
+            sha.update(b"\0")
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(chunk)
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    @staticmethod
+    def hash_code(code_dirs):
+        """
+        Returns the hex digest of the Python source files and Pipfile.lock files beneath the given directories, as the
+        version of the code of a stage.
+
+        :type code_dirs: list of str
+        :rtype: str
+        """
+        sha = hashlib.sha256()
+        for code_dir in code_dirs:
+            for dir_path, dir_names, file_names in os.walk(code_dir):
+                dir_names[:] = sorted(name for name in dir_names if name != "__pycache__")
+                for file_name in sorted(file_names):
+                    if not (file_name.endswith(".py") or file_name == "Pipfile.lock"):
+                        continue
+                    file_path = path.join(dir_path, file_name)
+                    sha.update(path.relpath(file_path, code_dir).encode("utf-8"))
+                    sha.update(b"\0")
+                    with open(file_path, "rb") as f:
+                        sha.update(f.read())
+                    sha.update(b"\0")
+        return sha.hexdigest()
+
+    def key_for(self, stage_name, code_dirs, args, input_paths, upstream_keys):
+        """
+        Computes the key of a run of a stage.
+
+        :param stage_name: Name of the stage.
+        :type stage_name: str
+        :param code_dirs: Directories containing the code the stage runs.
+        :type code_dirs: list of str
+        :param args: JSON-serializable arguments to the stage.
+        :type args: dict
+        :param input_paths: Dictionary of name -> path of each of the files or directories the stage reads.
+        :type input_paths: dict of str -> str
+        :param upstream_keys: Keys of the stages whose outputs this stage takes as input.
+        :type upstream_keys: list of StageKey
+        :rtype: StageKey
+        """
+        components = {
+            "code": self.hash_code(code_dirs),
+            "args": hashlib.sha256(json.dumps(args, sort_keys=True).encode("utf-8")).hexdigest()
+        }
+        for name, input_path in input_paths.items():
+            components["input:{}".format(name)] = self.hash_path(input_path)
+        for upstream_key in upstream_keys:
+            components["upstream:{}".format(upstream_key.stage_name)] = upstream_key.digest
+
+        return StageKey(stage_name, components)
+
+    def _entry_dir(self, key):
+        return path.join(self.cache_dir, key.stage_name, key.digest)
+
+    def _latest_path(self, stage_name):
+        return path.join(self.cache_dir, stage_name, "latest.json")
+
+    def contains(self, key):
+        return path.exists(path.join(self._entry_dir(key), "data.tdb"))
+
+    def explain(self, key):
+        """
+        Explains why a stage would be run, by comparing its key with the key of the latest cache entry for the stage.
+
+        :type key: StageKey
+        :return: Reasons the stage would be run, or an empty list if its output would be loaded from the cache.
+        :rtype: list of str
+        """
+        if self.contains(key):
+            return []
+
+        latest_path = self._latest_path(key.stage_name)
+        if not path.exists(latest_path):
+            return ["no cached output"]
+        with open(latest_path, "r") as f:
+            latest_components = json.load(f)
+
+        reasons = []
+        for name in sorted(set(key.components) | set(latest_components)):
+            if name not in latest_components:
+                reasons.append("{} is new".format(name))
+            elif name not in key.components:
+                reasons.append("{} was removed".format(name))
+            elif key.components[name] != latest_components[name]:
+                if key.components[name] == self.MISSING_FILE_DIGEST:
+                    reasons.append("{} was deleted".format(name))
+                else:
+                    reasons.append("{} changed".format(name))
+        if len(reasons) == 0:
+            reasons.append("cached output is missing")
+        return reasons
+
+    def load(self, key, output_paths):
+        """
+        Loads a stage's TracedData output from the cache, and restores its other outputs.
+
+        :param key: Key of the run of the stage.
+        :type key: StageKey
+        :param output_paths: Dictionary of name -> path of each of the other files or directories the stage writes, as
+                             passed to save.
+        :type output_paths: dict of str -> str
+        :return: The cached TracedData output, or None if there is no entry for key.
+        :rtype: list of TracedData | None
+        """
+        if not self.contains(key):
+            return None
+
+        entry_dir = self._entry_dir(key)
+        for name, output_path in output_paths.items():
+            cached_path = path.join(entry_dir, "outputs", name)
+            if path.isdir(cached_path):
+                IOUtils.ensure_dirs_exist(output_path)
+                for file_name in os.listdir(cached_path):
+                    self._copy(path.join(cached_path, file_name), path.join(output_path, file_name))
+            elif path.exists(cached_path):
+                IOUtils.ensure_dirs_exist_for_file(output_path)
+                self._copy(cached_path, output_path)
+
+        return TracedDataInterchangeIO.load(path.join(entry_dir, "data.tdb"))
+
+    def save(self, key, data, output_paths):
+        """
+        Saves a stage's outputs to the cache, replacing the previous entry for the stage.
+
+        :param key: Key of the run of the stage.
+        :type key: StageKey
+        :param data: TracedData output of the stage.
+        :type data: list of TracedData
+        :param output_paths: Dictionary of name -> path of each of the other files or directories the stage wrote.
+        :type output_paths: dict of str -> str
+        """
+        entry_dir = self._entry_dir(key)
+        stage_dir = path.dirname(entry_dir)
+
+        # Build the entry in a temporary directory, so that a partially written entry is never used.
+        tmp_dir = "{}.tmp-{}".format(entry_dir, os.getpid())
+        if path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        IOUtils.ensure_dirs_exist(path.join(tmp_dir, "outputs"))
+
+        TracedDataInterchangeIO.dump(data, path.join(tmp_dir, "data.tdb"), InterchangeFormats.BINARY)
+        for name, output_path in output_paths.items():
+            if path.exists(output_path):
+                self._copy(output_path, path.join(tmp_dir, "outputs", name))
+
+        for old_entry in os.listdir(stage_dir):
+            old_entry_path = path.join(stage_dir, old_entry)
+            if old_entry_path != tmp_dir and path.isdir(old_entry_path):
+                shutil.rmtree(old_entry_path)
+        os.rename(tmp_dir, entry_dir)
+
+        with open(self._latest_path(key.stage_name), "w") as f:
+            json.dump(key.components, f, sort_keys=True, indent=2)
+
+    @staticmethod
+    def _copy(src, dst):
+        if path.isdir(src):
+            if path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst)
+        else:
+            shutil.copyfile(src, dst)
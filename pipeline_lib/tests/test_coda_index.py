@@ -0,0 +1,135 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# pipeline_lib is imported from the repository root, as it is when a stage is run.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataCodaIO
+
+from pipeline_lib.coda_index import CodaIndex, CodaMerge
+
+
+class TestCodaIndex(unittest.TestCase):
+    """
+    Checks that CodaIndex sets the same codes as applying each of its imports with TracedDataCodaIO in turn.
+    """
+    USER = "test_user"
+    TEXTS = ["yes", "no", "maybe", "water", "food"]
+    UNCODED_TEXT = "not in coda"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        # The Coda files are written by TracedDataCodaIO, so that they are in the format it reads.
+        self.answer_coda_path = self.write_coda("answer", {"Answer": "answer_coded"}, lambda i: {
+            "answer_coded": ["a", "b"][i % 2]
+        })
+        self.other_coda_path = self.write_coda("other", {"Answer": "answer_coded"}, lambda i: {
+            "answer_coded": "b"
+        })
+        self.activation_coda_path = self.write_coda("activation", {"Code 1": "code_1", "Code 2": "code_2",
+                                                                   "Relevance": "relevance"}, lambda i: {
+            "code_1": ["a", "b", "NR"][i % 3], "code_2": "b" if i % 2 == 0 else None, "relevance": ["yes", "no"][i % 2]
+        })
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_coda(self, name, scheme_keys, codes_for_text):
+        key_of_raw = "raw"
+        coded = []
+        for i, text in enumerate(self.TEXTS):
+            data = {key_of_raw: text}
+            data.update(codes_for_text(i))
+            coded.append(TracedData(data, Metadata(self.USER, "coding", 0)))
+
+        path = os.path.join(self.tmp_dir.name, "{}.csv".format(name))
+        with open(path, "w") as f:
+            TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(coded, key_of_raw, scheme_keys, f)
+        return path
+
+    def make_data(self):
+        data = []
+        texts = self.TEXTS + [self.UNCODED_TEXT]
+        for i in range(24):
+            message = {"answer_raw": texts[i % len(texts)], "activation_raw": texts[(i + 1) % len(texts)]}
+            if i % 5 == 0:
+                # A message without one of the raw keys
+                del message["activation_raw"]
+            if i % 4 == 0:
+                # A message which already has a code
+                message["answer_coded"] = "already coded"
+            data.append(TracedData(message, Metadata(self.USER, "messages", 0)))
+        return data
+
+    def make_merges(self):
+        return [
+            CodaMerge.scheme(self.answer_coda_path, "answer_raw", {"Answer": "answer_coded"},
+                             overwrite_existing_codes=False),
+            CodaMerge.scheme(self.other_coda_path, "answer_raw", {"Answer": "answer_coded"},
+                             overwrite_existing_codes=False),
+            CodaMerge.matrix(self.activation_coda_path, "activation_raw", {"Code 1", "Code 2"}, "activation_coded_"),
+            CodaMerge.scheme(self.activation_coda_path, "activation_raw", {"Relevance": "relevance_coded"},
+                             overwrite_existing_codes=True),
+            CodaMerge.scheme(self.other_coda_path, "activation_raw", {"Answer": "answer_coded"},
+                             overwrite_existing_codes=True)
+        ]
+
+    def apply_sequentially(self, data, merges):
+        # Each import is applied to the messages which have its raw key, in order, as separate TracedDataCodaIO calls
+        for merge in merges:
+            with open(merge.coda_file_path, "r") as f:
+                merge.import_codes(self.USER, [td for td in data if merge.key_of_raw in td], f)
+
+    def apply_with_index(self, data, merges):
+        coda_index = CodaIndex(merges)
+        coda_index.build(self.USER, data, workers=1)
+        for td in data:
+            codes = dict()
+            for merge_codes in coda_index.codes_for(td):
+                codes.update(merge_codes)
+            if len(codes) > 0:
+                td.append_data(codes, Metadata(self.USER, "coda_index", 0))
+
+    @staticmethod
+    def values(data):
+        return [{key: td[key] for key in td} for td in data]
+
+    def assertSameCodes(self, merges):
+        expected = self.make_data()
+        self.apply_sequentially(expected, merges)
+        actual = self.make_data()
+        self.apply_with_index(actual, merges)
+
+        self.assertEqual(self.values(actual), self.values(expected))
+
+    def test_all_merges(self):
+        self.assertSameCodes(self.make_merges())
+
+    def test_each_merge(self):
+        for merge in self.make_merges():
+            self.assertSameCodes([merge])
+
+    def test_merges_in_reverse_order(self):
+        self.assertSameCodes(list(reversed(self.make_merges())))
+
+    def test_overwriting_merge_then_non_overwriting_merge(self):
+        self.assertSameCodes([
+            CodaMerge.scheme(self.answer_coda_path, "answer_raw", {"Answer": "answer_coded"},
+                             overwrite_existing_codes=True),
+            CodaMerge.scheme(self.other_coda_path, "answer_raw", {"Answer": "answer_coded"},
+                             overwrite_existing_codes=False)
+        ])
+
+    def test_texts_not_in_coda_and_missing_raw_keys_are_covered(self):
+        data = self.make_data()
+        self.assertTrue(any(td["answer_raw"] == self.UNCODED_TEXT for td in data))
+        self.assertTrue(any("activation_raw" not in td for td in data))
+        self.assertTrue(any(td.get("answer_coded") is not None for td in data))
+
+
+if __name__ == "__main__":
+    unittest.main()
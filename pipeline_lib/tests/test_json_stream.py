@@ -0,0 +1,126 @@
+import io
+import os
+import sys
+import unittest
+
+# pipeline_lib is imported from the repository root, as it is when a stage is run.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from core_data_modules.traced_data import Metadata, TracedData
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from pipeline_lib.history import TracedDataHistory
+from pipeline_lib.json_stream import TracedDataJsonStreamIO, TracedDataJsonStreamWriter
+
+
+class TestTracedDataJsonStream(unittest.TestCase):
+    """
+    Checks the JSON stream reader and writer against TracedDataJsonIO.
+    """
+
+    @staticmethod
+    def make_messages(count, shared_metadata=None):
+        messages = []
+        for i in range(count):
+            td = TracedData({"id": str(i), "text": "héllo \"{}\"\n".format(i), "n": i, "f": 1.5,
+                             "l": [1, {"x": None}], "e": {}}, Metadata("user", "fetch", 0))
+            for j in range(i % 4):
+                metadata = Metadata("user", "step {}".format(j), 1.25 * j) if shared_metadata is None \
+                    else shared_metadata
+                td.append_data({"k{}".format(j % 3): str(j), "b": j % 2 == 0}, metadata)
+            messages.append(td)
+        return messages
+
+    @classmethod
+    def make_joined_messages(cls, shared_metadata=None):
+        # Messages joined to contacts, with each contact shared by several messages
+        contacts = [TracedData({"contact": str(i)}, Metadata("user", "contacts", 0)) for i in range(2)]
+        messages = cls.make_messages(6, shared_metadata)
+        for i, td in enumerate(messages):
+            td.append_data({"survey_responses": contacts[i % 2]},
+                           Metadata("user", "join", 2) if shared_metadata is None else shared_metadata)
+        return messages
+
+    @staticmethod
+    def export(data, pretty_print):
+        f = io.StringIO()
+        TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=pretty_print)
+        return f.getvalue()
+
+    @staticmethod
+    def stream_export(data, pretty_print):
+        f = io.StringIO()
+        with TracedDataJsonStreamWriter(f, pretty_print=pretty_print) as writer:
+            for td in data:
+                writer.write(td)
+        return f.getvalue()
+
+    @classmethod
+    def entries(cls, td):
+        # The data and metadata of each entry of td's lineage, with nested TracedData replaced by their entries
+        return [({key: cls.entries(value) if isinstance(value, TracedData) else value
+                  for key, value in node._data.items()}, node._metadata.__dict__)
+                for node in TracedDataHistory.lineage(td)]
+
+    def assertSameTracedData(self, actual, expected):
+        self.assertEqual([self.entries(td) for td in actual], [self.entries(td) for td in expected])
+
+    def test_writer_output_is_the_same_as_traced_data_json_io(self):
+        for pretty_print in [False, True]:
+            self.assertEqual(self.stream_export(self.make_messages(10), pretty_print),
+                             self.export(self.make_messages(10), pretty_print))
+            self.assertEqual(self.stream_export([], pretty_print), self.export([], pretty_print))
+
+    def test_reads_traced_data_json_io_output(self):
+        for pretty_print in [False, True]:
+            text = self.export(self.make_messages(10), pretty_print)
+            expected = TracedDataJsonIO.import_json_to_traced_data_iterable(io.StringIO(text))
+
+            self.assertSameTracedData(TracedDataJsonStreamIO.load(io.StringIO(text)), expected)
+            self.assertSameTracedData(
+                list(TracedDataJsonStreamIO.import_json_to_traced_data_iterable(io.StringIO(text))), expected)
+
+    def test_references_are_read_by_load_and_rejected_by_streaming(self):
+        text = self.export(self.make_joined_messages(), True)
+        self.assertIn("py/id", text)
+        expected = TracedDataJsonIO.import_json_to_traced_data_iterable(io.StringIO(text))
+
+        self.assertSameTracedData(TracedDataJsonStreamIO.load(io.StringIO(text)), expected)
+        with self.assertRaises(ValueError):
+            list(TracedDataJsonStreamIO.import_json_to_traced_data_iterable(io.StringIO(text)))
+
+    def test_export_keeps_references_when_the_codec_cannot_write_every_object(self):
+        data = self.make_joined_messages()
+        for pretty_print in [False, True]:
+            f = io.StringIO()
+            TracedDataJsonStreamWriter.export_traced_data_iterable_to_json(data, f, pretty_print=pretty_print)
+            self.assertEqual(f.getvalue(), self.export(data, pretty_print))
+
+    def test_writer_writes_shared_objects_in_full(self):
+        shared_metadata = Metadata("user", "bulk", 3)
+        for data in [self.make_joined_messages(), self.make_messages(10, shared_metadata),
+                     self.make_joined_messages(shared_metadata)]:
+            text = self.stream_export(data, True)
+            self.assertNotIn("py/id", text)
+
+            # Both readers, and TracedDataJsonIO, read the shared objects back as equal copies
+            self.assertSameTracedData(TracedDataJsonIO.import_json_to_traced_data_iterable(io.StringIO(text)), data)
+            self.assertSameTracedData(TracedDataJsonStreamIO.load(io.StringIO(text)), data)
+            self.assertSameTracedData(
+                list(TracedDataJsonStreamIO.import_json_to_traced_data_iterable(io.StringIO(text))), data)
+
+    def test_long_histories(self):
+        td = self.make_messages(1)[0]
+        for i in range(sys.getrecursionlimit() * 2):
+            td.append_data({"step": i}, Metadata("user", "step", i))
+
+        f = io.StringIO()
+        TracedDataJsonStreamWriter.export_traced_data_iterable_to_json([td], f, pretty_print=True)
+        f.seek(0)
+        read = TracedDataJsonStreamIO.load(f)
+        self.assertEqual(len(TracedDataHistory.lineage(read[0])), len(TracedDataHistory.lineage(td)))
+        self.assertEqual(read[0]["step"], td["step"])
+
+
+if __name__ == "__main__":
+    unittest.main()
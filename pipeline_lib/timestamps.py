@@ -0,0 +1,156 @@
+import re
+from array import array
+from datetime import date, datetime, timedelta, timezone
+
+from dateutil.parser import isoparse
+
+# East Africa Time. Africa/Nairobi has been a fixed UTC+03:00 since 1942, so a fixed offset converts the same as pytz
+# does for all of the data this pipeline handles, without a timezone database lookup per message.
+EAT = timezone(timedelta(hours=3))
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+_MICROSECONDS_PER_SECOND = 1000000
+_MICROSECONDS_PER_DAY = 86400 * _MICROSECONDS_PER_SECOND
+
+# The ISO 8601 forms written by Rapid Pro and by datetime.isoformat. Anything else is parsed with dateutil's isoparse.
+_ISO_TIMESTAMP = re.compile(
+    r"(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?(?:(Z)|([+-])(\d{2}):(\d{2}))$")
+
+
+class Timestamps(object):
+    """
+    Batch conversion of columns of ISO 8601 timestamp strings.
+
+    A column of timestamps is held as an array.array of integer microseconds since the Unix epoch (the stdlib
+    equivalent of a datetime64[us] array), so that parsing, windowing and formatting a whole column is a loop over
+    integers rather than a datetime object and timezone conversion per message. Days are converted to and from dates
+    once per distinct day in the column.
+    """
+
+    @staticmethod
+    def from_datetime(dt):
+        """
+        :param dt: Timezone-aware datetime.
+        :type dt: datetime
+        :return: Microseconds since the Unix epoch.
+        :rtype: int
+        """
+        delta = dt - _EPOCH
+        return (delta.days * 86400 + delta.seconds) * _MICROSECONDS_PER_SECOND + delta.microseconds
+
+    @classmethod
+    def parse_iterable(cls, iso_strings):
+        """
+        Parses ISO 8601 timestamp strings, which must include a UTC offset.
+
+        :param iso_strings: Timestamps to parse.
+        :type iso_strings: iterable of str
+        :return: Microseconds since the Unix epoch of each timestamp, in input order.
+        :rtype: array.array of int
+        """
+        timestamps = array("q")
+        day_cache = dict()  # of date string -> microseconds since the epoch at the start of that day (UTC)
+        for iso_string in iso_strings:
+            match = _ISO_TIMESTAMP.match(iso_string)
+            if match is None:
+                timestamps.append(cls.from_datetime(isoparse(iso_string)))
+                continue
+
+            day, hours, minutes, seconds, fraction, utc, offset_sign, offset_hours, offset_minutes = match.groups()
+            day_start = day_cache.get(day)
+            if day_start is None:
+                day_start = (date(int(day[0:4]), int(day[5:7]), int(day[8:10])).toordinal() - _EPOCH_ORDINAL) * \
+                    _MICROSECONDS_PER_DAY
+                day_cache[day] = day_start
+
+            timestamp = day_start + \
+                ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * _MICROSECONDS_PER_SECOND
+            if fraction is not None:
+                timestamp += int(fraction.ljust(6, "0"))
+            if utc is None:
+                offset = (int(offset_hours) * 60 + int(offset_minutes)) * 60 * _MICROSECONDS_PER_SECOND
+                timestamp += -offset if offset_sign == "+" else offset
+            timestamps.append(timestamp)
+        return timestamps
+
+    @staticmethod
+    def window_mask(timestamps, start, end):
+        """
+        Returns which timestamps are in a time window.
+
+        :param timestamps: Microseconds since the Unix epoch.
+        :type timestamps: array.array of int
+        :param start: Start of the window (inclusive).
+        :type start: datetime
+        :param end: End of the window (inclusive).
+        :type end: datetime
+        :return: Whether each timestamp is in the window, in input order.
+        :rtype: list of bool
+        """
+        start = Timestamps.from_datetime(start)
+        end = Timestamps.from_datetime(end)
+        return [start <= timestamp <= end for timestamp in timestamps]
+
+    @staticmethod
+    def _split_iterable(timestamps, tz):
+        """
+        Splits timestamps into the local date and the time since the start of that date in timezone tz.
+
+        :return: Generator of (date string, hours, minutes, seconds, microseconds, UTC offset string), one per
+                 timestamp.
+        :rtype: generator of (str, int, int, int, int, str)
+        """
+        offset = tz.utcoffset(None)
+        offset_microseconds = (offset.days * 86400 + offset.seconds) * _MICROSECONDS_PER_SECOND
+        offset_string = _EPOCH.astimezone(tz).isoformat()[-6:]
+
+        date_cache = dict()  # of day number -> date string
+        for timestamp in timestamps:
+            day, time_of_day = divmod(timestamp + offset_microseconds, _MICROSECONDS_PER_DAY)
+            date_string = date_cache.get(day)
+            if date_string is None:
+                date_string = date.fromordinal(_EPOCH_ORDINAL + day).isoformat()
+                date_cache[day] = date_string
+
+            seconds, microseconds = divmod(time_of_day, _MICROSECONDS_PER_SECOND)
+            minutes, seconds = divmod(seconds, 60)
+            hours, minutes = divmod(minutes, 60)
+            yield date_string, hours, minutes, seconds, microseconds, offset_string
+
+    @classmethod
+    def isoformat_iterable(cls, timestamps, tz=EAT):
+        """
+        Formats timestamps in a fixed-offset timezone as datetime.isoformat does, e.g. "2018-09-14T21:25:00+03:00".
+
+        :param timestamps: Microseconds since the Unix epoch.
+        :type timestamps: iterable of int
+        :param tz: Fixed-offset timezone to format the timestamps in.
+        :type tz: datetime.timezone
+        :return: Formatted timestamps, in input order.
+        :rtype: list of str
+        """
+        formatted = []
+        for date_string, hours, minutes, seconds, microseconds, offset_string in cls._split_iterable(timestamps, tz):
+            if microseconds == 0:
+                formatted.append("{}T{:02d}:{:02d}:{:02d}{}".format(
+                    date_string, hours, minutes, seconds, offset_string))
+            else:
+                formatted.append("{}T{:02d}:{:02d}:{:02d}.{:06d}{}".format(
+                    date_string, hours, minutes, seconds, microseconds, offset_string))
+        return formatted
+
+    @classmethod
+    def date_time_iterable(cls, timestamps, tz=EAT):
+        """
+        Formats timestamps in a fixed-offset timezone to the minute, as strftime("%Y-%m-%d %H:%M") does.
+
+        :param timestamps: Microseconds since the Unix epoch.
+        :type timestamps: iterable of int
+        :param tz: Fixed-offset timezone to format the timestamps in.
+        :type tz: datetime.timezone
+        :return: Formatted timestamps, in input order.
+        :rtype: list of str
+        """
+        return ["{} {:02d}:{:02d}".format(date_string, hours, minutes)
+                for date_string, hours, minutes, _, _, _ in cls._split_iterable(timestamps, tz)]
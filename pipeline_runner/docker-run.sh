@@ -0,0 +1,40 @@
+#!/bin/bash
+
+set -e
+
+IMAGE_NAME=esc4jmcna-pipeline-runner
+
+# Check that the correct number of arguments were provided.
+if [ $# -lt 2 ]; then
+    echo "Usage: sh docker-run.sh <user> <data-root> [--checkpoints] [--workers <workers>] [--explain] [--no-cache]"
+    exit
+fi
+
+# Assign the program arguments to bash variables.
+USER=$1
+DATA_ROOT=$2
+shift 2
+RUNNER_ARGS="$*"
+
+# Build an image for the pipeline runner.
+# The build context is the repository root, so that all of the stages and the shared pipeline_lib package can be
+# added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
+
+# Create a container from the image that was just built.
+container="$(docker container create --env USER="$USER" --env RUNNER_ARGS="$RUNNER_ARGS" "$IMAGE_NAME")"
+
+function finish {
+    # Tear down the container when done.
+    docker container rm "$container" >/dev/null
+}
+trap finish EXIT
+
+# Copy the data root into the container once, for all of the stages
+docker cp "$DATA_ROOT/." "$container:/data"
+
+# Run the container
+docker start -a -i "$container"
+
+# Copy the data root, now including the outputs of all of the stages, back out of the container
+docker cp "$container:/data/." "$DATA_ROOT"
@@ -0,0 +1,383 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import sys
+import time
+from os import path
+
+# Stages are imported from their own directories, which sit next to this one (as they do in the Docker image).
+REPO_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from core_data_modules.util import IOUtils
+
+from pipeline_lib.code_keys import CodeKeyCatalogue
+from pipeline_lib.history import TracedDataHistory
+from pipeline_lib.icr_sampler import IcrSampling
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+from pipeline_lib.operator_index import OperatorIndex
+from pipeline_lib.stage_cache import StageCache
+
+SHOW = "esc4jmcna_activation"
+VARIABLE = "S07E01_Humanitarian_Priorities"
+
+
+def load_stage(stage_name):
+    """
+    Imports the script of a pipeline stage as a module, so that its functions can be called in this process.
+
+    Each stage has its own package named `lib`, so any `lib` imported for a previous stage is removed from
+    sys.modules first, and the stage's directory is searched first while its script is being imported.
+
+    :param stage_name: Name of the stage's directory, which contains a script of the same name.
+    :type stage_name: str
+    :return: The stage's script, as a module.
+    :rtype: module
+    """
+    for module_name in list(sys.modules):
+        if module_name == "lib" or module_name.startswith("lib."):
+            del sys.modules[module_name]
+
+    stage_dir = path.join(REPO_ROOT, stage_name)
+    sys.path.insert(0, stage_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "{}_stage".format(stage_name), path.join(stage_dir, "{}.py".format(stage_name)))
+        stage = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(stage)
+    finally:
+        sys.path.remove(stage_dir)
+
+    return stage
+
+
+class StageCheckpoints(object):
+    """
+    Writes the output of each stage to the path the shell pipeline would write it to, in the background.
+
+    Each checkpoint is written by a forked process, which works from a copy-on-write snapshot of the data at the
+    time of the fork, so the next stage can start modifying the data straight away.
+    """
+
+    def __init__(self, enabled, output_format):
+        """
+        :param enabled: Whether to write checkpoints. If False, write does nothing.
+        :type enabled: bool
+        :param output_format: Format to write checkpoints in. See TracedDataInterchangeIO.
+        :type output_format: str | None
+        """
+        self.enabled = enabled
+        self.output_format = output_format
+        self.writers = []  # of (checkpoint path, multiprocessing.Process)
+
+        self._fork_context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._fork_context = multiprocessing.get_context("fork")
+
+    def write(self, data, checkpoint_path):
+        """
+        :type data: list of TracedData
+        :type checkpoint_path: str
+        """
+        if not self.enabled:
+            return
+
+        IOUtils.ensure_dirs_exist_for_file(checkpoint_path)
+        if self._fork_context is None:
+            # Without fork, the data would have to be pickled to the writer anyway, so just write it here.
+            TracedDataInterchangeIO.dump(data, checkpoint_path, self.output_format, pretty_print=True)
+            return
+
+        writer = self._fork_context.Process(
+            target=TracedDataInterchangeIO.dump, args=(data, checkpoint_path, self.output_format, True))
+        writer.start()
+        self.writers.append((checkpoint_path, writer))
+
+    def wait(self):
+        """
+        Waits for all of the checkpoints to be written.
+
+        :raises RuntimeError: If writing any of the checkpoints failed.
+        """
+        failed = []
+        for checkpoint_path, writer in self.writers:
+            writer.join()
+            if writer.exitcode != 0:
+                failed.append(checkpoint_path)
+        self.writers = []
+
+        if len(failed) > 0:
+            raise RuntimeError("Failed to write checkpoints {}".format(", ".join(failed)))
+
+
+class PipelineStage(object):
+    def __init__(self, name, key, output_paths):
+        """
+        :param name: Name of the stage, which is also the name of its directory.
+        :type name: str
+        :param key: Key of this run of the stage in the stage cache, or None if the cache is not being used.
+        :type key: StageKey | None
+        :param output_paths: Dictionary of name -> path of each of the files or directories the stage writes, other
+                             than its TracedData output.
+        :type output_paths: dict of str -> str
+        """
+        self.name = name
+        self.key = key
+        self.output_paths = output_paths
+
+
+class StageTimings(object):
+    def __init__(self):
+        self.seconds = []  # of (stage name, seconds)
+
+    def time(self, stage_name, fn, *args):
+        """
+        Calls fn(*args), recording how long it took under stage_name.
+
+        :return: The result of fn.
+        """
+        print("Running {}".format(stage_name))
+        start = time.perf_counter()
+        with Instrumentation.span(stage_name):
+            result = fn(*args)
+        self.seconds.append((stage_name, time.perf_counter() - start))
+        return result
+
+    def print_summary(self):
+        print("Stage timings:")
+        for stage_name, seconds in self.seconds:
+            print("  {}: {:.2f}s".format(stage_name, seconds))
+        print("  total: {:.2f}s".format(sum(seconds for _, seconds in self.seconds)))
+
+    def save(self, timings_path):
+        IOUtils.ensure_dirs_exist_for_file(timings_path)
+        with open(timings_path, "w") as f:
+            json.dump([{"stage": stage_name, "seconds": seconds} for stage_name, seconds in self.seconds], f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs all of the pipeline stages from cleaning messages to generating "
+                                                 "the analysis files in one process, passing the data between the "
+                                                 "stages in memory. Reads and writes the same files under data-root "
+                                                 "as the run_scripts")
+    parser.add_argument("user", help="User launching this program, for use by TracedData Metadata")
+    parser.add_argument("data_root", metavar="data-root",
+                        help="Root directory of the pipeline's data, as used by the run_scripts")
+    parser.add_argument("--checkpoints", action="store_true",
+                        help="Also write the output of each intermediate stage to data-root, as the run_scripts do. "
+                             "Checkpoints are written in the background while the following stages run")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes for survey_auto_code to clean and label contacts with, and for "
+                             "messages to classify large batches of new texts as noise with")
+    parser.add_argument("--deduplicate-coda", action="store_true",
+                        help="Export one Coda message per distinct text, with a column of the number of messages with "
+                             "that text, rather than one Coda message per message")
+    IcrSampling.add_arguments(parser)
+    parser.add_argument("--timings-path",
+                        help="Optional path to a JSON file to write the time taken by each stage to")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Run every stage, rather than loading the outputs of stages whose code and inputs have "
+                             "not changed since the last run from the stage cache in data-root")
+    parser.add_argument("--explain", action="store_true",
+                        help="Print which stages would be run and why, without running any of them")
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args("pipeline", args)
+    user = args.user
+    data_root = args.data_root
+    checkpoints = StageCheckpoints(args.checkpoints, args.output_format)
+    workers = args.workers
+    deduplicate_coda = args.deduplicate_coda
+    icr_sampling = IcrSampling.from_args(args)
+    timings_path = args.timings_path
+    output_format = args.output_format
+    no_cache = args.no_cache
+    explain = args.explain
+    if explain and no_cache:
+        parser.error("--explain cannot be used with --no-cache")
+
+    def data_path(*parts):
+        return path.join(data_root, *parts)
+
+    cache = None
+    if not no_cache:
+        cache = StageCache(data_path(".stage_cache"))
+    timings = StageTimings()
+
+    def code_dirs_for(stage_name):
+        return [path.join(REPO_ROOT, stage_name), path.join(REPO_ROOT, "pipeline_lib"),
+                path.join(REPO_ROOT, "pipeline_runner")]
+
+    # Work out the files each stage reads and writes, and the cache keys of the stages. Each stage's key includes the
+    # key of the stage before it, so a change to any stage's inputs also changes the keys of all the stages after it.
+    survey_auto_code_stage = load_stage("survey_auto_code")
+    survey_coda_names = [plan.coda_name for plan in
+                         survey_auto_code_stage.make_cleaning_plan(survey_auto_code_stage.CleanerCaches())]
+    manually_coded_path = data_path("09 Manually Coded", "{}.json".format(SHOW))
+    code_key_catalogue_path = CodeKeyCatalogue.path_for(manually_coded_path)
+    analysis_json_path = data_path("12 Analysis", "analysis.json")
+    noise_cache_path = data_path(".noise_cache.json")
+    operator_index_path = data_path("00 UUIDs", "operator_index.idx")
+
+    stages = []
+    for stage_name, args, input_paths, output_paths in [
+        ("messages", {"show": SHOW, "variable": VARIABLE, "deduplicate_coda": deduplicate_coda,
+                      "icr_sampling": icr_sampling.to_dict()}, {
+            "raw_messages": data_path("01 Raw Messages", "{}.json".format(SHOW)),
+            "prev_coda": data_path("08 Coded Coda Files", "{}_coded.csv".format(SHOW))
+        }, {
+            "coda": data_path("07 Coda Files", "{}.csv".format(SHOW)),
+            "icr": data_path("14 ICR CSVs", "{}_icr.csv".format(SHOW))
+        }),
+        ("update_messages_with_surveys", {"show": SHOW}, {
+            "contacts": data_path("04 Raw Contacts", "contacts.json")
+        }, {}),
+        ("survey_auto_code", {"deduplicate_coda": deduplicate_coda, "icr_sampling": icr_sampling.to_dict()}, dict(
+            [("phone_uuids", data_path("00 UUIDs", "phone_uuids.json"))] +
+            [("prev_coded:{}".format(coda_name), data_path("08 Coded Coda Files", "{}_coded.csv".format(coda_name)))
+             for coda_name in survey_coda_names]
+        ), dict(
+            [("coda:{}".format(coda_name), data_path("07 Coda Files", "{}.csv".format(coda_name)))
+             for coda_name in survey_coda_names] +
+            [("icr:{}".format(coda_name), data_path("14 ICR CSVs", "{}_icr.csv".format(coda_name)))
+             for coda_name in survey_coda_names]
+        )),
+        ("apply_manual_codes", {}, {
+            "coded": data_path("08 Coded Coda Files")
+        }, {
+            "interface": data_path("03 Interface Files"),
+            "code_keys": code_key_catalogue_path
+        }),
+        ("analysis_file", {"show": SHOW}, {}, {
+            "history": TracedDataHistory.checkpoint_path_for(analysis_json_path),
+            "csv_by_message": data_path("13 Analysis CSV", "{}_analysis_messages.csv".format(SHOW)),
+            "csv_by_individual": data_path("13 Analysis CSV", "{}_analysis_individuals.csv".format(SHOW)),
+            "columns_by_message": data_path("13 Analysis CSV", "{}_analysis_messages.csv.columns".format(SHOW)),
+            "columns_by_individual": data_path("13 Analysis CSV", "{}_analysis_individuals.csv.columns".format(SHOW))
+        })
+    ]:
+        key = None
+        if cache is not None:
+            upstream_keys = [] if len(stages) == 0 else [stages[-1].key]
+            key = cache.key_for(stage_name, code_dirs_for(stage_name), args, input_paths, upstream_keys)
+        stages.append(PipelineStage(stage_name, key, output_paths))
+    stages = {stage.name: stage for stage in stages}
+
+    if explain:
+        for stage in stages.values():
+            reasons = cache.explain(stage.key)
+            if len(reasons) == 0:
+                print("{}: cached".format(stage.name))
+            else:
+                print("{}: would run, because {}".format(stage.name, "; ".join(reasons)))
+        sys.exit(0)
+
+    def run_stage(stage, fn):
+        """
+        Returns the output of a stage from the cache if its inputs have not changed, otherwise by calling fn.
+        """
+        if cache is not None:
+            data = cache.load(stage.key, stage.output_paths)
+            if data is not None:
+                print("Loaded {} from the cache".format(stage.name))
+                return data
+
+        data = timings.time(stage.name, fn)
+        if cache is not None:
+            cache.save(stage.key, data, stage.output_paths)
+        return data
+
+    with instrumentation:
+        # Clean messages.
+        # Noise classifications are kept between runs, so that only texts which haven't been seen before are classified.
+        def clean_messages():
+            messages_stage = load_stage("messages")
+            IOUtils.ensure_dirs_exist(data_path("07 Coda Files"))
+            IOUtils.ensure_dirs_exist(data_path("14 ICR CSVs"))
+            noise_classifier = messages_stage.NoiseClassifier(workers=workers)
+            noise_classifier.load(noise_cache_path)
+            raw_messages = TracedDataInterchangeIO.load(data_path("01 Raw Messages", "{}.json".format(SHOW)))
+            cleaned = messages_stage.clean_messages(
+                user, raw_messages, SHOW, VARIABLE,
+                data_path("08 Coded Coda Files", "{}_coded.csv".format(SHOW)),
+                data_path("07 Coda Files", "{}.csv".format(SHOW)),
+                data_path("14 ICR CSVs", "{}_icr.csv".format(SHOW)),
+                noise_classifier=noise_classifier, deduplicate_coda=deduplicate_coda, icr_sampling=icr_sampling
+            )
+            noise_classifier.save(noise_cache_path)
+            return cleaned
+
+        data = run_stage(stages["messages"], clean_messages)
+        checkpoints.write(data, data_path("02 Clean Messages", "{}.json".format(SHOW)))
+
+        # Join the messages with the surveys
+        def update_messages_with_surveys():
+            update_messages_with_surveys_stage = load_stage("update_messages_with_surveys")
+            surveys = TracedDataInterchangeIO.iterate(data_path("04 Raw Contacts", "contacts.json"))
+            return update_messages_with_surveys_stage.update_messages_with_surveys(user, data, surveys, SHOW)
+
+        data = run_stage(stages["update_messages_with_surveys"], update_messages_with_surveys)
+        checkpoints.write(data, data_path("05 Messages & Raw Surveys", "{}.json".format(SHOW)))
+
+        # Auto-code the surveys.
+        # The operator index is derived from the phone number UUID table, which is this stage's cache input, so it is
+        # only brought up to date when the stage runs.
+        def auto_code_surveys():
+            survey_auto_code_stage = load_stage("survey_auto_code")
+            cleaner_caches = survey_auto_code_stage.CleanerCaches()
+            cleaning_plan = survey_auto_code_stage.make_cleaning_plan(cleaner_caches)
+            OperatorIndex.update(operator_index_path, data_path("00 UUIDs", "phone_uuids.json"))
+            with OperatorIndex(operator_index_path) as operator_index:
+                return survey_auto_code_stage.auto_code_surveys(
+                    user, data, cleaning_plan, cleaner_caches, operator_index, data_path("08 Coded Coda Files"),
+                    data_path("07 Coda Files"), workers, deduplicate_coda, data_path("14 ICR CSVs"), icr_sampling
+                )
+
+        data = run_stage(stages["survey_auto_code"], auto_code_surveys)
+        checkpoints.write(data, data_path("06 Auto-Coded", "{}.json".format(SHOW)))
+
+        # Apply the manual codes.
+        # The code key catalogue is always saved, so that it can be cached with the stage's other outputs.
+        def apply_manual_codes():
+            apply_manual_codes_stage = load_stage("apply_manual_codes")
+            coded_data, catalogue = apply_manual_codes_stage.apply_manual_codes(
+                user, data, data_path("08 Coded Coda Files"), data_path("03 Interface Files"))
+            catalogue.save(code_key_catalogue_path)
+            return coded_data
+
+        data = run_stage(stages["apply_manual_codes"], apply_manual_codes)
+        code_key_catalogue = CodeKeyCatalogue.load(code_key_catalogue_path)
+        checkpoints.write(data, manually_coded_path)
+
+        # Update the monitoring stats.
+        # The coded messages have all of the keys of the cleaned messages, so they are counted as both.
+        def update_stats():
+            stats_stage = load_stage("stats")
+            stats_stage.update_stats(lambda flow_name: data, data, data_path("11 Stats", "monitoring-stats.csv"))
+
+        timings.time("stats", update_stats)
+
+        # Generate the analysis files
+        def generate_analysis_files():
+            analysis_file_stage = load_stage("analysis_file")
+            IOUtils.ensure_dirs_exist_for_file(analysis_json_path)
+            IOUtils.ensure_dirs_exist(data_path("13 Analysis CSV"))
+            return analysis_file_stage.generate_analysis_files(
+                user, data, code_key_catalogue, TracedDataHistory.checkpoint_path_for(analysis_json_path),
+                data_path("13 Analysis CSV", "{}_analysis_messages.csv".format(SHOW)),
+                data_path("13 Analysis CSV", "{}_analysis_individuals.csv".format(SHOW))
+            )
+
+        folded_data = run_stage(stages["analysis_file"], generate_analysis_files)
+        IOUtils.ensure_dirs_exist_for_file(analysis_json_path)
+        TracedDataInterchangeIO.dump(folded_data, analysis_json_path, output_format, pretty_print=True)
+
+        timings.time("checkpoints", checkpoints.wait)
+
+    timings.print_summary()
+    if timings_path is not None:
+        timings.save(timings_path)
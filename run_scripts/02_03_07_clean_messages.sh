@@ -2,14 +2,16 @@
 
 set -e
 
-if [ $# -ne 2 ]; then
-    echo "Usage: sh 02_03_07_clean_messages.sh <user> <data-root>"
+if [ $# -lt 2 ]; then
+    echo "Usage: sh 02_03_07_clean_messages.sh <user> <data-root> [--incremental]"
     echo "Cleans radio show answers, and exports to The Interface and to Coda for analysis."
+    echo "With --incremental, only the messages which are not already in 02 Clean Messages are cleaned."
     exit
 fi
 
 USER=$1
 DATA_ROOT=$2
+shift 2
 
 cd ../messages
 
@@ -31,5 +33,5 @@ do
     sh docker-run.sh "$USER" "$DATA_ROOT/01 Raw Messages/$SHOW.json" "$DATA_ROOT/08 Coded Coda Files/${SHOW}_coded.csv" \
         "$SHOW" "$VARIABLE" \
         "$DATA_ROOT/02 Clean Messages/$SHOW.json" "$DATA_ROOT/07 Coda Files/$SHOW.csv" \
-        "$DATA_ROOT/14 ICR CSVs/${SHOW}_icr.csv"
+        "$DATA_ROOT/14 ICR CSVs/${SHOW}_icr.csv" "$DATA_ROOT/.noise_cache.json" "$@"
 done
@@ -11,11 +11,16 @@ fi
 USER=$1
 DATA_ROOT=$2
 
+# Bring the index of phone number UUID -> operator up to date with any UUIDs added by the fetch stages
+cd ../operator_index
+sh docker-run.sh "$DATA_ROOT/00 UUIDs/phone_uuids.json" "$DATA_ROOT/00 UUIDs/operator_index.idx"
+
 cd ../survey_auto_code
 
 mkdir -p "$DATA_ROOT/06 Auto-Coded"
 mkdir -p "$DATA_ROOT/07 Coda Files"
+mkdir -p "$DATA_ROOT/14 ICR CSVs"
 
 sh docker-run.sh "$USER" "$DATA_ROOT/05 Messages & Raw Surveys/esc4jmcna_activation.json" \
-    "$DATA_ROOT/08 Coded Coda Files/" "$DATA_ROOT/00 UUIDs/phone_uuids.json" \
-    "$DATA_ROOT/06 Auto-Coded/esc4jmcna_activation.json" "$DATA_ROOT/07 Coda Files/"
+    "$DATA_ROOT/08 Coded Coda Files/" "$DATA_ROOT/00 UUIDs/operator_index.idx" \
+    "$DATA_ROOT/06 Auto-Coded/esc4jmcna_activation.json" "$DATA_ROOT/07 Coda Files/" "$DATA_ROOT/14 ICR CSVs/"
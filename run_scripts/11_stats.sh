@@ -4,7 +4,7 @@ set -e
 
 if [ $# -ne 2 ]; then
     echo "Usage: sh 11_stats.sh <user> <data-root>"
-    echo "Produces summary stats for surveys and shows"
+    echo "Produces monitoring stats for surveys and shows, counting every message again on each run"
     exit
 fi
 
@@ -15,5 +15,5 @@ cd ../stats
 
 mkdir -p "$DATA_ROOT/11 Stats"
 
-sh docker-run.sh "$USER" "$DATA_ROOT/02 Clean Messages/" "$DATA_ROOT/10 Manually Coded/surveys.json" \
+sh docker-run.sh "$USER" "$DATA_ROOT/02 Clean Messages/" "$DATA_ROOT/09 Manually Coded/esc4jmcna_activation.json" \
     "$DATA_ROOT/11 Stats/monitoring-stats.csv"
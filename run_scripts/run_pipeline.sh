@@ -0,0 +1,18 @@
+#!/usr/bin/env bash
+
+set -e
+
+if [ $# -lt 2 ]; then
+    echo "Usage: sh run_pipeline.sh <user> <data-root> [--checkpoints] [--workers <workers>] [--explain] [--no-cache]"
+    echo "Runs steps 02 to 12 (except 04, fetching contacts) in a single process, without the intermediate "
+    echo "docker build/cp round trips. Pass --checkpoints to also write the intermediate files of each step"
+    exit
+fi
+
+USER=$1
+DATA_ROOT=$2
+shift 2
+
+cd ../pipeline_runner
+
+sh docker-run.sh "$USER" "$DATA_ROOT" "$@"
@@ -0,0 +1,41 @@
+#!/bin/bash
+
+set -e
+
+IMAGE_NAME=esc4jmcna-stats
+
+# Check that the correct number of arguments were provided.
+if [ $# -ne 4 ]; then
+    echo "Usage: sh docker-run.sh <user> <messages-input-dir> <coded-input-file> <csv-output-file>"
+    exit
+fi
+
+# Assign the program arguments to bash variables.
+USER=$1
+INPUT_MESSAGES_DIR=$2
+INPUT_CODED=$3
+OUTPUT_CSV=$4
+
+# Build an image for this pipeline stage.
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
+
+# Create a container from the image that was just built.
+container="$(docker container create --env USER="$USER" "$IMAGE_NAME")"
+
+function finish {
+    # Tear down the container when done.
+    docker container rm "$container" >/dev/null
+}
+trap finish EXIT
+
+# Copy input data into the container
+docker cp "$INPUT_MESSAGES_DIR/." "$container:/data/messages-input"
+docker cp "$INPUT_CODED" "$container:/data/coded-input.json"
+
+# Run the container
+docker start -a -i "$container"
+
+# Copy the output data back out of the container
+mkdir -p "$(dirname "$OUTPUT_CSV")"
+docker cp "$container:/data/output.csv" "$OUTPUT_CSV"
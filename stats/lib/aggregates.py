@@ -0,0 +1,55 @@
+import csv
+from collections import Counter
+
+
+class MonitoringAggregates(object):
+    """
+    Counts of messages for monitoring a project while it runs, broken down by show and by one of the groups of each
+    metric (e.g. the hour a message arrived, or the channel or operator it came from).
+
+    Every statistic is a count, and rates are only computed from the counts when the CSV is written.
+    """
+    CSV_HEADERS = ["Metric", "Show", "Group", "Count", "Rate"]
+
+    # Metrics, in the order they are written to the CSV, and the metric each is a rate of (or None for counts)
+    METRICS = [
+        ("messages", None),
+        ("noise", "messages"),
+        ("messages_by_hour", None),
+        ("coded_messages", None),
+        ("channel", "coded_messages"),
+        ("operator", "coded_messages"),
+        ("zone", "coded_messages"),
+        ("consent_withdrawn", "coded_messages")
+    ]
+
+    def __init__(self):
+        self.counts = {metric: Counter() for metric, _ in self.METRICS}  # of metric -> (show, group) -> count
+
+    def count(self, metric, show, group="", n=1):
+        self.counts[metric][(show, group)] += n
+
+    def export_csv(self, f):
+        """
+        Writes every count, with the rate of the metrics which are rates, to a CSV file.
+
+        :type f: file-like
+        """
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(self.CSV_HEADERS)
+        for metric, total_metric in self.METRICS:
+            counts = Counter(self.counts[metric])
+            if total_metric is not None:
+                # Write a rate of 0 for the shows with none of this metric's messages, e.g. shows without any noise
+                shows = {show for show, _ in counts}
+                for show, _ in self.counts[total_metric]:
+                    if show not in shows:
+                        counts[(show, "")] = 0
+
+            for (show, group), count in sorted(counts.items()):
+                rate = ""
+                if total_metric is not None:
+                    total = self.counts[total_metric][(show, "")]
+                    if total > 0:
+                        rate = "{:.4f}".format(count / total)
+                writer.writerow([metric, show, group, count, rate])
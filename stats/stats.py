@@ -0,0 +1,148 @@
+import argparse
+from os import path
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.util import IOUtils
+
+from lib.aggregates import MonitoringAggregates
+from pipeline_lib.channels import Channels
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+
+# Flow name and variable name of each show
+SHOWS = [
+    ("esc4jmcna_activation", "S07E01_Humanitarian_Priorities")
+]
+
+RAPID_PRO_CONSENT_WITHDRAWN_KEY = "esc4jmcna_consent_s07e01_complete"
+CODED_SURVEY_KEYS = [
+    "gender_coded",
+    "district_coded",
+    "urban_rural_coded",
+    "age_coded",
+    "assessment_coded",
+    "idp_coded",
+    "involved_esc4jmcna_coded",
+    "repeated_esc4jmcna_coded"
+]
+CHANNEL_KEYS = sorted(Channels.RANGES) + [Channels.NON_LOGICAL_KEY]
+
+
+def count_messages(aggregates, flow_name, variable_name, messages):
+    """
+    Counts the messages and noise of one show, in total and per hour.
+
+    :param aggregates: Aggregates to add the counts to. These are updated in place.
+    :type aggregates: MonitoringAggregates
+    :param flow_name: Name of the show's flow.
+    :type flow_name: str
+    :param variable_name: Name of the show's variable.
+    :type variable_name: str
+    :param messages: The show's cleaned messages.
+    :type messages: iterable of TracedData
+    :return: Number of messages counted.
+    :rtype: int
+    """
+    eat_key = "{} (Time EAT) - {}".format(variable_name, flow_name)
+
+    message_count = 0
+    for td in messages:
+        message_count += 1
+        aggregates.count("messages", flow_name)
+        if td.get("noise") is not None:
+            aggregates.count("noise", flow_name)
+
+        # Bucket by the hour in EAT, which is the prefix 'YYYY-MM-DDTHH' of the ISO 8601 time
+        aggregates.count("messages_by_hour", flow_name, "{}:00".format(td[eat_key][:13].replace("T", " ")))
+
+    return message_count
+
+
+def count_coded_messages(aggregates, flow_name, coded_messages):
+    """
+    Counts one show's coded messages by channel, operator and zone, and counts the messages from respondents who
+    withdrew consent.
+
+    :param aggregates: Aggregates to add the counts to. These are updated in place.
+    :type aggregates: MonitoringAggregates
+    :param flow_name: Name of the show's flow.
+    :type flow_name: str
+    :param coded_messages: The show's messages, joined with the surveys and manually coded.
+    :type coded_messages: iterable of TracedData
+    :return: Number of coded messages counted.
+    :rtype: int
+    """
+    coded_count = 0
+    for td in coded_messages:
+        coded_count += 1
+        aggregates.count("coded_messages", flow_name)
+        for channel_key in CHANNEL_KEYS:
+            if td.get(channel_key) == Codes.TRUE:
+                aggregates.count("channel", flow_name, channel_key)
+        aggregates.count("operator", flow_name, str(td.get("operator")))
+        aggregates.count("zone", flow_name, str(td.get("zone_coded")))
+
+        if td.get(RAPID_PRO_CONSENT_WITHDRAWN_KEY) == "yes" or \
+                any(td.get(key) == Codes.STOP for key in CODED_SURVEY_KEYS):
+            aggregates.count("consent_withdrawn", flow_name)
+
+    return coded_count
+
+
+def update_stats(show_messages, coded_messages, csv_output_path):
+    """
+    Counts all of the cleaned and coded messages, and writes the stats. Every message is counted again by each run, so
+    the stats follow any messages which are fetched late and any recoding.
+
+    :param show_messages: Function of flow name -> the cleaned messages of that show, for each show in SHOWS.
+    :type show_messages: function of str -> iterable of TracedData
+    :param coded_messages: The manually coded messages of the first show in SHOWS.
+    :type coded_messages: iterable of TracedData
+    :param csv_output_path: Path to a CSV file to write the stats to.
+    :type csv_output_path: str
+    """
+    aggregates = MonitoringAggregates()
+
+    for flow_name, variable_name in SHOWS:
+        with Instrumentation.span("count_messages:{}".format(flow_name)) as span:
+            message_count = count_messages(aggregates, flow_name, variable_name, show_messages(flow_name))
+            span.count("records_out", message_count)
+        print("{}: Counted {} messages".format(flow_name, message_count))
+
+    flow_name, _ = SHOWS[0]
+    with Instrumentation.span("count_coded_messages") as span:
+        coded_count = count_coded_messages(aggregates, flow_name, coded_messages)
+        span.count("records_out", coded_count)
+    print("{}: Counted {} coded messages".format(flow_name, coded_count))
+
+    IOUtils.ensure_dirs_exist_for_file(csv_output_path)
+    with open(csv_output_path, "w") as f:
+        aggregates.export_csv(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts messages by show, hour, channel, operator and zone, and the "
+                                                 "rates of noise and of withdrawn consent, for monitoring a project "
+                                                 "while it runs. Every message is counted again by each run")
+    parser.add_argument("user", help="User launching this program")
+    parser.add_argument("messages_input_dir", metavar="messages-input-dir",
+                        help="Directory containing the cleaned messages of each show, in files named "
+                             "'<flow-name>.json'")
+    parser.add_argument("coded_input_path", metavar="coded-input-path",
+                        help="Path to the manually coded messages of the show, containing a list of serialized "
+                             "TracedData objects")
+    parser.add_argument("csv_output_path", metavar="csv-output-path",
+                        help="Path to a CSV file to write the stats to")
+    Instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    user = args.user
+    messages_input_dir = args.messages_input_dir
+    coded_input_path = args.coded_input_path
+    csv_output_path = args.csv_output_path
+
+    with Instrumentation.from_args("stats", args):
+        def show_messages(flow_name):
+            return TracedDataInterchangeIO.iterate(path.join(messages_input_dir, "{}.json".format(flow_name)))
+
+        update_stats(show_messages, TracedDataInterchangeIO.iterate(coded_input_path), csv_output_path)
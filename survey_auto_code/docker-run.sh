@@ -5,8 +5,8 @@ set -e
 IMAGE_NAME=esc4jmcna-survey-auto-code
 
 # Check that the correct number of arguments were provided.
-if [ $# -ne 6 ]; then
-    echo "Usage: sh docker-run.sh <user> <data-input-path> <prev-coded-path> <phone-uuid-table> <json-output-path> <coded-output-path>"
+if [ $# -ne 7 ]; then
+    echo "Usage: sh docker-run.sh <user> <data-input-path> <prev-coded-path> <operator-index> <json-output-path> <coded-output-path> <icr-output-path>"
     echo "Note: The file at <prev-coded-output> need not exist for this script to run"
     exit
 fi
@@ -15,12 +15,14 @@ fi
 USER=$1
 INPUT_JSON=$2
 PREV_CODED_DIR=$3
-PHONE_UUID_TABLE=$4
+OPERATOR_INDEX=$4
 OUTPUT_JSON=$5
 CODED_DIR=$6
+ICR_DIR=$7
 
 # Build an image for this pipeline stage.
-docker build -t "$IMAGE_NAME" .
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
 
 # Create a container from the image that was just built.
 container="$(docker container create --env USER="$USER" "$IMAGE_NAME")"
@@ -36,7 +38,7 @@ docker cp "$INPUT_JSON" "$container:/data/input.json"
 if [ -d "$PREV_CODED_DIR" ]; then
     docker cp "$PREV_CODED_DIR" "$container:/data/prev-coded"
 fi
-docker cp "$PHONE_UUID_TABLE" "$container:/data/phone-uuid-table.json"
+docker cp "$OPERATOR_INDEX" "$container:/data/operator-index.idx"
 
 # Run the image as a container.
 docker start -a -i "$container"
@@ -47,3 +49,6 @@ docker cp "$container:/data/output.json" "$OUTPUT_JSON"
 
 mkdir -p "$CODED_DIR"
 docker cp "$container:/data/coded/." "$CODED_DIR"
+
+mkdir -p "$ICR_DIR"
+docker cp "$container:/data/icr/." "$ICR_DIR"
@@ -0,0 +1,155 @@
+import json
+import os
+from collections import OrderedDict
+
+from core_data_modules.util import IOUtils
+
+
+class CleanerCache(object):
+    """
+    Memoises a cleaning function, such as somali.DemographicCleaner.clean_gender, with a bounded least-recently-used
+    cache.
+
+    Cache keys are the raw strings passed to the cleaner, exactly as given. Normalising the keys further (e.g. by
+    lower-casing) is only safe if the cleaner normalises in the same way, which is not guaranteed by the cleaners.
+    """
+
+    def __init__(self, cleaner, max_size):
+        """
+        :param cleaner: Function of raw text -> cleaned value.
+        :type cleaner: function of str -> str
+        :param max_size: Maximum number of results to keep. The least recently used result is evicted once this is
+                         exceeded.
+        :type max_size: int
+        """
+        self.cleaner = cleaner
+        self.max_size = max_size
+        self.name = "{}.{}".format(cleaner.__module__, cleaner.__qualname__)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = OrderedDict()
+
+    def __call__(self, raw):
+        if raw in self._results:
+            self.hits += 1
+            self._results.move_to_end(raw)
+            return self._results[raw]
+
+        self.misses += 1
+        cleaned = self.cleaner(raw)
+        self._add(raw, cleaned)
+        return cleaned
+
+    def _add(self, raw, cleaned):
+        self._results[raw] = cleaned
+        self._results.move_to_end(raw)
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._results)
+
+    def items(self):
+        return list(self._results.items())
+
+    def preload(self, items):
+        for raw, cleaned in items:
+            self._add(raw, cleaned)
+        # Evictions while warming the cache are not interesting to report.
+        self.evictions = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def merge(self, other):
+        """
+        Adds the statistics and results of another cache of the same cleaner (e.g. from a worker process) to this one.
+
+        :type other: CleanerCache
+        """
+        evictions = self.evictions
+        for raw, cleaned in other.items():
+            if raw not in self._results:
+                self._add(raw, cleaned)
+        self.evictions = evictions
+
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+
+
+class CleanerCaches(object):
+    """
+    Creates one CleanerCache per cleaning function, reports their statistics, and optionally persists their contents
+    to a JSON file so that later runs start with warm caches.
+    """
+    FILE_VERSION = 1
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.caches = OrderedDict()
+
+    def cached(self, cleaner):
+        """
+        Returns the cached version of a cleaner. Repeated calls for the same cleaner return the same cache, so that
+        cleaners used for several fields share their results.
+
+        :param cleaner: Function of raw text -> cleaned value.
+        :type cleaner: function of str -> str
+        :rtype: CleanerCache
+        """
+        cache = CleanerCache(cleaner, self.max_size)
+        if cache.name not in self.caches:
+            self.caches[cache.name] = cache
+        return self.caches[cache.name]
+
+    def load(self, path):
+        """
+        Warms the caches from a file previously written by save. Does nothing if the file does not exist.
+
+        The file must have been written with the same versions of the cleaners, so it should be deleted when
+        CoreDataModules is upgraded.
+        """
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r") as f:
+            saved = json.load(f)
+        if saved.get("version") != self.FILE_VERSION:
+            print("Warning: Ignoring cleaner cache file '{}', which has an unsupported version".format(path))
+            return
+
+        for name, items in saved["caches"].items():
+            if name in self.caches:
+                self.caches[name].preload(items)
+
+    def save(self, path):
+        IOUtils.ensure_dirs_exist_for_file(path)
+        with open(path, "w") as f:
+            json.dump({
+                "version": self.FILE_VERSION,
+                "caches": {name: cache.items() for name, cache in self.caches.items()}
+            }, f)
+
+    def reset_stats(self):
+        for cache in self.caches.values():
+            cache.reset_stats()
+
+    def merge(self, other):
+        """
+        Adds the statistics and results of another CleanerCaches (e.g. from a worker process) to these caches.
+
+        :type other: CleanerCaches
+        """
+        for name, other_cache in other.caches.items():
+            self.caches[name].merge(other_cache)
+
+    def print_stats(self):
+        print("Cleaner cache statistics (hits/misses/evictions/size):")
+        for name, cache in self.caches.items():
+            print("{}: {}/{}/{}/{}".format(name, cache.hits, cache.misses, cache.evictions, len(cache)))
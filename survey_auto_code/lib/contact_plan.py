@@ -0,0 +1,133 @@
+import math
+import multiprocessing
+
+from core_data_modules.cleaners import Codes
+from core_data_modules.traced_data import Metadata
+
+from pipeline_lib.bulk_metadata import BulkMetadata
+from pipeline_lib.channels import Channels
+
+
+class CleaningPlan:
+    def __init__(self, raw_field, clean_field, coda_name, cleaner):
+        self.raw_field = raw_field
+        self.clean_field = clean_field
+        self.coda_name = coda_name
+        self.cleaner = cleaner
+
+
+class ContactPlan(object):
+    """
+    The per-contact steps of the survey auto-coding stage: marking missing answers, cleaning answers, and labelling
+    each contact with their operator and channels.
+
+    Each contact is processed independently, so the plan can be run over shards of the contacts in worker processes.
+    A parallel run runs exactly the same code on each contact as a serial run does, so produces the same TracedData
+    histories.
+    """
+
+    def __init__(self, user, cleaning_plan, cleaner_caches, operator_index):
+        """
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param cleaning_plan: Fields to mark as missing and clean.
+        :type cleaning_plan: list of CleaningPlan
+        :param cleaner_caches: Caches used by the cleaners in cleaning_plan.
+        :type cleaner_caches: lib.cleaner_cache.CleanerCaches
+        :param operator_index: Index of avf_phone_id -> operator.
+        :type operator_index: pipeline_lib.operator_index.OperatorIndex
+        """
+        self.user = user
+        self.cleaning_plan = cleaning_plan
+        self.cleaner_caches = cleaner_caches
+        self.operator_index = operator_index
+
+    def apply(self, data):
+        """
+        Runs the plan over the given TracedData objects, in this process.
+
+        :type data: list of TracedData
+        :return: data, which is updated in place.
+        :rtype: list of TracedData
+        """
+        user = self.user
+
+        # Mark missing entries in the raw data as true missing
+        missing_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td in data:
+            missing = dict()
+            for plan in self.cleaning_plan:
+                if plan.raw_field not in td:
+                    missing[plan.raw_field] = Codes.TRUE_MISSING
+            missing_metadata.append_data(td, missing)
+
+        # Clean all responses
+        cleaned_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td in data:
+            cleaned = dict()
+            for plan in self.cleaning_plan:
+                if plan.cleaner is not None:
+                    cleaned[plan.clean_field] = plan.cleaner(td[plan.raw_field])
+            cleaned_metadata.append_data(td, cleaned)
+
+        # Label each message with the operator of the sender
+        operator_metadata = BulkMetadata(user, Metadata.get_call_location())
+        for td in data:
+            operator = self.operator_index.get_operator(td["avf_phone_id"])
+            operator_metadata.append_data(td, {"operator": operator})
+
+        # Label each message with channel keys
+        Channels.set_channel_keys_for_iterable(user, data)
+
+        return data
+
+    def apply_parallel(self, data, workers):
+        """
+        Runs the plan over the given TracedData objects, split into contiguous shards across a pool of worker
+        processes.
+
+        The workers' cleaner cache statistics and results are merged back into this plan's cleaner_caches.
+
+        :type data: list of TracedData
+        :param workers: Number of worker processes to use. If 1, the plan is run in this process.
+        :type workers: int
+        :return: The updated TracedData objects, in the same order as data. When workers > 1 these are new objects,
+                 and the objects in data are not modified.
+        :rtype: list of TracedData
+        """
+        if workers <= 1 or len(data) == 0:
+            return _apply_plan(self, data)
+
+        shard_size = int(math.ceil(len(data) / workers))
+        shards = [data[i:i + shard_size] for i in range(0, len(data), shard_size)]
+
+        with multiprocessing.Pool(len(shards), initializer=_init_worker, initargs=(self,)) as pool:
+            results = pool.map(_apply_to_shard, shards, chunksize=1)
+
+        labelled = []
+        for shard, cleaner_caches in results:
+            labelled.extend(shard)
+            self.cleaner_caches.merge(cleaner_caches)
+        return labelled
+
+
+# The ContactPlan used by a worker process, set by _init_worker when the worker starts.
+_worker_plan = None
+
+
+def _init_worker(contact_plan):
+    global _worker_plan
+    _worker_plan = contact_plan
+
+
+def _apply_to_shard(shard):
+    # Report only this shard's cache statistics, as a worker may process more than one shard
+    _worker_plan.cleaner_caches.reset_stats()
+    _apply_plan(_worker_plan, shard)
+    return shard, _worker_plan.cleaner_caches
+
+
+def _apply_plan(contact_plan, data):
+    # Serial and parallel runs both call ContactPlan.apply from here, so that the call stacks recorded in Metadata are
+    # the same in both.
+    return contact_plan.apply(data)
@@ -1,123 +1,232 @@
 import argparse
+import functools
 import os
-import time
 from os import path
 
-from core_data_modules.cleaners import somali, Codes, PhoneCleaner
-from core_data_modules.traced_data import Metadata, TracedData
-from core_data_modules.traced_data.io import TracedDataJsonIO, TracedDataCodaIO
-from core_data_modules.util import IOUtils, PhoneNumberUuidTable
-
-from lib.channel import Channels
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Cleans the wt surveys and exports variables to Coda for "
-                                                 "manual verification and coding")
-    parser.add_argument("user", help="User launching this program, for use by TracedData Metadata")
-    parser.add_argument("json_input_path", metavar="json-input-path",
-                        help="Path to input file, containing a list of serialized TracedData objects as JSON")
-    parser.add_argument("prev_coded_path", metavar="prev-coded-path",
-                        help="Directory containing Coda files generated by a previous run of this pipeline stage. "
-                             "New data will be appended to this file.")
-    parser.add_argument("phone_uuid_table_path", metavar="phone-uuid-table-path",
-                        help="JSON file containing an existing phone number <-> UUID lookup table.")
-    parser.add_argument("json_output_path", metavar="json-output-path",
-                        help="Path to a JSON file to write processed TracedData messages to")
-    parser.add_argument("coded_output_path", metavar="coding-output-path",
-                        help="Directory to write coding files to")
-
-    args = parser.parse_args()
-    user = args.user
-    json_input_path = args.json_input_path
-    prev_coded_path = args.prev_coded_path
-    phone_uuid_table_path = args.phone_uuid_table_path
-    json_output_path = args.json_output_path
-    coded_output_path = args.coded_output_path
-
-    class CleaningPlan:
-        def __init__(self, raw_field, clean_field, coda_name, cleaner):
-            self.raw_field = raw_field
-            self.clean_field = clean_field
-            self.coda_name = coda_name
-            self.cleaner = cleaner
-
-    cleaning_plan = [
+from core_data_modules.cleaners import Codes, somali
+from core_data_modules.traced_data.io import TracedDataCodaIO, TracedDataCSVIO
+from core_data_modules.util import IOUtils
+
+from lib.cleaner_cache import CleanerCaches
+from lib.contact_plan import CleaningPlan, ContactPlan
+from pipeline_lib.channels import Channels
+from pipeline_lib.coda_dedup import DeduplicatedCodaIO
+from pipeline_lib.icr_sampler import IcrSampling
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+from pipeline_lib.operator_index import OperatorIndex
+
+
+def make_cleaning_plan(cleaner_caches):
+    """
+    Returns the plan for cleaning survey answers, using cached versions of the cleaners.
+
+    :param cleaner_caches: Caches to memoise the cleaners with. Raw answers are very repetitive.
+    :type cleaner_caches: CleanerCaches
+    :rtype: list of CleaningPlan
+    """
+    return [
         CleaningPlan("gender_review", "gender_clean", "Gender",
-                     somali.DemographicCleaner.clean_gender),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_gender)),
         CleaningPlan("district_review", "district_clean", "District",
-                     somali.DemographicCleaner.clean_somalia_district),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_somalia_district)),
         CleaningPlan("urban_rural_review", "urban_rural_clean", "Urban_Rural",
-                     somali.DemographicCleaner.clean_urban_rural),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_urban_rural)),
         CleaningPlan("age_review", "age_clean", "Age",
-                     somali.DemographicCleaner.clean_age),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_age)),
         CleaningPlan("assessment_review", "assessment_clean", "Assessment",
-                     somali.DemographicCleaner.clean_yes_no),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_yes_no)),
         CleaningPlan("idp_review", "idp_clean", "IDP",
-                     somali.DemographicCleaner.clean_yes_no),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_yes_no)),
 
         CleaningPlan("involved_esc4jmcna", "involved_esc4jmcna_clean", "Involved",
-                     somali.DemographicCleaner.clean_yes_no),
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_yes_no)),
         CleaningPlan("repeated_esc4jmcna", "repeated_esc4jmcna_clean", "Repeated",
-                     somali.DemographicCleaner.clean_yes_no)
+                     cleaner_caches.cached(somali.DemographicCleaner.clean_yes_no))
     ]
 
-    # Load phone number UUID table
-    with open(phone_uuid_table_path, "r") as f:
-        phone_uuids = PhoneNumberUuidTable.load(f)
-
-    # Load data from JSON file
-    with open(json_input_path, "r") as f:
-        data = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
 
+def auto_code_surveys(user, data, cleaning_plan, cleaner_caches, operator_index, prev_coded_path, coded_output_path,
+                      workers=1, deduplicate_coda=False, icr_output_path=None, icr_sampling=None):
+    """
+    Cleans survey answers, labels messages with operators and channels, and exports the answers to Coda for manual
+    verification and coding.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param data: Messages joined with surveys.
+    :type data: list of TracedData
+    :param cleaning_plan: Fields to clean, from make_cleaning_plan.
+    :type cleaning_plan: list of CleaningPlan
+    :param cleaner_caches: Caches used by the cleaners in cleaning_plan.
+    :type cleaner_caches: CleanerCaches
+    :param operator_index: Index of avf_phone_id -> operator, for looking up operators.
+    :type operator_index: OperatorIndex
+    :param prev_coded_path: Directory containing Coda files generated by a previous run of this pipeline stage.
+    :type prev_coded_path: str
+    :param coded_output_path: Directory to write coding files to.
+    :type coded_output_path: str
+    :param workers: Number of processes to clean and label contacts with.
+    :type workers: int
+    :param deduplicate_coda: Whether to export one Coda message per distinct answer, with a multiplicity column. See
+                             DeduplicatedCodaIO.
+    :type deduplicate_coda: bool
+    :param icr_output_path: If set, a sample of the respondents who answered each survey question is written to a CSV
+                            in this directory, for inter-coder reliability evaluation of the question's Coda file.
+    :type icr_output_path: str | None
+    :param icr_sampling: How to sample respondents for the ICR CSVs. If None, the default IcrSampling is used.
+    :type icr_sampling: IcrSampling | None
+    :return: The cleaned and labelled messages. These are new objects when workers > 1.
+    :rtype: list of TracedData
+    """
     # Filter out test messages sent by AVF
     contacts = [td for td in data if not td.get("test_run", False)]
 
-    # Mark missing entries in the raw data as true missing
-    for td in data:
-        missing = dict()
-        for plan in cleaning_plan:
-            if plan.raw_field not in td:
-                missing[plan.raw_field] = Codes.TRUE_MISSING
-        td.append_data(missing, Metadata(user, Metadata.get_call_location(), time.time()))
-
-    # Clean all responses
-    for td in data:
-        cleaned = dict()
-        for plan in cleaning_plan:
-            if plan.cleaner is not None:
-                cleaned[plan.clean_field] = plan.cleaner(td[plan.raw_field])
-        td.append_data(cleaned, Metadata(user, Metadata.get_call_location(), time.time()))
-
-    # Label each message with the operator of the sender
-    for td in data:
-        phone_number = phone_uuids.get_phone(td["avf_phone_id"])
-        operator = PhoneCleaner.clean_operator(phone_number)
-
-        td.append_data(
-            {"operator": operator},
-            Metadata(user, Metadata.get_call_location(), time.time())
-        )
-
-    # Label each message with channel keys
-    for td in data:
-        Channels.set_channel_keys(user, td)
+    # Mark missing entries, clean all responses, and label each message with the operator of the sender and with
+    # channel keys
+    contact_plan = ContactPlan(user, cleaning_plan, cleaner_caches, operator_index)
+    with Instrumentation.span("clean_and_label_contacts") as span:
+        data = contact_plan.apply_parallel(data, workers)
+        span.count("records_in", len(data))
+        for cache in cleaner_caches.caches.values():
+            span.count("cleaner_cache_hits", cache.hits)
+            span.count("cleaner_cache_misses", cache.misses)
 
-    # Write json output
-    IOUtils.ensure_dirs_exist_for_file(json_output_path)
-    with open(json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_json(data, f, pretty_print=True)
+    cleaner_caches.print_stats()
 
     # Output for manual verification + coding
     IOUtils.ensure_dirs_exist(coded_output_path)
+    export_to_coda = TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme
+    if deduplicate_coda:
+        export_to_coda = functools.partial(DeduplicatedCodaIO.export_traced_data_iterable_to_coda_with_scheme, user)
     for plan in cleaning_plan:
         coded_output_file_path = path.join(coded_output_path, "{}.csv".format(plan.coda_name))
         prev_coded_output_file_path = path.join(prev_coded_path, "{}_coded.csv".format(plan.coda_name))
 
-        if os.path.exists(prev_coded_output_file_path):
-            with open(coded_output_file_path, "w") as f, open(prev_coded_output_file_path, "r") as prev_f:
-                TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
-                    data, plan.raw_field, {plan.coda_name: plan.clean_field}, f, prev_f)
-        else:
-            with open(coded_output_file_path, "w") as f:
-                TracedDataCodaIO.export_traced_data_iterable_to_coda_with_scheme(
-                    data, plan.raw_field, {plan.coda_name: plan.clean_field}, f)
+        with Instrumentation.span("export_coda:{}".format(plan.coda_name)) as span:
+            if os.path.exists(prev_coded_output_file_path):
+                with open(coded_output_file_path, "w") as f, open(prev_coded_output_file_path, "r") as prev_f:
+                    export_to_coda(data, plan.raw_field, {plan.coda_name: plan.clean_field}, f, prev_f)
+            else:
+                with open(coded_output_file_path, "w") as f:
+                    export_to_coda(data, plan.raw_field, {plan.coda_name: plan.clean_field}, f)
+            span.count("records_in", len(data))
+
+    if icr_output_path is not None:
+        export_icr(data, cleaning_plan, icr_output_path, icr_sampling)
+
+    return data
+
+
+def export_icr(data, cleaning_plan, icr_output_path, icr_sampling=None):
+    """
+    Writes a sample of the respondents who answered each survey question, and their answers, for inter-coder
+    reliability evaluation.
+
+    Each respondent's answers are repeated on every one of their messages, so respondents are sampled once each, and
+    stratified by the time of their first message. Respondents who did not answer a question are not sampled for it.
+
+    :param data: Cleaned messages joined with surveys.
+    :type data: list of TracedData
+    :param cleaning_plan: Fields which were exported to Coda.
+    :type cleaning_plan: list of CleaningPlan
+    :param icr_output_path: Directory to write an ICR CSV for each field to, named '<coda-name>_icr.csv'.
+    :type icr_output_path: str
+    :param icr_sampling: How to sample respondents. If None, the default IcrSampling is used.
+    :type icr_sampling: IcrSampling | None
+    """
+    if icr_sampling is None:
+        icr_sampling = IcrSampling()
+
+    respondents = dict()  # of avf_phone_id -> first message from that respondent
+    for td in data:
+        if not td.get("test_run", False):
+            respondents.setdefault(td["avf_phone_id"], td)
+
+    IOUtils.ensure_dirs_exist(icr_output_path)
+    for plan in cleaning_plan:
+        with Instrumentation.span("export_icr:{}".format(plan.coda_name)) as span:
+            icr_sampler = icr_sampling.sampler(Channels.TIMESTAMP_KEY, "avf_phone_id")
+            icr_sampler.add_iterable(td for td in respondents.values() if td[plan.raw_field] != Codes.TRUE_MISSING)
+            icr_messages = icr_sampler.sample()
+            with open(path.join(icr_output_path, "{}_icr.csv".format(plan.coda_name)), "w") as f:
+                TracedDataCSVIO.export_traced_data_iterable_to_csv(
+                    icr_messages, f, headers=["avf_phone_id", plan.raw_field])
+            span.count("records_in", icr_sampler.messages)
+            span.count("records_out", len(icr_messages))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cleans the wt surveys and exports variables to Coda for "
+                                                 "manual verification and coding")
+    parser.add_argument("user", help="User launching this program, for use by TracedData Metadata")
+    parser.add_argument("json_input_path", metavar="json-input-path",
+                        help="Path to input file, containing a list of serialized TracedData objects as JSON")
+    parser.add_argument("prev_coded_path", metavar="prev-coded-path",
+                        help="Directory containing Coda files generated by a previous run of this pipeline stage. "
+                             "New data will be appended to this file.")
+    parser.add_argument("operator_index_path", metavar="operator-index-path",
+                        help="Index of phone number UUID -> operator, built from the phone number <-> UUID lookup "
+                             "table by the operator_index stage")
+    parser.add_argument("json_output_path", metavar="json-output-path",
+                        help="Path to a JSON file to write processed TracedData messages to")
+    parser.add_argument("coded_output_path", metavar="coding-output-path",
+                        help="Directory to write coding files to")
+    parser.add_argument("--cleaner-cache-path",
+                        help="JSON file to load cached cleaner results from at the start of the run, and to save them "
+                             "to at the end, so that reruns start with warm caches. Delete this file when the "
+                             "cleaners are updated")
+    parser.add_argument("--cleaner-cache-size", type=int, default=10000,
+                        help="Maximum number of results to cache for each cleaner")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to clean and label contacts with. Contacts are split into "
+                             "contiguous shards, one per process, and merged back in their original order")
+    parser.add_argument("--deduplicate-coda", action="store_true",
+                        help="Export one Coda message per distinct answer, with a column of the number of messages "
+                             "with that answer, rather than one Coda message per message")
+    parser.add_argument("--icr-output-path",
+                        help="Directory to write a sample of the respondents who answered each survey question to, "
+                             "for inter-coder reliability evaluation")
+    IcrSampling.add_arguments(parser)
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    user = args.user
+    json_input_path = args.json_input_path
+    prev_coded_path = args.prev_coded_path
+    operator_index_path = args.operator_index_path
+    json_output_path = args.json_output_path
+    coded_output_path = args.coded_output_path
+    output_format = args.output_format
+    cleaner_cache_path = args.cleaner_cache_path
+    cleaner_cache_size = args.cleaner_cache_size
+    workers = args.workers
+    deduplicate_coda = args.deduplicate_coda
+    icr_output_path = args.icr_output_path
+    icr_sampling = IcrSampling.from_args(args)
+
+    with Instrumentation.from_args("survey_auto_code", args):
+        # Raw answers are very repetitive, so memoise the cleaners
+        cleaner_caches = CleanerCaches(max_size=cleaner_cache_size)
+        cleaning_plan = make_cleaning_plan(cleaner_caches)
+
+        if cleaner_cache_path is not None:
+            cleaner_caches.load(cleaner_cache_path)
+
+        # Load data from JSON file
+        with Instrumentation.span("load") as span:
+            data = TracedDataInterchangeIO.load(json_input_path)
+            span.count("records_out", len(data))
+
+        with OperatorIndex(operator_index_path) as operator_index:
+            data = auto_code_surveys(user, data, cleaning_plan, cleaner_caches, operator_index, prev_coded_path,
+                                     coded_output_path, workers, deduplicate_coda, icr_output_path, icr_sampling)
+
+        if cleaner_cache_path is not None:
+            cleaner_caches.save(cleaner_cache_path)
+
+        # Write json output
+        with Instrumentation.span("dump") as span:
+            TracedDataInterchangeIO.dump(data, json_output_path, output_format, pretty_print=True)
+            span.count("records_in", len(data))
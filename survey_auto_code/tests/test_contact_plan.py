@@ -0,0 +1,119 @@
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# The stage's `lib` package is imported relative to the stage directory, and pipeline_lib from the repository root,
+# as they are when the stage is run.
+STAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(STAGE_DIR))
+sys.path.insert(0, STAGE_DIR)
+# Every stage has its own `lib` package, so forget any imported by another stage's tests run in the same process.
+for module in [name for name in sys.modules if name == "lib" or name.startswith("lib.")]:
+    del sys.modules[module]
+
+from core_data_modules.cleaners import somali
+from core_data_modules.traced_data import Metadata, TracedData
+
+from lib.cleaner_cache import CleanerCaches
+from lib.contact_plan import CleaningPlan, ContactPlan
+from pipeline_lib.channels import Channels
+from pipeline_lib.history import TracedDataHistory
+from pipeline_lib.operator_index import OperatorIndex
+
+# This stage's `lib` modules, which are put back while each test runs so that the parallel plan can pickle functions
+# from them by name.
+STAGE_MODULES = {name: module for name, module in sys.modules.items() if name == "lib" or name.startswith("lib.")}
+
+
+class TestContactPlan(unittest.TestCase):
+    CONTACTS = 40
+    TIMES = [
+        "2018-09-09T10:00:00+03:00",  # Radio promo
+        "2018-09-09T20:00:00+03:00",  # SMS ad
+        "2018-09-14T22:00:00+03:00",  # Bulk SMS and radio show
+        "2018-09-16T12:00:00+03:00"   # Non-logical time
+    ]
+
+    def setUp(self):
+        stage_modules = mock.patch.dict(sys.modules, STAGE_MODULES)
+        stage_modules.start()
+        self.addCleanup(stage_modules.stop)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        phone_uuid_table_path = os.path.join(self.tmp_dir.name, "phone_uuids.json")
+        with open(phone_uuid_table_path, "w") as f:
+            json.dump({"+25261{:07d}".format(i): self.avf_phone_id(i) for i in range(self.CONTACTS)}, f)
+
+        self.operator_index_path = os.path.join(self.tmp_dir.name, "operator_index.idx")
+        OperatorIndex.update(self.operator_index_path, phone_uuid_table_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def avf_phone_id(i):
+        return "avf-phone-uuid-{:04d}".format(i)
+
+    @classmethod
+    def make_contacts(cls):
+        contacts = []
+        for i in range(cls.CONTACTS):
+            td = TracedData({"avf_phone_id": cls.avf_phone_id(i)}, Metadata("test_user", "contacts", 1))
+            answers = {Channels.TIMESTAMP_KEY: cls.TIMES[i % len(cls.TIMES)]}
+            # Leave some answers missing, so that they are marked as missing
+            if i % 3 != 0:
+                answers["gender_review"] = ["Lab", "dhedig", "female", "male"][i % 4]
+            if i % 5 != 0:
+                answers["involved_esc4jmcna"] = ["haa", "maya", "yes"][i % 3]
+            td.append_data(answers, Metadata("test_user", "surveys", 2))
+            contacts.append(td)
+        return contacts
+
+    @staticmethod
+    def make_contact_plan(operator_index):
+        cleaner_caches = CleanerCaches()
+        cleaning_plan = [
+            CleaningPlan("gender_review", "gender_clean", "Gender",
+                         cleaner_caches.cached(somali.DemographicCleaner.clean_gender)),
+            CleaningPlan("involved_esc4jmcna", "involved_esc4jmcna_clean", "Involved",
+                         cleaner_caches.cached(somali.DemographicCleaner.clean_yes_no))
+        ]
+        return ContactPlan("test_user", cleaning_plan, cleaner_caches, operator_index)
+
+    @staticmethod
+    def history(td):
+        return [(dict(entry._data), entry._metadata.user, entry._metadata.source, entry._metadata.timestamp)
+                for entry in TracedDataHistory.lineage(td)]
+
+    # Metadata timestamps are the time each batch of updates started, so the clock is fixed for the comparison.
+    # Worker processes only see the fixed clock if they are forked from this one.
+    @unittest.skipUnless(multiprocessing.get_start_method() == "fork",
+                         "Worker processes must be forked to share the fixed clock")
+    @mock.patch("pipeline_lib.bulk_metadata.time")
+    def test_serial_and_parallel_runs_are_equal(self, mock_time):
+        mock_time.time.return_value = 1536500000.0
+
+        with OperatorIndex(self.operator_index_path) as operator_index:
+            serial = self.make_contact_plan(operator_index).apply_parallel(self.make_contacts(), 1)
+            parallel_plan = self.make_contact_plan(operator_index)
+            parallel = parallel_plan.apply_parallel(self.make_contacts(), 4)
+
+        self.assertEqual(len(serial), self.CONTACTS)
+        self.assertEqual(len(parallel), self.CONTACTS)
+        for serial_td, parallel_td in zip(serial, parallel):
+            self.assertEqual(set(serial_td.keys()), set(parallel_td.keys()))
+            for key in serial_td.keys():
+                self.assertEqual(serial_td[key], parallel_td[key])
+            self.assertEqual(self.history(serial_td), self.history(parallel_td))
+
+        # The workers' cleaner cache statistics are merged back into the parallel plan's caches
+        for cache in parallel_plan.cleaner_caches.caches.values():
+            self.assertEqual(cache.hits + cache.misses, self.CONTACTS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,7 +17,8 @@ INPUT_SURVEY=$3
 OUTPUT_JSON=$4
 
 # Build an image for this pipeline stage.
-docker build -t "$IMAGE_NAME" .
+# The build context is the repository root, so that the shared pipeline_lib package can be added to the image.
+docker build -t "$IMAGE_NAME" -f Dockerfile ..
 
 # Create a container from the image that was just built.
 container="$(docker container create --env USER="$USER" "$IMAGE_NAME")"
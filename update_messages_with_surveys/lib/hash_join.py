@@ -0,0 +1,159 @@
+from collections import Counter
+
+from core_data_modules.traced_data import TracedData
+
+
+class JoinReport(object):
+    """Counts of the keys which did and did not match during a TracedDataHashJoin."""
+
+    def __init__(self, contact_report=None):
+        """
+        :param contact_report: Report from indexing the contacts which messages will be joined to, for reports on joins
+                               which share one contact index.
+        :type contact_report: JoinReport | None
+        """
+        self.messages = 0
+        self.matched_messages = 0
+        self.unmatched_message_keys = set()
+        self.message_key_counts = Counter()
+
+        self.contacts = 0
+        self.duplicate_contact_keys = set()
+        self.matched_contact_keys = set()
+        self.contact_keys = set()
+
+        if contact_report is not None:
+            self.contacts = contact_report.contacts
+            self.duplicate_contact_keys = contact_report.duplicate_contact_keys
+            self.contact_keys = contact_report.contact_keys
+
+    def print_summary(self, name):
+        duplicate_message_keys = [key for key, count in self.message_key_counts.items() if count > 1]
+        unmatched_contact_keys = self.contact_keys - self.matched_contact_keys
+
+        print("Join summary for {}:".format(name))
+        print("  Messages: {} ({} matched, {} unmatched)".format(
+            self.messages, self.matched_messages, self.messages - self.matched_messages))
+        print("  Distinct message keys with no contact: {}".format(len(self.unmatched_message_keys)))
+        print("  Distinct message keys with more than one message: {}".format(len(duplicate_message_keys)))
+        print("  Contacts: {} ({} distinct keys)".format(self.contacts, len(self.contact_keys)))
+        print("  Contact keys with more than one contact (the last contact is used): {}".format(
+            len(self.duplicate_contact_keys)))
+        print("  Contact keys with no messages: {}".format(len(unmatched_contact_keys)))
+
+
+class TracedDataHashJoin(object):
+    """
+    Joins messages to contacts on an id key, by building a hash index over one side and streaming the other side
+    through it.
+
+    Each matched message is updated with TracedData.update_iterable, so joined messages are the same as those produced
+    by calling TracedData.update_iterable over all the messages and contacts. Messages with no matching contact are
+    passed through unchanged. Where several contacts have the same key, the last one is used.
+    """
+
+    def __init__(self, user, id_key, prefix):
+        """
+        :param user: Identifier of the user running this program, for TracedData Metadata.
+        :type user: str
+        :param id_key: Key to join messages and contacts on.
+        :type id_key: str
+        :param prefix: Prefix passed to TracedData.update_iterable.
+        :type prefix: str
+        """
+        self.user = user
+        self.id_key = id_key
+        self.prefix = prefix
+
+    def _update(self, message, contact):
+        TracedData.update_iterable(self.user, self.id_key, [message], [contact], self.prefix)
+
+    def index_contacts(self, contacts, report=None):
+        """
+        Builds an index of contacts by id key, for use with join_messages.
+
+        :type contacts: iterable of TracedData
+        :param report: Optional JoinReport to record contact counts in.
+        :type report: JoinReport | None
+        :rtype: dict of str -> TracedData
+        """
+        index = dict()
+        for contact in contacts:
+            key = contact[self.id_key]
+            if report is not None:
+                report.contacts += 1
+                if key in index:
+                    report.duplicate_contact_keys.add(key)
+                report.contact_keys.add(key)
+            index[key] = contact
+        return index
+
+    def join_messages(self, messages, contact_index, report):
+        """
+        Joins a stream of messages to an index of contacts built by index_contacts.
+
+        :type messages: iterable of TracedData
+        :type contact_index: dict of str -> TracedData
+        :param report: JoinReport to record message counts in.
+        :type report: JoinReport
+        :return: Generator of the messages, joined where possible, in their original order.
+        :rtype: generator of TracedData
+        """
+        for message in messages:
+            key = message[self.id_key]
+            report.messages += 1
+            report.message_key_counts[key] += 1
+
+            contact = contact_index.get(key)
+            if contact is None:
+                report.unmatched_message_keys.add(key)
+            else:
+                report.matched_messages += 1
+                report.matched_contact_keys.add(key)
+                self._update(message, contact)
+
+            yield message
+
+    def join_contacts(self, messages, contacts, report):
+        """
+        Joins messages to a stream of contacts, by indexing the messages and retaining only the contacts which match
+        them. Use this instead of join_messages when there are fewer messages than contacts.
+
+        :type messages: list of TracedData
+        :type contacts: iterable of TracedData
+        :param report: JoinReport to record counts in.
+        :type report: JoinReport
+        :return: messages, joined where possible and updated in place.
+        :rtype: list of TracedData
+        """
+        message_index = dict()
+        for message in messages:
+            key = message[self.id_key]
+            report.messages += 1
+            report.message_key_counts[key] += 1
+            message_index.setdefault(key, []).append(message)
+
+        # Keep the last contact for each key, to match the behaviour of join_messages.
+        matched_contacts = self.index_contacts(
+            (contact for contact in contacts if self._record_contact(contact, message_index, report)))
+
+        for key, key_messages in message_index.items():
+            contact = matched_contacts.get(key)
+            if contact is None:
+                report.unmatched_message_keys.add(key)
+                continue
+
+            report.matched_contact_keys.add(key)
+            for message in key_messages:
+                report.matched_messages += 1
+                self._update(message, contact)
+
+        return messages
+
+    def _record_contact(self, contact, message_index, report):
+        key = contact[self.id_key]
+        report.contacts += 1
+        if key in report.contact_keys:
+            report.duplicate_contact_keys.add(key)
+        report.contact_keys.add(key)
+        return key in message_index
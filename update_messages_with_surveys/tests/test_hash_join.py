@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+
+# The stage's `lib` package is imported relative to the stage directory, and pipeline_lib from the repository root,
+# as they are when the stage is run.
+STAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(STAGE_DIR))
+sys.path.insert(0, STAGE_DIR)
+# Every stage has its own `lib` package, so forget any imported by another stage's tests run in the same process.
+for module in [name for name in sys.modules if name == "lib" or name.startswith("lib.")]:
+    del sys.modules[module]
+
+from core_data_modules.traced_data import Metadata, TracedData
+
+from lib.hash_join import JoinReport, TracedDataHashJoin
+
+
+class TestTracedDataHashJoin(unittest.TestCase):
+    """
+    Checks that TracedDataHashJoin joins messages to contacts in the same way as TracedData.update_iterable.
+    """
+    USER = "test_user"
+    ID_KEY = "avf_phone_id"
+    PREFIX = "survey_responses"
+
+    @classmethod
+    def make_messages(cls):
+        # Messages from phone ids 0-9, where phone ids 8 and 9 have no contact
+        return [TracedData({cls.ID_KEY: "phone-{}".format(i % 10), "text": "message {}".format(i)},
+                           Metadata(cls.USER, "messages", 0))
+                for i in range(30)]
+
+    @classmethod
+    def make_contacts(cls):
+        # Contacts for phone ids 0-7 and 10-11 (which have no messages), with a second contact for phone ids 2 and 5
+        contacts = []
+        for i in list(range(8)) + [10, 11, 2, 5]:
+            contact = TracedData({cls.ID_KEY: "phone-{}".format(i), "gender": "contact {}".format(len(contacts))},
+                                 Metadata(cls.USER, "contacts", 0))
+            contact.append_data({"age": str(20 + i)}, Metadata(cls.USER, "contacts", 1))
+            contacts.append(contact)
+        return contacts
+
+    @classmethod
+    def values(cls, td):
+        # The current values of td, with any nested TracedData replaced by their values
+        return {key: cls.values(td[key]) if isinstance(td[key], TracedData) else td[key] for key in td}
+
+    def expected(self):
+        messages = self.make_messages()
+        TracedData.update_iterable(self.USER, self.ID_KEY, messages, self.make_contacts(), self.PREFIX)
+        return [self.values(td) for td in messages]
+
+    def join(self):
+        return TracedDataHashJoin(self.USER, self.ID_KEY, self.PREFIX)
+
+    def test_join_messages(self):
+        join = self.join()
+        contact_report = JoinReport()
+        contact_index = join.index_contacts(self.make_contacts(), contact_report)
+        report = JoinReport(contact_report)
+        joined = list(join.join_messages(self.make_messages(), contact_index, report))
+
+        self.assertEqual([self.values(td) for td in joined], self.expected())
+        self.assertEqual(report.messages, 30)
+        self.assertEqual(report.matched_messages, 24)
+        self.assertEqual(contact_report.duplicate_contact_keys, {"phone-2", "phone-5"})
+
+    def test_join_contacts(self):
+        report = JoinReport()
+        joined = self.join().join_contacts(self.make_messages(), self.make_contacts(), report)
+
+        self.assertEqual([self.values(td) for td in joined], self.expected())
+        self.assertEqual(report.messages, 30)
+        self.assertEqual(report.matched_messages, 24)
+        self.assertEqual(report.contacts, 12)
+        self.assertEqual(report.duplicate_contact_keys, {"phone-2", "phone-5"})
+
+
+if __name__ == "__main__":
+    unittest.main()
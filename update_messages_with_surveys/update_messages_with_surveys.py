@@ -1,8 +1,48 @@
 import argparse
+import os
+
+from lib.hash_join import JoinReport, TracedDataHashJoin
+from pipeline_lib.instrumentation import Instrumentation
+from pipeline_lib.interchange import TracedDataInterchangeIO
+
+
+def survey_join(user):
+    """
+    Returns the join of messages to surveys on respondents' phone ids, which adds the survey data to each message under
+    the prefix "survey_responses".
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :rtype: TracedDataHashJoin
+    """
+    return TracedDataHashJoin(user, "avf_phone_id", "survey_responses")
+
+
+def update_messages_with_surveys(user, messages, surveys, name):
+    """
+    Joins a list of messages to a stream of surveys, by indexing the messages and retaining only the surveys which
+    match them.
+
+    :param user: Identifier of the user running this program, for TracedData Metadata.
+    :type user: str
+    :param messages: Messages to add survey data to.
+    :type messages: list of TracedData
+    :param surveys: Surveys to join to the messages.
+    :type surveys: iterable of TracedData
+    :param name: Name of the messages, for the printed join summary.
+    :type name: str
+    :return: messages, joined where possible and updated in place.
+    :rtype: list of TracedData
+    """
+    report = JoinReport()
+    with Instrumentation.span("join_contacts") as span:
+        messages = survey_join(user).join_contacts(messages, surveys, report)
+        span.count("messages", report.messages)
+        span.count("matched_messages", report.matched_messages)
+        span.count("contacts", report.contacts)
+    report.print_summary(name)
+    return messages
 
-from core_data_modules.traced_data import TracedData
-from core_data_modules.traced_data.io import TracedDataJsonIO
-from core_data_modules.util import IOUtils
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Joins radio show answers with survey answers on respondents' "
@@ -14,25 +54,53 @@ if __name__ == "__main__":
                         help="Path to the cleaned survey JSON file, containing a list of serialized TracedData objects")
     parser.add_argument("json_output_path", metavar="json-output-path",
                         help="Path to a JSON file to write processed messages to")
+    parser.add_argument("--show", nargs=2, action="append", default=[],
+                        metavar=("json-input-path", "json-output-path"),
+                        help="Additional show to join with the same surveys, given as the path to its messages JSON "
+                             "file and the path to write its processed messages to. May be repeated. The surveys are "
+                             "only loaded once for all the shows")
+    TracedDataInterchangeIO.add_output_format_argument(parser)
+    Instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
     user = args.user
     json_input_path = args.json_input_path
     survey_input_path = args.survey_input_path
     json_output_path = args.json_output_path
+    shows = [(json_input_path, json_output_path)] + [tuple(show) for show in args.show]
+    output_format = args.output_format
 
-    # Load messages
-    with open(json_input_path, "r") as f:
-        messages = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+    with Instrumentation.from_args("update_messages_with_surveys", args):
+        # Add survey data to the messages, by hashing the smaller of the two sides on avf_phone_id and streaming the
+        # larger side through the index. When joining several shows, always index the surveys so that they are only
+        # loaded once.
+        if len(shows) == 1 and os.path.getsize(json_input_path) < os.path.getsize(survey_input_path):
+            with Instrumentation.span("load") as span:
+                messages = TracedDataInterchangeIO.load(json_input_path)
+                span.count("records_out", len(messages))
+            messages = update_messages_with_surveys(
+                user, messages, TracedDataInterchangeIO.iterate(survey_input_path), json_input_path)
 
-    # Load surveys
-    with open(survey_input_path, "r") as f:
-        surveys = TracedDataJsonIO.import_json_to_traced_data_iterable(f)
+            # Write json output
+            with Instrumentation.span("dump") as span:
+                TracedDataInterchangeIO.dump(messages, json_output_path, output_format, pretty_print=True)
+                span.count("records_in", len(messages))
+        else:
+            join = survey_join(user)
+            contact_report = JoinReport()
+            with Instrumentation.span("index_contacts") as span:
+                contact_index = join.index_contacts(TracedDataInterchangeIO.iterate(survey_input_path), contact_report)
+                span.count("contacts", contact_report.contacts)
 
-    # Add survey data to the messages
-    TracedData.update_iterable(user, "avf_phone_id", messages, surveys, "survey_responses")
+            for show_input_path, show_output_path in shows:
+                report = JoinReport(contact_report)
 
-    # Write json output
-    IOUtils.ensure_dirs_exist_for_file(json_output_path)
-    with open(json_output_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_json(messages, f, pretty_print=True)
+                # Write json output
+                with Instrumentation.span("join_messages") as span, \
+                        TracedDataInterchangeIO.writer(show_output_path, output_format, pretty_print=True) as writer:
+                    for message in join.join_messages(TracedDataInterchangeIO.iterate(show_input_path), contact_index,
+                                                      report):
+                        writer.write(message)
+                    span.count("messages", report.messages)
+                    span.count("matched_messages", report.matched_messages)
+                report.print_summary(show_input_path)